@@ -1,21 +1,86 @@
 # Core python
-import os
+import os, sys
 import re
-from collections import deque
+import json
+
+# Asynchronous work
+import asyncio
 
 # import praw
 import asyncpraw
+import asyncprawcore
 
 # Data
 import pandas as pd
+import numpy as np
+import fsspec
 
 # Time
 from datetime import datetime, timedelta
 import time
 
+# Attribute access
+from operator import attrgetter
+
 # Logging and monitoring
 import logging
 
+# GVCEH objects
+# Utilities folder, found from this file so the standalone scrapers (run from their own folder) can import it too
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import rate_limiter as rl
+import history_store as hs
+import seen_index as si
+import fetch_state as fs
+import checkpoint as cp
+
+
+class RateHeaderRequestor(asyncprawcore.Requestor):
+    '''
+    asyncprawcore requestor passing the rate limit headers of each Reddit response
+    (X-Ratelimit-Remaining, -Used and -Reset) to a callback, so the fetcher's rate
+    limiter can be synced with the server without reading asyncprawcore internals.
+    Used through asyncpraw.Reddit's requestor_class argument.
+
+    Inputs:
+        __init__ :
+            rate_header_callback: Function called with (remaining, used, reset_seconds)
+            Other arguments are passed to asyncprawcore.Requestor
+
+    '''
+
+    def __init__(self,
+                 *args,
+                 rate_header_callback=None,
+                 **kwargs):
+        '''
+        Initialize the RateHeaderRequestor class.
+        '''
+
+        super().__init__(*args, **kwargs)
+
+        self.rate_header_callback = rate_header_callback
+
+    async def request(self,
+                      *args,
+                      **kwargs):
+        '''
+        Method to make a request and report its rate limit headers
+        '''
+
+        response = await super().request(*args, **kwargs)
+
+        headers = response.headers
+        if self.rate_header_callback is not None and "x-ratelimit-remaining" in headers:
+            try:
+                self.rate_header_callback(float(headers["x-ratelimit-remaining"]),
+                                          float(headers.get("x-ratelimit-used", 0)),
+                                          float(headers["x-ratelimit-reset"]))
+            except (KeyError, ValueError):
+                pass
+
+        return response
+
 
 class GVCEHReddit():
     '''
@@ -27,10 +92,17 @@ class GVCEHReddit():
     maintains a search history and only adds new submissions if they are
     not already in the search history.
 
-    Primary output are the post files found in the posts file path.  The
-    naming convention for these files is {subreddit}_posts_data.csv.  Note
-    that the logic within the fetch_data excludes any submission IDs already
-    in the posts output file.
+    Fetched posts are appended to a history store (an SQLite table keyed on
+    the submission ID, partitioned by subreddit - see utils/history_store.py)
+    kept in the store file path.  Previous history files named
+    {subreddit}_posts_data.csv are imported into the store the first time a
+    subreddit is fetched.  Note that the logic within the fetch_data excludes
+    any submission IDs already in the history store, using a persistent index
+    of fetched IDs (see utils/seen_index.py).
+
+    Primary output is the reddit_posts.csv file in the posts file path which
+    holds the posts added by the latest fetch (the posts that need scoring).
+    The full history can be read with the read_history method.
 
     The fetch_data method has an optional logging feature which can be turned on
     by setting the logging input parameter to True.
@@ -55,15 +127,25 @@ class GVCEHReddit():
 
     Outputs:
         fetch_data:
-            Posts files found in the posts_file_path
+            New posts file found in the posts_file_path
+            History store found in the store_file_path
             Log files found in the logs_file_path
 
     Attributes:
         posts_file_path: Path to the retrieved posts or submissions
         logs_file_path: Path to the logs captured during retrieval
+        store_file_path: Path to the history store (must be on local disk)
+        store_file_name: Name of the history store file
+        seen_index_file_name: Name of the file with the index of fetched submission IDs
+        fetch_state_file_name: Name of the file with fetch high-water marks
+        checkpoint_file_name: Name of the checkpoint file of unfinished fetches ({} is the fetch type)
+        checkpoint_max_age: Age after which an unfinished fetch's checkpoint is no longer resumed
+        new_posts_file_name: Name of the file with the posts added by the latest fetch
 
         keywords_file_path: Path to the CSV files with keyword search terms
         keywords_files:  Names of files with keywords
+        keyword_stop_words: Words removed from keywords when they are cleaned
+        keyword_cache_file_name: Name of the file caching the cleaned search terms (kept in the store file path)
         subreddits_file: Name of file with subreddits from which to pull data
 
         df_columns: Columns of the retrieved submissions data
@@ -73,9 +155,25 @@ class GVCEHReddit():
         search_time_filter:  The look-back period for the API search
         limit_num: Maximum number of submissions to retrieve in response to a search
         file_update_trigger:  Number of submissions to retrieve before updating output data
+        fetch_concurrency: Maximum number of subreddit/search term searches running at the same time
+        row_queue: Optional asyncio.Queue receiving the lists of new posts as they are fetched (for streaming scoring)
+
+        batch_search_terms: True if search terms should be ORed together into as few queries as possible
+        max_query_length: Maximum length of a batched search query
+        unmatched_search_term: search_term recorded for posts returned by a batched query that
+                               match none of its terms locally
+
+        incremental_search: True if searches should sort by new and stop once they only return posts
+                            already seen
+        seen_run_limit: Number of already seen posts in a row that stops an incremental search
+
+        group_subreddits: True if low volume subreddits should be searched together (sub1+sub2+...)
+        subreddit_group_volume: Maximum combined history row count of a subreddit group
+        subreddit_group_max_size: Maximum number of subreddits in a group
 
-        api_call_times: A doubly ended queue store of timestamps for all API calls
-        pause_indexes: A doubly ended queue store of timestamps indexes at which API fetching was paused
+        listing_page_size: Number of submissions Reddit returns per listing request
+
+        rate_limiter: Token bucket shared by all API calls of a fetch (see utils/rate_limiter.py)
 
         dup_cols: Columns to use in determining duplicates (which are dropped before saving)
 
@@ -88,6 +186,17 @@ class GVCEHReddit():
     posts_file_path = "../../data/reddit/posts"
     logs_file_path = "../../data/reddit/logs"
     keywords_file_path = "../../data/keywords"
+    store_file_path = "../../data/reddit/store"
+
+    # History store and new posts files
+    store_file_name = "reddit_posts.db"
+    seen_index_file_name = "seen_ids.db"
+    fetch_state_file_name = "fetch_state.db"
+
+    # Checkpoints of unfinished fetches
+    checkpoint_file_name = "reddit_{}_checkpoint.json"
+    checkpoint_max_age = timedelta(days=1)
+    new_posts_file_name = "reddit_posts.csv"
 
     # Reddit submission attributes to retain
     df_columns = ["id", "created_at", "scrape_time", "author", "subreddit", "title",
@@ -96,29 +205,56 @@ class GVCEHReddit():
     # Files with keywords used to search reddits
     keywords_files = ["keywords.csv", "hashtags_other.csv"]
 
+    # Remove these words from search terms
+    keyword_stop_words = ['stop', 'the', 'to', 'and', 'a', 'in', 'it',
+                          'is', 'I', 'i', 'that', 'had', 'on', 'for', 'were', 'was',
+                          'through', 'of', 'way', 'end', 'our', 'place', 'home',
+                          'support', 'city', 'visitor', 'women', 'men', 'need', 'idea',
+                          'north', 'south', 'east', 'west', 'ready', 'save', 'salt', 'win',
+                          'lose', 'loss', 'family', 'working', 'hope', 'love', 'house']
+
+    # Cache of cleaned search terms
+    keyword_cache_file_name = "keyword_cache.json"
+
     # File with list of subreddit from which to pull data
     subreddits_file = "subreddits.csv"
 
-    # API Rate limits
+    # API Rate limits - the limiter is also synced with the rate limit headers returned by Reddit
     # api_call_limit = 880
     api_call_limit = 440
     rate_limit_window = timedelta(minutes=10)
 
-    # Sleep between API calls (seconds) if there's no pause
-    api_sleep_time = 0.05
+    # Submissions returned per listing request
+    listing_page_size = 100
 
     # Max number of submissions to retrieve
     limit_num = 1000
     
-    # New limit number - maximum posts to retrieve using fetch_new endpoint
+    # New limit number - posts to retrieve using fetch_new endpoint when a subreddit has no high-water mark
     new_limit_num = 125
 
-    # Number of new rows triggering a file update
+    # Number of new rows triggering a history store update and checkpoint
     file_update_trigger = 500
 
-    # Store timestamps of all API calls
-    api_call_times = deque()
-    pause_indexes = deque()
+    # Queue receiving new posts for streaming scoring (None if not streaming)
+    row_queue = None
+
+    # Maximum number of searches running concurrently over the shared Reddit session
+    fetch_concurrency = 4
+
+    # Search term batching - OR search terms together up to Reddit's query length limit
+    batch_search_terms = False
+    max_query_length = 512
+    unmatched_search_term = "<unmatched>"
+
+    # Incremental search - sort by new and stop paging once results are already seen
+    incremental_search = False
+    seen_run_limit = 25
+
+    # Subreddit grouping - search low volume subreddits together in one request
+    group_subreddits = False
+    subreddit_group_volume = 250
+    subreddit_group_max_size = 10
 
     # Fetch search lookback window
     search_time_filter = "month"
@@ -156,6 +292,14 @@ class GVCEHReddit():
         if fetch_logging != True:
             self.fetch_logging = False
 
+        # Loggers keyed by log file stub
+        self.loggers = {}
+
+        # Text cleaning patterns, compiled once - unwanted characters (replaced by a space), stop words and extra spaces
+        self.unwanted_char_pattern = re.compile(r"\\n|r/|[^a-zA-Z0-9 ]+")
+        self.stop_word_pattern = re.compile(r"\b(?:{})\b".format("|".join([re.escape(w) for w in self.keyword_stop_words])))
+        self.extra_space_pattern = re.compile(r"\s{2,}")
+
     def __get_subreddit_names(self):
         '''
         Get subreddit names from a file
@@ -167,11 +311,76 @@ class GVCEHReddit():
         # Ensure keywords are strings and remove any duplicates
         self.subreddit_names = df_kw["subreddit_names"].unique().tolist()
 
+    def __plan_subreddit_groups(self):
+        '''
+        Method to decide which subreddits are searched together in one multi-subreddit
+        request.  Subreddit volume is measured by the number of posts in its history file.
+        Subreddits are packed, smallest first, into groups whose combined volume stays
+        under subreddit_group_volume; subreddits at or above that volume (e.g. britishcolumbia)
+        are always searched on their own.
+
+        Without group_subreddits set every subreddit is its own group.
+
+        '''
+
+        # One group per subreddit
+        if not self.group_subreddits:
+            self.subreddit_groups = [[subreddit_name] for subreddit_name in self.subreddit_names]
+            return
+
+        # Count history rows for each subreddit
+        volumes = {subreddit_name: self.history_store.partition_count(partition=subreddit_name)
+                   for subreddit_name in self.subreddit_names}
+
+        # Pack low volume subreddits together
+        self.subreddit_groups = []
+        this_group = []
+        group_volume = 0
+        for subreddit_name in sorted(self.subreddit_names, key=lambda n: volumes[n]):
+
+            # High volume subreddits are searched alone
+            if volumes[subreddit_name] >= self.subreddit_group_volume:
+                self.subreddit_groups.append([subreddit_name])
+                continue
+
+            # Start a new group if this one is full
+            if len(this_group) > 0 and \
+                    (group_volume + volumes[subreddit_name] >= self.subreddit_group_volume or
+                     len(this_group) >= self.subreddit_group_max_size):
+                self.subreddit_groups.append(this_group)
+                this_group = []
+                group_volume = 0
+
+            this_group.append(subreddit_name)
+            group_volume = group_volume + volumes[subreddit_name]
+
+        if len(this_group) > 0:
+            self.subreddit_groups.append(this_group)
+
     def __get_search_terms(self):
         '''
-        Get search terms from files with keywords
+        Get search terms from files with keywords.  The cleaned search terms are cached
+        with a signature of the keyword files (their size and version or modification
+        time) and the stop words, so the keyword files are only read and cleaned again
+        when one of them changes.
         '''
 
+        # Signature of the keyword files and the cleaning rules
+        signature = self.__get_keywords_signature()
+
+        # Use the cached search terms if nothing has changed
+        cache_file = os.path.join(self.store_file_path, self.keyword_cache_file_name)
+        try:
+            with open(cache_file, "r") as f:
+                keyword_cache = json.load(f)
+
+            if keyword_cache["signature"] == signature:
+                self.search_terms = keyword_cache["search_terms"]
+                return
+
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
         # A list holding keywords
         keywords = []
 
@@ -185,7 +394,153 @@ class GVCEHReddit():
             keywords.extend([self.__clean_keyword_text(k) for k in df_kw[df_kw.columns[0]].tolist()])
 
         # Ensure keywords are strings and remove any duplicates
-        self.search_terms = [k for k in set(keywords) if isinstance(k, str) and len(k) > 1]
+        self.search_terms = sorted([k for k in set(keywords) if isinstance(k, str) and len(k) > 1])
+
+        # Cache the search terms
+        os.makedirs(self.store_file_path, exist_ok=True)
+        with open(cache_file, "w") as f:
+            json.dump({"signature": signature, "search_terms": self.search_terms}, f)
+
+    def __get_keywords_signature(self):
+        '''
+        Method to get a signature of the keyword files and stop words used to create the
+        search terms.  Files may be local or in cloud storage, so their size and version
+        (md5 hash in GCP storage, otherwise modification time) are read through fsspec
+        without reading the files.
+
+        Output:
+            Dictionary of the unwanted characters pattern, stop words and list of [file name, size, version]
+
+        '''
+
+        signature = {"unwanted_chars": self.unwanted_char_pattern.pattern,
+                     "stop_words": list(self.keyword_stop_words),
+                     "files": []}
+
+        for kwf in self.keywords_files:
+            kwf_fs, kwf_path = fsspec.core.url_to_fs(os.path.join(self.keywords_file_path, kwf))
+            info = kwf_fs.info(kwf_path)
+
+            version = info.get("md5Hash", info.get("mtime", info.get("updated")))
+            signature["files"].append([kwf, info.get("size"), str(version)])
+
+        return signature
+
+    def __create_search_queries(self):
+        '''
+        Method to create the list of queries to run against each subreddit.  Each entry is a
+        tuple of (query, search terms in the query, term matcher).
+
+        Without batching every search term is its own query.  With batch_search_terms set,
+        search terms are ORed together into queries no longer than max_query_length, e.g.
+            homeless OR encampment OR (affordable housing) OR shelter
+        Multi-word terms are wrapped in parentheses so they keep the meaning they have when
+        searched on their own.  Submissions returned by a batched query are attributed back
+        to their search terms locally using the term matcher (see __match_search_terms).
+
+        '''
+
+        # One query per search term
+        if not self.batch_search_terms:
+            self.search_queries = [(term, [term], None) for term in self.search_terms]
+            return
+
+        join_str = " OR "
+
+        # Group search terms greedily into queries that fit the length limit
+        term_groups = []
+        this_group = []
+        length = 0
+        for term in sorted(self.search_terms):
+
+            # Phrase used for this term in the query
+            phrase = "({})".format(term) if " " in term else term
+
+            # Length of the query if this term is added
+            added_length = len(phrase) if len(this_group) == 0 else len(phrase) + len(join_str)
+
+            if len(this_group) > 0 and length + added_length > self.max_query_length:
+                term_groups.append(this_group)
+                this_group = []
+                length = 0
+                added_length = len(phrase)
+
+            this_group.append((term, phrase))
+            length = length + added_length
+
+        if len(this_group) > 0:
+            term_groups.append(this_group)
+
+        # Create the queries and a matcher for each
+        self.search_queries = []
+        for group in term_groups:
+            query = join_str.join([phrase for term, phrase in group])
+            terms = [term for term, phrase in group]
+            self.search_queries.append((query, terms, self.__compile_term_matcher(terms)))
+
+    def __compile_term_matcher(self,
+                               terms):
+        '''
+        Method to compile a single regular expression matching every word used by a list of
+        search terms.  Scanning a post once with this pattern finds all the words it contains,
+        and a search term matches when all of its words were found.
+
+        Inputs:
+            terms: list
+                Cleaned search terms
+
+        Output:
+            Tuple of (compiled pattern, list of (term, set of term words))
+
+        '''
+
+        term_words = [(term, set(term.split())) for term in terms]
+        all_words = sorted(set().union(*[words for term, words in term_words]), key=len, reverse=True)
+
+        pattern = re.compile(r"\b(?:{})\b".format("|".join([re.escape(w) for w in all_words])))
+
+        return pattern, term_words
+
+    def __match_search_terms(self,
+                             text,
+                             terms,
+                             matcher):
+        '''
+        Method to attribute a submission returned by a query to the search terms it matches.
+
+        Inputs:
+            text: str
+                Title and selftext of the submission
+            terms: list
+                Search terms in the query
+            matcher: tuple
+                Term matcher returned by __compile_term_matcher (None for single term queries)
+
+        Output:
+            Search term(s) for the search_term column - matching terms are joined with ", ".
+            If Reddit returned the submission but no term matches locally (e.g. through Reddit's
+            word stemming) unmatched_search_term is recorded.
+
+        '''
+
+        # Single term queries need no matching
+        if matcher is None:
+            return terms[0]
+
+        pattern, term_words = matcher
+
+        # Clean the post text the same way search terms are cleaned
+        text = self.__clean_keyword_text(str(text))
+
+        # Find all the term words present in the text in a single pass
+        found_words = set(pattern.findall(text))
+
+        matches = [term for term, words in term_words if words <= found_words]
+
+        if len(matches) == 0:
+            return self.unmatched_search_term
+
+        return ", ".join(matches)
 
 
     async def fetch_search_data(self):
@@ -193,6 +548,15 @@ class GVCEHReddit():
         '''
         Function for retrieving Reddit data using the search method.
 
+        Subreddit and search term searches run as asyncio tasks over a single shared
+        asyncpraw session.  At most fetch_concurrency searches are in flight at any
+        one time and all of them count against the same API rate limit.
+
+        New posts are saved to the history store every file_update_trigger posts, along
+        with a checkpoint of the completed subreddit and query searches, and again if the
+        fetch fails.  A fetch started after a failure resumes from the checkpoint and skips
+        searches that were already completed.
+
         This function needs to be called with await
         # df = await test.fetch_data()
 
@@ -201,350 +565,887 @@ class GVCEHReddit():
         # Get the search terms
         self.__get_search_terms()
 
+        # Get the queries to run for these search terms
+        self.__create_search_queries()
+
         # Get subreddit names
         self.__get_subreddit_names()
 
-        # Initialize a asyncpraw reddit object
-        reddit = asyncpraw.Reddit(client_id=self.client_id,
-                                  client_secret=self.client_secret,
-                                  user_agent=self.user_agent)
+        # Load the checkpoint of an unfinished search fetch, if any
+        self.__open_checkpoint(fetch_type="search")
 
-        # Search in each subreddit
-        for subreddit_name in self.subreddit_names:
-
-            # Create a subreddit class
-            subreddit = await reddit.subreddit(subreddit_name)
+        # Open the history store and get the submissions already fetched
+        self.__open_history_store()
 
-            # Get history file name, if it exists
-            history_file = f'{subreddit_name}_posts_data.csv'
+        # Stream the posts saved before the interruption to the scoring queue
+        await self.__stream_restored_posts()
 
-            # Start logger
-            self.__log_event(msg_id=0, screen_print=False, logfile_stub=subreddit_name)
+        # Decide which subreddits to search together
+        self.__plan_subreddit_groups()
 
-            # Log fetch start
-            self.__log_event(msg_id=1, screen_print=True, event='start fetch', subreddit_name=subreddit_name)
+        # Initialize a asyncpraw reddit object, with the API rate limiter shared by all its calls
+        reddit = self.__start_api_call_rate()
 
-            # Read files with previous Reddit data into a dataframe
-            try:
-                subreddit_df = pd.read_csv(os.path.join(self.posts_file_path, history_file))
-                seen_submission_ids = set(subreddit_df['id'])
+        # Bound the number of searches running at the same time
+        search_slots = asyncio.Semaphore(self.fetch_concurrency)
 
-                # check if history columns match expected
-                if (len(subreddit_df.columns) != len(self.df_columns)) or \
-                            ((subreddit_df.columns == self.df_columns).any() == False):
+        # Posts of completed searches waiting to be saved
+        self.search_buffer = []
+        self.buffered_searches = []
 
-                    # Log submission processing
-                    msg = ("History file appears corrupted")
-                    self.__log_event(msg_id=1, screen_print=True, event='processing error', error_msg=msg)
+        try:
+            # Search in each subreddit group
+            await self.__gather_searches([self.__fetch_subreddit_search(reddit=reddit,
+                                                                 subreddit_group=subreddit_group,
+                                                                 search_slots=search_slots)
+                                          for subreddit_group in self.subreddit_groups])
 
-                    raise RuntimeError(msg)
+        except:
+            # Save the completed searches so a new fetch can resume from here
+            self.__flush_search_buffer()
 
-            except FileNotFoundError:
-                # Create a new dataframe
-                subreddit_df = None
-                seen_submission_ids = set()
+            # Log checkpoint
+            self.__log_event(msg_id=1, screen_print=True, event='fetch failed - checkpoint saved',
+                             completed_searches=len(self.checkpoint.completed), logfile_stub=self.store_logfile_stub)
 
-            # List to hold dictionaries of new posts
-            subreddit_data = []
+            raise
 
-            # Now search for search terms
-            for search_term in self.search_terms:
+        finally:
+            # Close reddit object
+            await reddit.close()
 
-                # Search Reddit for each search term
-                try:
+        # Save what is left in the buffer
+        self.__flush_search_buffer()
 
-                    async for submission in subreddit.search(search_term,
-                                                             limit=self.limit_num,
-                                                             time_filter=self.search_time_filter):
+        # Write the file of new posts
+        self.__write_new_posts_file()
 
-                        # Manage API call rate
-                        self.__manage_api_call_rate()
+        # The fetch is finished - no need to resume it
+        self.checkpoint.clear()
 
-                        # Check if we already have this submission in the dataset
-                        if submission.id in seen_submission_ids:
+        # Log file update - finished fetch
+        self.__log_event(msg_id=1, screen_print=True, event='fetch complete', logfile_stub=self.store_logfile_stub)
 
-                            # Log submission found
-                            self.__log_event(msg_id=1, screen_print=False, event='submission ID found', id=submission.id)
+        # Close logging
+        self.__log_event(msg_id=-1, screen_print=False)
 
-                            continue
 
-                        # Log submission processing
-                        self.__log_event(msg_id=1, screen_print=False, event='submission processing', id=submission.id)
+    async def __fetch_subreddit_search(self,
+                                       reddit,
+                                       subreddit_group,
+                                       search_slots):
+        '''
+        Method to run all search term searches for a group of subreddits and save any new
+        posts to each subreddit's history.  A group with more than one subreddit is
+        searched in a single request per query using Reddit's sub1+sub2+... syntax and the
+        results are split back into the subreddits' histories.  Searches completed by an
+        earlier, unfinished fetch are skipped.
+
+        Inputs:
+            reddit: asyncpraw.Reddit
+                Reddit session shared by all searches
+            subreddit_group: list
+                Names of the subreddits to search together
+            search_slots: asyncio.Semaphore
+                Semaphore limiting the number of concurrent searches
 
-                        # Load data for this submission id
-                        await submission.load()
-                        seen_submission_ids.add(submission.id)
+        '''
 
-                        # Manage API call rate
-                        self.__manage_api_call_rate()
+        # Combined subreddit name (just the subreddit name if searched on its own)
+        group_name = "+".join(subreddit_group)
 
-                        # Dictionary to hold
-                        sub_dict = {}
+        # Create a subreddit class
+        subreddit = await reddit.subreddit(group_name)
 
-                        # Add submission to dictionary
-                        for col in self.df_columns:
+        # Start logger
+        self.__log_event(msg_id=0, screen_print=False, logfile_stub=group_name)
 
-                            if col == "created_at":
-                                sub_dict[col] = datetime.utcfromtimestamp(int(getattr(submission, "created_utc")))
+        # Log fetch start
+        self.__log_event(msg_id=1, screen_print=True, event='start fetch', subreddit_name=group_name,
+                         logfile_stub=group_name)
 
-                            elif col == "scrape_time":
-                                sub_dict[col] =  datetime.now().strftime(self.dtformat)
+        # Searches still to run - completion is kept per subreddit, as the groups can change between runs
+        search_queries = [search_query for search_query in self.search_queries
+                          if not all((subreddit_name, search_query[0]) in self.checkpoint.completed
+                                     for subreddit_name in subreddit_group)]
 
-                            elif col == "search_term":
-                                sub_dict[col] = search_term
+        # Log skipped searches
+        if len(search_queries) < len(self.search_queries):
+            self.__log_event(msg_id=1, screen_print=False, event='resuming fetch',
+                             skipped_searches=len(self.search_queries) - len(search_queries),
+                             logfile_stub=group_name)
 
-                            else:
-                                sub_dict[col] = getattr(submission, col)
+        # Now search for search terms - each completed search adds its new posts to the search buffer
+        await self.__gather_searches([self.__search_subreddit_term(subreddit=subreddit,
+                                                                   subreddit_name=group_name,
+                                                                   subreddit_group=subreddit_group,
+                                                                   search_query=search_query,
+                                                                   seen_submission_ids=self.seen_submission_ids,
+                                                                   search_slots=search_slots)
+                                      for search_query in search_queries])
 
-                        # Add this to the list of dictionaries
-                        subreddit_data.append(sub_dict)
 
-                except Exception as e:
+    async def __gather_searches(self,
+                                searches):
+        '''
+        Method to run searches as asyncio tasks and wait for all of them.  If one fails,
+        the others are cancelled and waited for before the error is raised, so no search
+        is left running on the closed reddit session or adding to a flushed buffer.
 
-                    # Log exception
-                    self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
-                                     exception_info=str(e), query_num=len(self.api_call_times), search_term=search_term)
+        Input:
+            searches: list
+                Coroutines of the searches to run
 
-                    raise RuntimeError(e)
+        '''
 
-            # Construct a new dataframe with history and new posts
-            if len(subreddit_data) > 0:
+        tasks = [asyncio.ensure_future(search) for search in searches]
 
-                # Combine new posts with history
-                if type(subreddit_df) == type(None):
-                    new_data_df = pd.DataFrame(data=subreddit_data)
+        try:
+            await asyncio.gather(*tasks)
 
-                else:
-                    new_data_df = pd.concat(objs=[subreddit_df, pd.DataFrame(data=subreddit_data)])
+        except BaseException:
+            # Stop the other searches
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-                # Drop duplicates
-                new_data_df = new_data_df.drop_duplicates(subset=self.dup_cols)
+            raise
 
-                # Save the file
-                new_data_df.to_csv(path_or_buf=os.path.join(self.posts_file_path, history_file), index=False)
 
-                # Log file update
-                self.__log_event(msg_id=1, screen_print=False, event='saving final data', new_row_count=len(subreddit_data))
+    def __buffer_search_results(self,
+                                subreddit_group,
+                                query,
+                                term_data):
+        '''
+        Method to add the new posts of a completed search to the search buffer, and save
+        the buffer once it holds file_update_trigger posts.
 
-            else:
-                self.__log_event(msg_id=1, screen_print=False, event='no new post results found')
+        Inputs:
+            subreddit_group: list
+                Names of the subreddits searched
+            query: str
+                Query searched
+            term_data: list
+                List of dictionaries of new posts
 
-        # Write the combined file
-        self.__concat_posts_files()
+        '''
 
-        # Log file update - finished fetch
-        self.__log_event(msg_id=1, screen_print=True, event='fetch complete')
+        # Split the new posts by subreddit - posts from outside the group (e.g. user profile
+        # posts) stay with the first subreddit of the group as they would in a single search
+        name_lookup = {subreddit_name.lower(): subreddit_name for subreddit_name in subreddit_group}
+        for sub_dict in term_data:
+            subreddit_name = name_lookup.get(str(sub_dict["subreddit"]).lower(), subreddit_group[0])
+            self.search_buffer.append((subreddit_name, sub_dict))
 
-        # Close logging
-        self.__log_event(msg_id=-1, screen_print=False)
+        # Record the completed search
+        self.buffered_searches.append(("+".join(subreddit_group), query))
 
-        # Close reddit object
-        await reddit.close()
+        # Save the buffer if it is full
+        if len(self.search_buffer) >= self.file_update_trigger:
+            self.__flush_search_buffer()
 
 
-    async def fetch_new_data(self):
+    def __flush_search_buffer(self):
+        '''
+        Method to append the posts in the search buffer to the history store, save the
+        high-water marks of the buffered searches and checkpoint them as completed.
 
         '''
-        Function for retrieving Reddit data using the new method.
 
-        This function needs to be called with await
-        # df = await test.fetch_data()
+        # Group the buffered posts by subreddit
+        subreddit_data = {}
+        for subreddit_name, sub_dict in self.search_buffer:
+            subreddit_data.setdefault(subreddit_name, []).append(sub_dict)
+
+        # Append the new posts to the history store
+        for subreddit_name in subreddit_data:
+            self.__save_subreddit_posts(subreddit_name=subreddit_name,
+                                        subreddit_data=subreddit_data[subreddit_name],
+                                        logfile_stub=self.store_logfile_stub)
+
+        # Now the posts are saved, save the searches' high-water marks
+        for group_name, query in self.buffered_searches:
+            mark_key = "{}|{}".format(group_name, query)
+            if mark_key in self.pending_high_water_marks:
+                post_id, created_utc = self.pending_high_water_marks.pop(mark_key)
+                self.fetch_state.set_high_water_mark(key=mark_key,
+                                                     post_id=post_id,
+                                                     created_utc=created_utc)
+
+        # Checkpoint the completed searches for each subreddit searched
+        self.checkpoint.completed.update([(subreddit_name, query)
+                                          for group_name, query in self.buffered_searches
+                                          for subreddit_name in group_name.split("+")])
+        self.checkpoint.save()
+
+        # Empty the buffer
+        self.search_buffer = []
+        self.buffered_searches = []
+
+
+    async def __search_subreddit_term(self,
+                                      subreddit,
+                                      subreddit_name,
+                                      subreddit_group,
+                                      search_query,
+                                      seen_submission_ids,
+                                      search_slots):
+        '''
+        Method to search one subreddit for one search query (a single search term or a
+        batch of ORed search terms).
+
+        With incremental_search set the search is sorted by new and paging stops as soon
+        as seen_run_limit already seen posts come back in a row, or a post older than the
+        newest post found for this subreddit and query in an earlier fetch (its high-water
+        mark) is reached.
+
+        Inputs:
+            subreddit: asyncpraw.models.Subreddit
+                Subreddit to search
+            subreddit_name: str
+                Name of the subreddit (used to route log messages)
+            subreddit_group: list
+                Names of the subreddits searched
+            search_query: tuple
+                Entry of search_queries - (query, search terms in the query, term matcher)
+            seen_submission_ids: SeenIdIndex
+                Index of submission IDs already fetched; shared by all searches and updated in place
+            search_slots: asyncio.Semaphore
+                Semaphore limiting the number of concurrent searches
+
+        The new posts found are added to the search buffer once the search completes.
 
         '''
 
-        # Get subreddit names
-        self.__get_subreddit_names()
+        # List to hold new submissions
+        new_submissions = []
 
-        # Initialize a asyncpraw reddit object
-        reddit = asyncpraw.Reddit(client_id=self.client_id,
-                                  client_secret=self.client_secret,
-                                  user_agent=self.user_agent)
+        # Unpack the query
+        query, query_terms, term_matcher = search_query
 
-        # Search in each subreddit
-        for subreddit_name in self.subreddit_names:
+        # Search options - incremental searches go newest first
+        search_kwargs = {"limit": self.limit_num,
+                         "time_filter": self.search_time_filter}
 
-            # Create a subreddit class
-            subreddit = await reddit.subreddit(subreddit_name)
+        if self.incremental_search:
+            search_kwargs["sort"] = "new"
 
-            # Get history file name, if it exists
-            history_file = f'{subreddit_name}_posts_data.csv'
+            # Newest post found by this search in earlier fetches
+            mark_key = "{}|{}".format(subreddit_name, query)
+            _, mark_created_utc = self.fetch_state.get_high_water_mark(key=mark_key)
 
-            # Start logger
-            self.__log_event(msg_id=0, screen_print=False, logfile_stub=subreddit_name)
+            # Newest post found by this search now
+            newest_submission = None
 
-            # Log fetch start
-            self.__log_event(msg_id=1, screen_print=True, event='start fetch', subreddit_name=subreddit_name)
+            # Count of already seen posts in a row
+            seen_run = 0
 
-            # List to hold dictionaries of new posts
-            subreddit_data = []
+        # Wait for a free search slot
+        async with search_slots:
 
-            # Read files with previous Reddit data into a dataframe
+            # Search Reddit for this search term
             try:
-                subreddit_df = pd.read_csv(os.path.join(self.posts_file_path, history_file))
-                seen_submission_ids = set(subreddit_df['id'])
 
-                # check if history columns match expected
-                if (len(subreddit_df.columns) != len(self.df_columns)) or \
-                            ((subreddit_df.columns == self.df_columns).any() == False):
+                # Manage API call rate for the first listing page
+                await self.__manage_api_call_rate()
 
-                    # Log submission processing
-                    msg = ("History file appears corrupted")
-                    self.__log_event(msg_id=1, screen_print=True, event='processing error', error_msg=msg)
+                submission_count = 0
+                async for submission in subreddit.search(query, **search_kwargs):
 
-                    raise RuntimeError(msg)
+                    # Manage API call rate for each further listing page
+                    submission_count += 1
+                    if submission_count % self.listing_page_size == 1 and submission_count > 1:
+                        await self.__manage_api_call_rate()
 
-            except FileNotFoundError:
-                # Create a new dataframe
-                subreddit_df = None
-                seen_submission_ids = set()
+                    if self.incremental_search:
 
-            # Manage API call rate
-            self.__manage_api_call_rate()
+                        # Keep track of the newest post
+                        if newest_submission is None or submission.created_utc > newest_submission.created_utc:
+                            newest_submission = submission
 
-            try:
+                        # Stop once the search gets back to posts older than the high-water mark
+                        if mark_created_utc is not None and submission.created_utc < mark_created_utc:
 
-                # async for submission in subreddit.new(limit=self.limit_num):
-                async for submission in subreddit.new(limit=self.new_limit_num):
+                            # Log early stop
+                            self.__log_event(msg_id=1, screen_print=False, event='search reached high-water mark',
+                                             search_term=query, submission_count=submission_count,
+                                             logfile_stub=subreddit_name)
 
-                    # Manage API call rate
-                    self.__manage_api_call_rate()
+                            break
 
                     # Check if we already have this submission in the dataset
                     if submission.id in seen_submission_ids:
 
                         # Log submission found
-                        self.__log_event(msg_id=1, screen_print=False, event='submission ID found', id=submission.id)
+                        self.__log_event(msg_id=1, screen_print=False, event='submission ID found', id=submission.id,
+                                         logfile_stub=subreddit_name)
+
+                        # Stop once only already seen posts are coming back
+                        if self.incremental_search:
+                            seen_run += 1
+                            if seen_run >= self.seen_run_limit:
+
+                                # Log early stop
+                                self.__log_event(msg_id=1, screen_print=False, event='search reached seen posts',
+                                                 search_term=query, submission_count=submission_count,
+                                                 logfile_stub=subreddit_name)
+
+                                break
 
                         continue
 
-                    # Log submission processing
-                    self.__log_event(msg_id=1, screen_print=False, event='submission processing', id=submission.id)
+                    # Reset the run of seen posts
+                    if self.incremental_search:
+                        seen_run = 0
 
-                    # Load data for this submission id
-                    await submission.load()
+                    # Claim this submission before awaiting so concurrent searches skip it
                     seen_submission_ids.add(submission.id)
 
-                    # Manage API call rate
-                    self.__manage_api_call_rate()
+                    # Log submission processing
+                    self.__log_event(msg_id=1, screen_print=False, event='submission processing', id=submission.id,
+                                     logfile_stub=subreddit_name)
+
+                    # Add this to the list of new submissions
+                    new_submissions.append(submission)
+
+                # Build the rows of all new submissions from the listing payloads
+                term_data = await self.__extract_submission_rows(submissions=new_submissions,
+                                                                 search_term=None)
+
+                # Attribute each submission to the search terms it matches
+                for sub_dict in term_data:
+                    sub_dict["search_term"] = self.__match_search_terms(text="{} {}".format(sub_dict["title"],
+                                                                                            sub_dict["selftext"]),
+                                                                        terms=query_terms,
+                                                                        matcher=term_matcher)
+
+                    # Log submissions matching none of the query's terms
+                    if sub_dict["search_term"] == self.unmatched_search_term:
+                        self.__log_event(msg_id=1, screen_print=False, event='no search term matched',
+                                         id=sub_dict["id"], search_term=query, logfile_stub=subreddit_name)
+
+                # Keep the newest post found as the search's high-water mark - it is saved
+                # once the new posts are in the history store
+                if self.incremental_search and newest_submission is not None:
+                    self.pending_high_water_marks[mark_key] = (newest_submission.fullname,
+                                                               newest_submission.created_utc)
 
-                    # Dictionary to hold
-                    sub_dict = {}
+            except Exception as e:
 
-                    # Add submission to dictionary
-                    for col in self.df_columns:
+                # Log exception
+                self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
+                                 exception_info=str(e), query_num=self.rate_limiter.call_count, search_term=query,
+                                 logfile_stub=subreddit_name)
 
-                        if col == "created_at":
-                            sub_dict[col] = datetime.utcfromtimestamp(int(getattr(submission, "created_utc")))
+                raise RuntimeError(e)
 
-                        elif col == "scrape_time":
-                            sub_dict[col] = datetime.now().strftime(self.dtformat)
+        # Add the completed search's new posts to the search buffer
+        self.__buffer_search_results(subreddit_group=subreddit_group,
+                                     query=query,
+                                     term_data=term_data)
 
-                        elif col == "search_term":
-                            # Collect data for this search term --- Since new posts fetch set to all_new_posts
-                            sub_dict[col] = "all_new_posts"
+        # Stream the new posts to the scoring queue
+        if self.row_queue is not None and len(term_data) > 0:
+            await self.row_queue.put(term_data)
 
-                        else:
-                            sub_dict[col] = getattr(submission, col)
 
-                    # Add this to the list of dictionaries
-                    subreddit_data.append(sub_dict)
+    async def fetch_new_data(self):
 
-            except Exception as e:
+        '''
+        Function for retrieving Reddit data using the new method.
 
-                # Log exception
-                self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
-                                 exception_info=str(e), query_num=len(self.api_call_times), subreddit=subreddit_name)
+        The newest post fetched from each subreddit is saved as the subreddit's high-water
+        mark.  Later fetches page forward from that mark with Reddit's before cursor, so
+        they only request posts created since the previous fetch, however many there are.
+        The first fetch of a subreddit takes the latest new_limit_num posts.
 
-                raise RuntimeError(e)
+        Each finished subreddit is checkpointed, so a fetch started after a failure skips
+        the subreddits that were already done.
+
+        This function needs to be called with await
+        # df = await test.fetch_data()
+
+        '''
+
+        # Get subreddit names
+        self.__get_subreddit_names()
+
+        # Load the checkpoint of an unfinished new posts fetch, if any
+        self.__open_checkpoint(fetch_type="new")
+
+        # Open the history store and get the submissions already fetched
+        self.__open_history_store()
+        seen_submission_ids = self.seen_submission_ids
+
+        # Stream the posts saved before the interruption to the scoring queue
+        await self.__stream_restored_posts()
+
+        # Initialize a asyncpraw reddit object, with the API rate limiter shared by all its calls
+        reddit = self.__start_api_call_rate()
+
+        try:
+            # Search in each subreddit
+            for subreddit_name in self.subreddit_names:
+
+                # Skip subreddits finished by an earlier, unfinished fetch
+                if subreddit_name in self.checkpoint.completed:
+                    continue
+
+                # Create a subreddit class
+                subreddit = await reddit.subreddit(subreddit_name)
+
+                # Start logger
+                self.__log_event(msg_id=0, screen_print=False, logfile_stub=subreddit_name)
+
+                # Log fetch start
+                self.__log_event(msg_id=1, screen_print=True, event='start fetch', subreddit_name=subreddit_name)
+
+                # List to hold new submissions
+                new_submissions = []
+
+                try:
 
+                    # Get the posts created since the last fetch
+                    submissions = await self.__list_new_submissions(subreddit=subreddit,
+                                                                    subreddit_name=subreddit_name)
 
-            # Construct a new dataframe with history and new posts
-            if len(subreddit_data) > 0:
+                    for submission in submissions:
 
-                # Combine new posts with history
-                if type(subreddit_df) == type(None):
-                    new_data_df = pd.DataFrame(data=subreddit_data)
+                        # Check if we already have this submission in the dataset
+                        if submission.id in seen_submission_ids:
+
+                            # Log submission found
+                            self.__log_event(msg_id=1, screen_print=False, event='submission ID found', id=submission.id)
+
+                            continue
+
+                        # Log submission processing
+                        self.__log_event(msg_id=1, screen_print=False, event='submission processing', id=submission.id)
+
+                        seen_submission_ids.add(submission.id)
+
+                        # Add this to the list of new submissions
+                        new_submissions.append(submission)
 
-                else:
-                    new_data_df = pd.concat(objs=[subreddit_df, pd.DataFrame(data=subreddit_data)])
+                    # Build the rows of all new submissions from the listing payloads
+                    # Collect data for this search term --- Since new posts fetch set to all_new_posts
+                    subreddit_data = await self.__extract_submission_rows(submissions=new_submissions,
+                                                                          search_term="all_new_posts")
 
-                # Drop duplicates
-                new_data_df = new_data_df.drop_duplicates(subset=["id"])
+                except Exception as e:
 
-                # Save the file
-                new_data_df.to_csv(path_or_buf=os.path.join(self.posts_file_path, history_file), index=False)
+                    # Log exception
+                    self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
+                                     exception_info=str(e), query_num=self.rate_limiter.call_count, subreddit=subreddit_name)
 
-                # Log file update
-                self.__log_event(msg_id=1, screen_print=False, event='saving final data', new_row_count=len(subreddit_data))
+                    raise RuntimeError(e)
 
-            else:
-                self.__log_event(msg_id=1, screen_print=False, event='no new post results found')
+                # Append the new posts to the history store
+                self.__save_subreddit_posts(subreddit_name=subreddit_name,
+                                            subreddit_data=subreddit_data,
+                                            logfile_stub=subreddit_name)
 
+                # Now the posts are saved, move the subreddit's high-water mark to the newest post
+                if len(submissions) > 0:
+                    self.fetch_state.set_high_water_mark(key="new|{}".format(subreddit_name),
+                                                         post_id=submissions[0].fullname,
+                                                         created_utc=submissions[0].created_utc)
 
-        # Write the combined file
-        self.__concat_posts_files()
+                # Checkpoint the finished subreddit
+                self.checkpoint.completed.add(subreddit_name)
+                self.checkpoint.save()
+
+                # Stream the new posts to the scoring queue
+                if self.row_queue is not None and len(subreddit_data) > 0:
+                    await self.row_queue.put(subreddit_data)
+
+        finally:
+            # Close reddit object
+            await reddit.close()
+
+        # Write the file of new posts
+        self.__write_new_posts_file()
+
+        # The fetch is finished - no need to resume it
+        self.checkpoint.clear()
 
         # Log file update - finished fetch
-        self.__log_event(msg_id=1, screen_print=True, event='fetch complete')
+        self.__log_event(msg_id=1, screen_print=True, event='fetch complete', logfile_stub=self.store_logfile_stub)
 
         # Close logging
         self.__log_event(msg_id=-1, screen_print=False)
 
-        # Close reddit object
-        await reddit.close()
 
+    async def __list_new_submissions(self,
+                                     subreddit,
+                                     subreddit_name):
+        '''
+        Method to list the posts created in a subreddit since its high-water mark, newest first.
+
+        A single post probe first checks if anything is newer than the mark.  If so, pages
+        of listing_page_size posts are requested with the before cursor, each page starting
+        from the newest post of the page before, until a partial page comes back.  If the
+        marked post has been removed Reddit returns nothing before it, in which case the
+        latest new_limit_num posts newer than the mark's creation time are used.
+
+        Inputs:
+            subreddit: asyncpraw.models.Subreddit
+                Subreddit to list
+            subreddit_name: str
+                Name of the subreddit
+
+        Output:
+            List of submissions, newest first
+
+        '''
+
+        mark_fullname, mark_created_utc = self.fetch_state.get_high_water_mark(key="new|{}".format(subreddit_name))
+
+        # No mark yet - take the latest posts
+        if mark_fullname is None:
+            return await self.__get_new_page(subreddit=subreddit, limit=self.new_limit_num)
+
+        # Check if anything has been posted since the mark
+        newest = await self.__get_new_page(subreddit=subreddit, limit=1)
+        if len(newest) == 0 or newest[0].fullname == mark_fullname:
+            return []
+
+        # Page forward from the mark
+        submissions = []
+        cursor = mark_fullname
+        while True:
+            page = await self.__get_new_page(subreddit=subreddit,
+                                             limit=self.listing_page_size,
+                                             params={"before": cursor})
+
+            # Pages come newest first, and each page is newer than the last
+            submissions = page + submissions
+
+            if len(page) < self.listing_page_size:
+                break
+
+            cursor = page[0].fullname
+
+        # The marked post is gone - fall back to filtering the latest posts by time
+        if len(submissions) == 0:
+
+            # Log stale mark
+            self.__log_event(msg_id=1, screen_print=False, event='high-water mark not found',
+                             mark=mark_fullname, subreddit=subreddit_name)
+
+            page = await self.__get_new_page(subreddit=subreddit, limit=self.new_limit_num)
+            submissions = [submission for submission in page if submission.created_utc >= mark_created_utc]
+
+        # Log posts found
+        self.__log_event(msg_id=1, screen_print=False, event='new posts since high-water mark',
+                         mark=mark_fullname, post_count=len(submissions))
+
+        return submissions
+
+
+    async def __get_new_page(self,
+                             subreddit,
+                             limit,
+                             params=None):
+        '''
+        Method to request posts from a subreddit's new listing.
+
+        Inputs:
+            subreddit: asyncpraw.models.Subreddit
+                Subreddit to list
+            limit: int
+                Maximum number of posts to return
+            params: dict
+                Extra listing parameters (e.g. the before cursor)
+
+        Output:
+            List of submissions, newest first
 
-    def __concat_posts_files(self):
         '''
-        Method to concatenate the posts into a single dataframe and file.
 
+        # Manage API call rate for each listing page needed
+        for _ in range(max(1, -(-limit // self.listing_page_size))):
+            await self.__manage_api_call_rate()
+
+        return [submission async for submission in subreddit.new(limit=limit, params=dict(params or {}))]
+
+
+    async def __extract_submission_rows(self,
+                                        submissions,
+                                        search_term):
         '''
+        Method to build dictionaries of df_columns values for a list of submissions.
+
+        Search and new listings already carry every attribute kept in df_columns, so the
+        rows are built straight from the listing payloads.  A submission is only loaded
+        (costing an extra API call) if the listing left one of those attributes out.
+
+        The attributes are gathered into one column per attribute, creation times are
+        converted for the whole column at once and every row gets the same scrape time.
+
+        Inputs:
+            submissions: list
+                Submissions (asyncpraw.models.Submission) returned by a listing
+            search_term: str
+                Value to record in the search_term column
+
+        Output:
+            List of dictionaries of column values
+
+        '''
+
+        if len(submissions) == 0:
+            return []
+
+        # Submission attributes needed to fill df_columns
+        needed_attributes = ["created_utc"] + [col for col in self.df_columns
+                                               if col not in ("created_at", "scrape_time", "search_term")]
 
-        # Name the file containing the combined reddit output
-        combined_file_stub = "reddit_posts"
-        combined_file_name = "{}.csv".format(combined_file_stub)
+        # Load the full submission only if the listing payload is missing something
+        for submission in submissions:
+            submission_attributes = vars(submission)
+            if any(attribute not in submission_attributes for attribute in needed_attributes):
 
-        # Log beginning file concatenation process
-        self.__log_event(msg_id=0, screen_print=False, event='starting concatenation process',
-                         logfile_stub=combined_file_stub)
+                # Manage API call rate
+                await self.__manage_api_call_rate()
+
+                # Load data for this submission id
+                await submission.load()
+
+        # Gather the submission attributes into columns
+        columns = dict(zip(needed_attributes, zip(*map(attrgetter(*needed_attributes), submissions))))
+
+        # Convert creation times (UTC seconds, truncated) in one step
+        created_utc = np.array(columns["created_utc"], dtype=np.float64).astype(np.int64)
+        columns["created_at"] = pd.to_datetime(created_utc, unit="s").to_pydatetime()
+
+        # One scrape time for the list
+        columns["scrape_time"] = [datetime.now().strftime(self.dtformat)] * len(submissions)
+
+        columns["search_term"] = [search_term] * len(submissions)
+
+        # Build the rows
+        return [dict(zip(self.df_columns, values)) for values in zip(*[columns[col] for col in self.df_columns])]
+
+
+    def __open_checkpoint(self,
+                          fetch_type):
+        '''
+        Method to set up the checkpoint of a fetch, loading the checkpoint of an unfinished
+        fetch of the same type if there is a recent one.
+
+        Input:
+            fetch_type: str
+                Type of fetch (search or new)
 
-        dfs = []
+        '''
+
+        self.checkpoint = cp.FetchCheckpoint(checkpoint_file=os.path.join(self.store_file_path,
+                                                                          self.checkpoint_file_name.format(fetch_type)),
+                                             max_age=self.checkpoint_max_age)
+        self.checkpoint.load()
+
+
+    def __open_history_store(self):
+        '''
+        Method to open the history store for a fetch.  Any subreddit not yet in the store
+        has its previous {subreddit}_posts_data.csv history file imported, then the index
+        of fetched submission IDs is opened so fetches can skip them, along with the
+        high-water marks left by earlier fetches.
+
+        '''
+
+        # Time stamp and run ID for the rows added by this fetch (kept from the original run when resuming)
+        self.run_start = self.checkpoint.run_start
+        self.run_id = self.checkpoint.run_id
+
+        # Start the logger for store events - named after the new posts file
+        self.store_logfile_stub = os.path.splitext(self.new_posts_file_name)[0]
+        self.__log_event(msg_id=0, screen_print=False, logfile_stub=self.store_logfile_stub)
+
+        # Log resumed fetch
+        if self.checkpoint.resumed:
+            self.__log_event(msg_id=1, screen_print=True, event='resuming unfinished fetch',
+                             run_start=self.run_start, run_id=self.run_id, completed=len(self.checkpoint.completed),
+                             logfile_stub=self.store_logfile_stub)
+
+        # Open the store
+        self.history_store = hs.HistoryStore(db_file=os.path.join(self.store_file_path, self.store_file_name),
+                                             columns=self.df_columns,
+                                             key_col="id")
+
+        # Import any previous history files
+        imported_ids = []
         for subreddit_name in self.subreddit_names:
 
+            # Skip subreddits already in the store
+            if self.history_store.has_partition(partition=subreddit_name):
+                continue
+
             # Get the name of the history file
             history_file = f'{subreddit_name}_posts_data.csv'
 
             try:
                 # read the file
-                df = pd.read_csv(filepath_or_buffer=os.path.join(self.posts_file_path, history_file))
+                subreddit_df = pd.read_csv(os.path.join(self.posts_file_path, history_file))
+
+                # check if history columns match expected
+                if (len(subreddit_df.columns) != len(self.df_columns)) or \
+                            ((subreddit_df.columns == self.df_columns).any() == False):
+
+                    # Log submission processing
+                    msg = ("History file appears corrupted")
+                    self.__log_event(msg_id=1, screen_print=True, event='processing error', error_msg=msg,
+                                     file_name=history_file, logfile_stub=self.store_logfile_stub)
+
+                    raise RuntimeError(msg)
+
+                # Imported history predates every fetch so it is never part of a fetch's new posts
+                row_count = self.history_store.append(partition=subreddit_name,
+                                                      rows=subreddit_df,
+                                                      inserted_at="1970-01-01 00:00:00")
+                imported_ids.extend(subreddit_df['id'].tolist())
+
+                # Log successful file import
+                self.__log_event(msg_id=1, screen_print=False, event='history file imported',
+                                 file_name=history_file, row_count=row_count, logfile_stub=self.store_logfile_stub)
+
+            except FileNotFoundError:
+                pass
+
+            self.history_store.add_partition(partition=subreddit_name)
+
+        # Index of submission IDs already fetched
+        self.seen_submission_ids = si.SeenIdIndex(db_file=os.path.join(self.store_file_path,
+                                                                       self.seen_index_file_name),
+                                                  source="reddit",
+                                                  id_base=36)
+
+        # Build the index from the store the first time it is used, otherwise just add imported history
+        if self.seen_submission_ids.is_empty():
+            self.seen_submission_ids.persist(self.history_store.ids())
+
+        elif len(imported_ids) > 0:
+            self.seen_submission_ids.persist(imported_ids)
+
+        # High-water marks of earlier fetches, and those waiting for their posts to be saved
+        self.fetch_state = fs.FetchState(db_file=os.path.join(self.store_file_path, self.fetch_state_file_name),
+                                         source="reddit")
+        self.pending_high_water_marks = {}
+
 
-                # Add to list
-                dfs.append(df)
+    async def __stream_restored_posts(self):
+        '''
+        Method to put the posts saved to the history store by the interrupted fetch being
+        resumed on the scoring queue (when streaming).  The scorer only saw the posts
+        streamed before the interruption - any it already scored keep their scores.
+
+        '''
+
+        if self.row_queue is None or not self.checkpoint.resumed:
+            return
+
+        # Read the interrupted fetch's rows from the store
+        df = self.history_store.read(run_id=self.run_id)
+
+        if len(df) > 0:
+            await self.row_queue.put(df.to_dict("records"))
 
-                # Log successful file read
-                self.__log_event(msg_id=1, screen_print=False, event='successful history file read',
-                                 file_name=history_file)
+            # Log restored posts
+            self.__log_event(msg_id=1, screen_print=False, event='restored posts streamed',
+                             row_count=len(df), logfile_stub=self.store_logfile_stub)
 
-            except:
 
-                # Log unsuccessful file read
-                self.__log_event(msg_id=1, screen_print=False, event='unsuccessful history file read',
-                                 file_name=history_file)
+    def __save_subreddit_posts(self,
+                               subreddit_name,
+                               subreddit_data,
+                               logfile_stub):
+        '''
+        Method to append a subreddit's new posts to the history store.
+
+        Inputs:
+            subreddit_name: str
+                Name of the subreddit (the store partition)
+            subreddit_data: list
+                List of dictionaries of new posts
+            logfile_stub: str
+                Log file receiving the log messages
+
+        '''
+
+        if len(subreddit_data) > 0:
 
-        # Concatenate
-        df = pd.concat(objs=dfs)
-        df = df.reset_index(drop=True)
+            # Append the new posts - posts already stored are skipped
+            new_row_count = self.history_store.append(partition=subreddit_name,
+                                                      rows=subreddit_data,
+                                                      inserted_at=self.run_start,
+                                                      run_id=self.run_id)
+
+            # Record the saved submissions in the index of fetched IDs
+            self.seen_submission_ids.persist([sub_dict["id"] for sub_dict in subreddit_data])
+
+            # Log file update
+            self.__log_event(msg_id=1, screen_print=False, event='saving final data', subreddit_name=subreddit_name,
+                             new_row_count=new_row_count, logfile_stub=logfile_stub)
+
+        else:
+            self.__log_event(msg_id=1, screen_print=False, event='no new post results found',
+                             subreddit_name=subreddit_name, logfile_stub=logfile_stub)
+
+
+    def __write_new_posts_file(self):
+        '''
+        Method to write the posts added by this fetch to the new posts file (the input of
+        the Reddit scorer).  Only the new rows are read back from the history store, so the
+        cost of this step grows with new data rather than with the full history.
+
+        '''
+
+        # Log beginning file write process
+        self.__log_event(msg_id=1, screen_print=False, event='starting new posts file write',
+                         logfile_stub=self.store_logfile_stub)
+
+        # Read this fetch's rows from the store
+        df = self.history_store.read(run_id=self.run_id)
 
         # Drop duplicates
         df = df.drop_duplicates(subset=self.dup_cols)
 
-        # Write combined file
-        df.to_csv(path_or_buf=os.path.join(self.posts_file_path, combined_file_name),
+        # Write new posts file
+        df.to_csv(path_or_buf=os.path.join(self.posts_file_path, self.new_posts_file_name),
                   index=False)
 
         # Log successful file save
-        self.__log_event(msg_id=1, screen_print=False, event='successful history file save',
-                         file_name=combined_file_name)
+        self.__log_event(msg_id=1, screen_print=False, event='successful new posts file save',
+                         file_name=self.new_posts_file_name, row_count=len(df), logfile_stub=self.store_logfile_stub)
+
+        # Close the store, index and state
+        self.history_store.close()
+        self.seen_submission_ids.close()
+        self.fetch_state.close()
+
+
+    def read_history(self,
+                     subreddit_names=None):
+        '''
+        Method to read the combined history of fetched posts from the history store.
+
+        Input:
+            subreddit_names: list
+                Subreddits to read (defaults to all)
+
+        Output:
+            pandas dataframe with the df_columns of every stored post
+
+        '''
+
+        store = hs.HistoryStore(db_file=os.path.join(self.store_file_path, self.store_file_name),
+                                columns=self.df_columns,
+                                key_col="id")
+        df = store.read(partitions=subreddit_names)
+        store.close()
+
+        return df
 
 
     def __clean_keyword_text(self,
@@ -555,28 +1456,21 @@ class GVCEHReddit():
 
         '''
 
-        # Remove these words from search terms
-        stop_words = ['stop', 'the', 'to', 'and', 'a', 'in', 'it',
-                      'is', 'I', 'i', 'that', 'had', 'on', 'for', 'were', 'was',
-                      'through', 'of', 'way', 'end', 'our', 'place', 'home',
-                      'support', 'city', 'visitor', 'women', 'men', 'need', 'idea',
-                      'north', 'south', 'east', 'west', 'ready', 'save', 'salt', 'win',
-                      'lose', 'loss', 'family', 'working', 'hope', 'love', 'house']
+        # Leave missing values for the caller to drop
+        if not isinstance(text, str):
+            return text
 
-        # Remove unwanted characters
-        pat = r"\\n|r/|[^a-zA-Z0-9 ]"
-        text = re.sub(pat, '', text)
+        # Replace unwanted characters with a space, so words joined by punctuation stay apart
+        text = self.unwanted_char_pattern.sub(' ', text)
 
         # cohvert to lowercase
         text = text.strip().lower()
 
         # Remove stop words
-        pat = "|".join(["\\b{}\\b".format(w) for w in stop_words])
-        text = re.sub(pat, ' ', text)
+        text = self.stop_word_pattern.sub(' ', text)
 
         # remove extra spaces
-        pat = r"\s{2,}"
-        text = re.sub(pat, ' ', text)
+        text = self.extra_space_pattern.sub(' ', text)
 
         # Remove leading and trailing spaces
         text = text.strip()
@@ -584,54 +1478,79 @@ class GVCEHReddit():
         return text
 
 
-    def __manage_api_call_rate(self):
+    def __start_api_call_rate(self):
         '''
-        Method to pause fetch methods from calling the Reddit API to avoid rate limit exceptions.
-        Pauses are only needed if the program has made too many API calls within a specified window.
-        However. this method should be called after each API call since it also provides the
-        check determining if a pause is needed.
+        Method to set up the API rate limiter for a fetch and the reddit object whose
+        calls it manages.  The limiter starts with the api_call_limit budget and is synced
+        with the rate limit headers of Reddit's responses, passed on by RateHeaderRequestor.
 
-        Key class parameters:
-            self.api_call_limit: The maximum number of API calls during a specified time window
-            self.rate_limit_window: The time window over which API calls are counted
-            self.api_call_times = deque(): A doubly ended queue store of timestamps for all API calls
-            self.pause_indexes = deque(): A doubly ended queue store of timestamps indexes at which API fetching
-                    was paused
+        Output:
+            asyncpraw.Reddit object
 
         '''
 
-        # Record the time this method was called which should correspond with an API call time
-        self.api_call_times.append(datetime.now())
+        # Token bucket shared by every task using this reddit object
+        self.rate_limiter = rl.AsyncRateLimiter(call_limit=self.api_call_limit,
+                                                window_seconds=self.rate_limit_window.total_seconds())
 
-        # Check rate limit - if equal to a multiple of the rate limit then we need to pause
-        if len(self.api_call_times) >= self.api_call_limit * (len(self.pause_indexes) + 1):
+        # Rate limit state from the headers of the last response (None until the first response)
+        self.server_rate_state = None
+        self.server_response_count = 0
+        self.server_rate_warned = False
 
-            # Add this pause to the indexes of pauses
-            self.pause_indexes.append(len(self.api_call_times) - 1)
+        return asyncpraw.Reddit(client_id=self.client_id,
+                                client_secret=self.client_secret,
+                                user_agent=self.user_agent,
+                                requestor_class=RateHeaderRequestor,
+                                requestor_kwargs={"rate_header_callback": self.__record_rate_headers})
 
-            # If this is the first pause wait until time uses first API entry
-            if len(self.pause_indexes) == 0:
 
-                wait_until = self.api_call_times[0] + self.rate_limit_window
+    def __record_rate_headers(self,
+                              remaining,
+                              used,
+                              reset_seconds):
+        '''
+        Method to keep the rate limit headers of a Reddit response, with the time they were received
+        '''
 
-            # otherwise use the time of the last pause
-            else:
-                wait_until = self.api_call_times[self.pause_indexes[-1]] + self.rate_limit_window
+        self.server_response_count += 1
+        self.server_rate_state = (remaining, used, reset_seconds, time.time(), self.server_response_count)
 
-            # Now wait by pausing the API
-            wait_time = (wait_until - datetime.now()).total_seconds()
 
-            #  Log the pause
-            self.__log_event(msg_id=1, screen_print=True, event='rate limit reached',
-                             wait_time_sec=wait_time, api_call_count=len(self.api_call_times))
+    async def __manage_api_call_rate(self):
+        '''
+        Method to pause fetch methods from calling the Reddit API to avoid rate limit exceptions.
+        This method should be awaited before each API call.  It only waits when the call budget
+        is used up, and it does so with asyncio so other fetch tasks keep running.
 
-            time.sleep(wait_time)
+        Key class parameters:
+            self.rate_limiter: Token bucket shared by all API calls
+            self.server_rate_state: Rate limit state reported in Reddit's response headers
 
-        else:
+        '''
 
-            # Even if we're not at limit's wait a short time
-            wait_time = self.api_sleep_time
-            time.sleep(wait_time)
+        # Sync with the remaining calls and reset time reported by Reddit for the last response -
+        # each response is only synced once
+        if self.server_rate_state is not None:
+            remaining, used, reset_seconds, received_at, response_num = self.server_rate_state
+            self.rate_limiter.sync_with_server(remaining=remaining,
+                                               reset_seconds=reset_seconds - (time.time() - received_at),
+                                               response_id=response_num)
+
+        # Warn if Reddit's responses carry no rate limit headers - only the api_call_limit budget applies
+        elif self.rate_limiter.call_count > 2 * self.fetch_concurrency and not self.server_rate_warned:
+            self.server_rate_warned = True
+            self.__log_event(msg_id=1, screen_print=True, event='rate limit headers not available',
+                             api_call_limit=self.api_call_limit, api_call_count=self.rate_limiter.call_count)
+
+        # Wait for budget if needed
+        wait_time = await self.rate_limiter.acquire()
+
+        if wait_time > 0:
+
+            #  Log the pause
+            self.__log_event(msg_id=1, screen_print=True, event='rate limit reached',
+                             wait_time_sec=wait_time, api_call_count=self.rate_limiter.call_count)
 
 
     def __log_event(self,
@@ -654,6 +1573,8 @@ class GVCEHReddit():
                 A dictionary of terms to include in the message
                 Note that if msg_id = 0 - kwargs is expected to have a
                 logfile_stub entry - kwargs['logfile_stub'] = 'victoria'
+                If msg_id = 1 - an optional logfile_stub entry selects which log file
+                receives the message (defaults to the most recently opened log)
 
         '''
 
@@ -663,33 +1584,46 @@ class GVCEHReddit():
         # msg_id = -1 - Close logger
         if self.fetch_logging and msg_id == -1:
 
-            # Close any open logs
-            logging.shutdown()
+            # Close any open log files
+            for logger in self.loggers.values():
+                for handler in logger.handlers[:]:
+                    handler.close()
+                    logger.removeHandler(handler)
+            self.loggers = {}
 
         # msg_id = 0 - Set up the logger
         if self.fetch_logging and msg_id == 0:
 
-            # Close any open logs
-            logging.shutdown()
-
             # Name a new log file
             log_file = f"{kwargs['logfile_stub']}_logfile.log"
 
+            # Each log file gets its own named logger so that concurrent subreddit
+            # fetches do not reconfigure each other's logs
+            logger = logging.getLogger("gvceh.reddit.{}".format(kwargs['logfile_stub']))
+            for handler in logger.handlers[:]:
+                handler.close()
+                logger.removeHandler(handler)
+
             # Configure the logging system
             # print('log_path: {}'.format(self.logs_file_path))
             # print('log_file_path: {}'.format(os.path.join(self.logs_file_path, log_file)))
-            logging.basicConfig(filename=os.path.join(self.logs_file_path, log_file),
-                                filemode='w',
-                                format='%(levelname)s - %(message)s',
-                                level=logging.INFO,
-                                force=True)
+            handler = logging.FileHandler(filename=os.path.join(self.logs_file_path, log_file),
+                                          mode='w')
+            handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
 
-            # Create a logger
-            self.logger = logging.getLogger()
+            # Keep the logger and make it the default for messages without a logfile_stub
+            self.loggers[kwargs['logfile_stub']] = logger
+            self.logger = logger
 
         # msg_id = 1 - Data fetch start
         elif self.fetch_logging and msg_id == 1:
 
+            # Route the message to the logger for this log file stub, if given
+            logger = self.loggers.get(kwargs.pop('logfile_stub', None), self.logger)
+
             # Create a message using terms in the kwargs
             log_msg = ": ".join(["{}: {}".format(k, kwargs[k]) for k in kwargs.keys()])
 
@@ -697,5 +1631,4 @@ class GVCEHReddit():
             log_msg = "time: {}: {}".format(current_time, log_msg)
             if screen_print:
                 print(log_msg)
-            self.logger.info(msg=log_msg)
-
+            logger.info(msg=log_msg)
@@ -1,28 +1,27 @@
 # Class to score Reddit posts for relevance and sentiment
 import os, sys
-import json
 
 import pandas as pd
+import numpy as np
 
 from datetime import datetime
+import time
 
 # Logging and monitoring
 import logging
 
-from transformers import pipeline
-import joblib
-# from setfit import SetFitModel
-
-from tempfile import TemporaryFile
-
-# GCP
-from google.cloud import storage
-from google.oauth2 import service_account
+# Asynchronous work
+import asyncio
 
 
 # GVCEH objectscl
-sys.path.insert(0, "utils/")
+# Utilities folder, found from this file so the standalone scrapers (run from their own folder) can import it too
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
 import gcp_tools as gt
+import incremental_scores as isc
+import inference_cache as ic
+import model_registry as mr
+import model_server as ms
 
 
 
@@ -40,7 +39,12 @@ class ScorePosts():
 
         relevance_model_path: Path to the location for a locally stored relevance model
         relevance_model1_filename: Filename for the posts relevance model
+        relevance_batch_size: Number of posts passed to the relevance model in each prediction
         sentiment_model_hf_location: Hugging Face location for sentiment model
+        sentiment_batch_size: Number of post segments passed to the sentiment model in each batch
+        model_cache_file_path: Path to the local cache of model files downloaded from GCP storage
+        model_server_url: URL of a running model server (see run_model_server.py) - models are
+                          loaded in this process if blank or the server can't be reached
 
         ggcp_credentials: GCP project credentials used to interface with GCP storage
 
@@ -51,6 +55,19 @@ class ScorePosts():
         update_scores: Boolean indicating if scores should be updated and overwritten (True)
                         or only new scores should be added for not scored posts
 
+        incremental_scoring: Boolean indicating if posts keep their previous scores when neither
+                             their text (text_hash) nor the models (model_version) have changed
+        score_cols: Columns holding the model scores
+
+        use_inference_cache: Boolean indicating if model outputs are cached by text (shared with ScoreTweets)
+        inference_cache_file_path: Path to the inference cache (an SQLite file which must be on local disk)
+        inference_cache_file_name: Name of the inference cache file
+        inference_cache_max_entries: Number of model outputs kept in the inference cache
+
+        streaming: Boolean indicating if posts are scored in micro-batches as they are fetched
+                   (see score_stream) instead of all at once from the new posts file
+        micro_batch_size: Number of posts scored together in streaming mode
+
         fetch_logging: Boolean to turn logging on and off
         dtformat: String format for time values
 
@@ -67,7 +84,11 @@ class ScorePosts():
     # Model parameters
     relevance_model_path = "../data/models"
     relevance_model1_filename = "reddit-setfit-model.joblib"
+    relevance_batch_size = 32
     sentiment_model_hf_location = "cardiffnlp/twitter-roberta-base-sentiment-latest"
+    sentiment_batch_size = 32
+    model_cache_file_path = "../data/models/cache"
+    model_server_url = ""
 
     # Dup columns
     dup_cols = ["id", "title", "selftext"]
@@ -78,6 +99,20 @@ class ScorePosts():
     # Flag indicating if old scores should be overwritten
     update_scores = True
 
+    # Only score posts whose text or models have changed
+    incremental_scoring = True
+    score_cols = ["is_relevant", "sentiment", "sentiment_score"]
+
+    # Cache of model outputs
+    use_inference_cache = True
+    inference_cache_file_path = "../data/store"
+    inference_cache_file_name = "inference_cache.db"
+    inference_cache_max_entries = 500000
+
+    # Streaming mode
+    streaming = False
+    micro_batch_size = 64
+
     # Logging flag
     score_logging = True
 
@@ -87,10 +122,12 @@ class ScorePosts():
     def __init__(self,
                  update_scores=False,
                  score_logging=True,
+                 streaming=False,
                  **kwargs
                  ):
         '''
-        Initialize the ScoreTweets class.
+        Initialize the ScoreTweets class.  Unless streaming, all of the new posts are
+        scored and saved straight away.
         '''
 
         # Update any key word args
@@ -103,24 +140,47 @@ class ScorePosts():
         if score_logging != True:
             self.score_logging = False
 
+        # Open the cache of model outputs
+        self.inference_cache = None
+        if self.use_inference_cache:
+            self.inference_cache = ic.InferenceCache(db_file=os.path.join(self.inference_cache_file_path,
+                                                                          self.inference_cache_file_name),
+                                                     max_entries=self.inference_cache_max_entries)
+
         # Start logger
         self.__log_event(msg_id=0, screen_print=False, logfile_stub='reddit_scorer')
 
         # Log score start
-        self.__log_event(msg_id=1, screen_print=True, event='start score', source='reddit')
+        self.__log_event(msg_id=1, screen_print=True, event='start score', source='reddit', streaming=streaming)
+
+        # Set up the models - run on the model server if there is one, otherwise loaded on
+        # first use (once per process)
+        self.__connect_models()
+
+        # In streaming mode posts are scored by score_stream - only new posts are scored
+        if streaming:
+            self.streaming = True
+            self.update_scores = False
+            self.scored_batches = []
+
+            # Previously scored posts, to reuse their scores
+            if self.incremental_scoring:
+                self.__read_scored_file()
+
+            return
 
         # Read tweet data
         self.read_posts_file()
 
-        # Score for relevance
-        self.score_relevance()
-
-        # Score for sentiment
-        self.sentiment_model()
+        # Score for relevance and sentiment
+        self.__score_changed_posts()
 
         # Score for relevance
         self.write_posts_file()
 
+        # Close the cache of model outputs
+        self.__close_inference_cache()
+
         # Close logging
         self.__log_event(msg_id=-1, screen_print=False)
 
@@ -131,41 +191,122 @@ class ScorePosts():
         '''
 
         # Log relevance score start
-        self.__log_event(msg_id=1, screen_print=True, event='start relevance scoring', source='reddit')
-
-        # create the model
-        prefix = "gs://"
-        # If on GCP need some code to open the file
-        if self.relevance_model_path.find(prefix) >= 0:
-
-            # Get bucket name and model_bucket from model path
-            prefix_len = len(prefix)
-            bucket_name = self.relevance_model_path[prefix_len: self.relevance_model_path[5:].find("/") + prefix_len]
-            model_bucket = self.relevance_model_path[prefix_len:]
-            model_bucket = "{}/{}".format(model_bucket[model_bucket.find("/") + 1:],
-                                          self.relevance_model1_filename)
-
-            # # Set up GCP storage client
-            json_acct_info = json.loads(self.gcp_credentials)
-            credentials = service_account.Credentials.from_service_account_info(json_acct_info)
-            storage_client = storage.Client(credentials=credentials, project=json_acct_info["project_id"])
-
-            # Create GCP buckets
-            bucket = storage_client.get_bucket(bucket_name)
-            blob = bucket.blob(model_bucket)
-
-            # Download model to temporary file
-            with TemporaryFile() as temp_file:
-                # download blob into temp file
-                blob.download_to_file(temp_file)
-                temp_file.seek(0)
-                # load into joblib
-                model1 = joblib.load(temp_file)
-
-        # Otherwise we can load locally
-        else:
-            model1 = joblib.load(os.path.join(self.relevance_model_path,
-                                              self.relevance_model1_filename))
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='start relevance scoring', source='reddit')
+
+        # Combined title and text into a single column
+        self.__add_model_text()
+
+        # Put the text columns into a list
+        all_text = self.df_new['titletext'].tolist()
+
+        # Predict for posts not in the cache - cached predictions are kept per model version
+        self.__get_model_version()
+        predictions = self.__cached_predict(model="relevance|{}".format(self.model_versions["relevance"]),
+                                            texts=all_text,
+                                            predict_fn=self.__predict_relevance)
+
+        # add a is_relevant column
+        self.df_new['is_relevant'] = predictions
+
+        # Log relevance score completion
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='relevance scoring completed', source='reddit')
+
+
+    def __predict_relevance(self,
+                            all_text):
+        '''
+        Method to predict relevance for a list of texts in batches
+
+        Output:
+            List of predictions in the order of the texts
+
+        '''
+
+        # List to hold predictions
+        predictions = [None] * len(all_text)
+
+        # Sort posts by length so each batch holds posts of similar length (less padding)
+        post_order = sorted(range(len(all_text)), key=lambda i: len(all_text[i]))
+
+        for batch_start in range(0, len(post_order), self.relevance_batch_size):
+            batch_index = post_order[batch_start: batch_start + self.relevance_batch_size]
+
+            # Predict for the batch of posts
+            batch_start_time = time.perf_counter()
+            batch_predictions = self.__predict_relevance_batch([all_text[i] for i in batch_index])
+            batch_seconds = time.perf_counter() - batch_start_time
+
+            # Put the predictions back in the posts' order
+            for i, prediction in zip(batch_index, batch_predictions):
+                predictions[i] = prediction
+
+            # Log batch throughput
+            self.__log_event(msg_id=1, screen_print=False, event='relevance batch scored', source='reddit',
+                             batch_size=len(batch_index), max_length=len(all_text[batch_index[-1]]),
+                             seconds=round(batch_seconds, 3),
+                             posts_per_second=round(len(batch_index) / max(batch_seconds, 1e-6), 1))
+
+        return predictions
+
+
+    def __predict_relevance_batch(self,
+                                  texts):
+        '''
+        Method to predict relevance for a batch of texts on the model server or with the
+        relevance model loaded in this process
+
+        '''
+
+        if self.model_server is not None:
+            return self.model_server.predict(name="reddit_relevance", texts=texts)
+
+        return self.model_registry.predict_joblib_setfit(model_path=self.relevance_model_path,
+                                                         file_name=self.relevance_model1_filename,
+                                                         texts=texts)
+
+
+    def __cached_predict(self,
+                         model,
+                         texts,
+                         predict_fn):
+        '''
+        Method to get model outputs for a list of texts from the inference cache, only
+        running texts not in the cache through predict_fn
+
+        Output:
+            List of outputs in the order of the texts
+
+        '''
+
+        if self.inference_cache is None:
+            return predict_fn(texts)
+
+        return self.inference_cache.predict(model=model, texts=texts, predict_fn=predict_fn)
+
+
+    def __close_inference_cache(self):
+        '''
+        Method to log the inference cache hits and misses and close the cache
+
+        '''
+
+        if self.inference_cache is None:
+            return
+
+        # Log cache use
+        self.__log_event(msg_id=1, screen_print=False, event='inference cache', source='reddit',
+                         hits=self.inference_cache.hits, misses=self.inference_cache.misses,
+                         evictions=self.inference_cache.evictions)
+
+        self.inference_cache.close()
+        self.inference_cache = None
+
+
+    def __add_model_text(self):
+        '''
+        Method to add the text scored by the models (title and text) to the posts
+
+        '''
 
         # Replace NA values with blanks
         for col in ['selftext', 'title']:
@@ -174,24 +315,95 @@ class ScorePosts():
         # Combined title and text into a single column
         self.df_new['titletext'] = self.df_new['title'] + " " + self.df_new['selftext']
 
-        # Put the text columns into a list
-        all_text = self.df_new['titletext'].tolist()
 
-        # List to hold predictions
-        predictions = []
+    def __get_model_version(self):
+        '''
+        Method to get the version of the relevance and sentiment models saved with each
+        post's scores and used in the inference cache keys.  The relevance model's version
+        is the version (GCS generation or modification time) of its model file and the
+        sentiment model's is its Hugging Face revision.
 
-        for post in all_text:
-            # Predict for each title individually
-            prediction = model1.model.predict([post])
+        '''
 
-            # Assuming prediction is a list with a single element
-            predictions.append(prediction[0].tolist())
+        if self.model_version is None:
 
-        # add a is_relevant column
-        self.df_new['is_relevant'] = predictions
+            # Models run on the model server are the versions it loaded
+            if self.model_server is not None:
+                self.model_versions = {"relevance": self.model_server_versions.get("reddit_relevance"),
+                                       "sentiment": self.model_server_versions.get("sentiment")}
 
-        # Log relevance score completion
-        self.__log_event(msg_id=1, screen_print=True, event='relevance scoring completed', source='reddit')
+            # Otherwise the versions this process loads
+            else:
+                _, relevance_version = self.model_registry.get_model_file(model_path=self.relevance_model_path,
+                                                                          file_name=self.relevance_model1_filename)
+                self.model_versions = {"relevance": "{}@{}".format(self.relevance_model1_filename, relevance_version),
+                                       "sentiment": self.model_registry.get_hf_version(self.sentiment_model_hf_location)}
+
+            self.model_version = "{}|{}".format(self.model_versions["relevance"], self.model_versions["sentiment"])
+
+        return self.model_version
+
+
+    def __connect_models(self):
+        '''
+        Method to set up the model registry and, if model_server_url is set, connect to
+        the model server
+
+        '''
+
+        self.model_registry = mr.ModelRegistry(cache_path=self.model_cache_file_path,
+                                               gcp_credentials=self.gcp_credentials)
+        self.model_version = None
+        self.model_versions = None
+
+        self.model_server = None
+        self.model_server_versions = None
+        if len(self.model_server_url) > 0:
+            self.model_server = ms.ModelServerClient(url=self.model_server_url)
+            self.model_server_versions = self.model_server.get_versions()
+
+            # Fall back to loading the models here
+            if self.model_server_versions is None:
+                self.model_server = None
+
+            # Log model server connection
+            self.__log_event(msg_id=1, screen_print=True, event='model server', source='reddit',
+                             url=self.model_server_url, connected=self.model_server is not None)
+
+
+    def __score_changed_posts(self):
+        '''
+        Method to score posts for relevance and sentiment.  Each post keeps a hash of the
+        text scored and the version of the models.  With incremental_scoring set, only
+        posts without previous scores for the same text hash and model version are run
+        through the models - the rest keep their previous scores.
+
+        '''
+
+        # Record the text and models the posts are scored with
+        self.__add_model_text()
+        self.df_new['text_hash'] = isc.hash_texts(self.df_new['titletext'])
+        self.df_new['model_version'] = self.__get_model_version()
+
+        # Split off posts whose scores are unchanged
+        df_reused = None
+        if self.incremental_scoring and self.scored_file_found:
+            self.df_new, df_reused = isc.split_scored_rows(df=self.df_new,
+                                                           df_scored=self.df_scored,
+                                                           score_cols=self.score_cols)
+
+        # Log posts to score
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='posts to score', source='reddit',
+                         score_cnt=len(self.df_new), reused_cnt=0 if df_reused is None else len(df_reused))
+
+        # Score for relevance and sentiment
+        if len(self.df_new) > 0:
+            self.score_relevance()
+            self.sentiment_model()
+
+        # Add back the posts with unchanged scores
+        if df_reused is not None and len(df_reused) > 0:
+            self.df_new = pd.concat(objs=[self.df_new, df_reused])
 
 
     def sentiment_model(self):
@@ -201,58 +413,108 @@ class ScorePosts():
         '''
 
         # Log sentiment score start
-        self.__log_event(msg_id=1, screen_print=True, event='start sentiment scoring', source='reddit')
-
-        # Initialize sentiment analysis pipeline
-        sentiment_analyzer = pipeline(task='sentiment-analysis',
-                                      model=self.sentiment_model_hf_location,
-                                      device=-1,
-                                      truncation=True)
-        sentiment_analyzer.tokenizer.model_max_length = 512
-
-        # Initialize lists to store results
-        sentiments = []
-        scores = []
-
-        # Process each post in the dataframe
-        for post in self.df_new['titletext']:
-            # Segment the text
-            segments = post.split('\n')
-
-            # Initialize counters for sentiments and scores
-            sentiment_counts = {'positive': 0, 'negative': 0, 'neutral': 0}
-            sentiment_scores = {'positive': 0, 'negative': 0, 'neutral': 0}
-
-            # Analyze sentiment for each segment
-            for segment in segments:
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='start sentiment scoring', source='reddit')
+
+        # Sentiment labels, in the order ties between total scores are broken
+        sentiment_labels = ['positive', 'negative', 'neutral']
+        label_index = {label: i for i, label in enumerate(sentiment_labels)}
+
+        # Segment the text of all posts into one list, keeping the post each segment came from
+        segment_posts = []
+        segments = []
+        for post_num, post in enumerate(self.df_new['titletext']):
+            for segment in post.split('\n'):
                 # Optionally, filter out segments that are too short or not meaningful
                 if len(segment.strip()) > 0:
-                    result = sentiment_analyzer(segment)[0]
-                    sentiment_label = result['label']
-                    sentiment_score = result['score']
-
-                    # Update sentiment and score counters
-                    sentiment_counts[sentiment_label] += 1
-                    sentiment_scores[sentiment_label] += sentiment_score
-
-            # Determine overall sentiment based on total scores
-            if sum(sentiment_counts.values()) > 0:  # Check if any segment with non-zero sentiment scores
-                overall_sentiment = max(sentiment_scores, key=sentiment_scores.get)
-                overall_sentiment_score = sentiment_scores[overall_sentiment] / sentiment_counts[overall_sentiment]
-            else:
-                overall_sentiment = None
-                overall_sentiment_score = None
-
-            # Append results to lists
-            sentiments.append(overall_sentiment)
-            scores.append(overall_sentiment_score)
+                    segment_posts.append(post_num)
+                    segments.append(segment)
+
+        # Analyze sentiment for segments not in the cache - cached results are kept per model version
+        self.__get_model_version()
+        results = self.__cached_predict(model="sentiment|{}".format(self.model_versions["sentiment"]),
+                                        texts=segments,
+                                        predict_fn=self.__analyze_segments)
+        segment_label_index = np.array([label_index[result['label']] for result in results], dtype=np.int64)
+        segment_scores = np.array([result['score'] for result in results], dtype=np.float64)
+
+        # Count segments and total scores for each post and sentiment - np.add.at adds the
+        # segments one at a time in their original order, as a loop over each post would
+        post_count = len(self.df_new)
+        segment_posts = np.array(segment_posts, dtype=np.int64)
+        sentiment_counts = np.zeros((post_count, len(sentiment_labels)))
+        sentiment_scores = np.zeros((post_count, len(sentiment_labels)))
+        np.add.at(sentiment_counts, (segment_posts, segment_label_index), 1)
+        np.add.at(sentiment_scores, (segment_posts, segment_label_index), segment_scores)
+
+        # Determine overall sentiment based on total scores (argmax keeps the first of tied labels)
+        overall_index = sentiment_scores.argmax(axis=1)
+        post_index = np.arange(post_count)
+        overall_counts = sentiment_counts[post_index, overall_index]
+        overall_scores = sentiment_scores[post_index, overall_index] / np.maximum(overall_counts, 1)
+
+        # Posts without any segments with sentiment get no score
+        has_segments = sentiment_counts.sum(axis=1) > 0
+        sentiments = [sentiment_labels[i] if has else None for i, has in zip(overall_index, has_segments)]
+        scores = [float(score) if has else None for score, has in zip(overall_scores, has_segments)]
 
         # Add sentiment and score columns to the new dataframe
         self.df_new['sentiment'] = sentiments
         self.df_new['sentiment_score'] = scores
 
         # Log sentiment score start
-        self.__log_event(msg_id=1, screen_print=True, event='sentiment scoring completed', source='reddit')
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='sentiment scoring completed', source='reddit')
+
+
+    def __analyze_segments(self,
+                           segments):
+        '''
+        Method to analyze sentiment for a list of post segments in batches of segments of
+        similar length
+
+        Output:
+            List of dictionaries of sentiment label and score in the order of the segments
+
+        '''
+
+        # Sort segments by length so each batch holds segments of similar length
+        segment_order = sorted(range(len(segments)), key=lambda i: len(segments[i]))
+
+        # Analyze sentiment for each batch of segments
+        segment_results = [None] * len(segments)
+        for batch_start in range(0, len(segment_order), self.sentiment_batch_size):
+            batch_index = segment_order[batch_start: batch_start + self.sentiment_batch_size]
+
+            batch_start_time = time.perf_counter()
+            results = self.__predict_sentiment_batch([segments[i] for i in batch_index])
+            batch_seconds = time.perf_counter() - batch_start_time
+
+            # Put the results back in the segments' order
+            for i, result in zip(batch_index, results):
+                segment_results[i] = result
+
+            # Log batch throughput
+            self.__log_event(msg_id=1, screen_print=False, event='sentiment batch scored', source='reddit',
+                             batch_size=len(batch_index), max_length=len(segments[batch_index[-1]]),
+                             seconds=round(batch_seconds, 3),
+                             segments_per_second=round(len(batch_index) / max(batch_seconds, 1e-6), 1))
+
+        return segment_results
+
+
+    def __predict_sentiment_batch(self,
+                                  texts):
+        '''
+        Method to analyze sentiment for a batch of texts on the model server or with the
+        sentiment pipeline loaded in this process (texts are truncated to 512 tokens)
+
+        '''
+
+        if self.model_server is not None:
+            return self.model_server.predict(name="sentiment", texts=texts)
+
+        return self.model_registry.predict_sentiment(hf_location=self.sentiment_model_hf_location,
+                                                     texts=texts,
+                                                     batch_size=self.sentiment_batch_size)
 
 
     def read_posts_file(self):
@@ -279,6 +541,22 @@ class ScorePosts():
             raise RuntimeError(msg)
 
         # Look for an existing file with scored tweet data
+        self.__read_scored_file()
+
+        # If we're updating everything create one big data frame
+        # Otherwise just score the new posts and then concat with previously scored
+        # before writing (assuming scored file found)
+        if self.update_scores and self.scored_file_found:
+
+            self.df_new = pd.concat(objs=[self.df_new, self.df_scored])
+
+
+    def __read_scored_file(self):
+        '''
+        Method to read previously scored posts, if there are any
+
+        '''
+
         try:
             self.df_scored = pd.read_csv(filepath_or_buffer=os.path.join(self.posts_file_path,
                                                                          self.scored_input_file_name))
@@ -289,12 +567,112 @@ class ScorePosts():
 
             self.scored_file_found = False
 
-        # If we're updating everything create one big data frame
-        # Otherwise just score the new posts and then concat with previously scored
-        # before writing (assuming scored file found)
-        if self.update_scores and self.scored_file_found:
 
-            self.df_new = pd.concat(objs=[self.df_new, self.df_scored])
+    def score_batch(self,
+                    rows):
+        '''
+        Method to score a micro-batch of new posts in streaming mode.  The scored posts
+        are kept until finish_stream saves them.
+
+        Input:
+            rows: list
+                List of dictionaries of new posts
+
+        '''
+
+        self.df_new = pd.DataFrame(rows)
+
+        # Score for relevance and sentiment
+        self.__score_changed_posts()
+
+        self.scored_batches.append(self.df_new)
+
+        # Log micro-batch
+        self.__log_event(msg_id=1, screen_print=False, event='micro-batch scored', source='reddit',
+                         post_cnt=len(self.df_new))
+
+
+    def finish_stream(self):
+        '''
+        Method to save the posts scored in streaming mode with the previously scored
+        posts and close logging.  The scored posts file may be in cloud storage, where
+        files can't be appended to, so it is written once at the end.
+
+        '''
+
+        if len(self.scored_batches) > 0:
+
+            # Combine the scored micro-batches
+            self.df_new = pd.concat(objs=self.scored_batches)
+
+            # Add the previously scored posts and save
+            self.__read_scored_file()
+            self.write_posts_file()
+
+        else:
+            self.__log_event(msg_id=1, screen_print=True, event='no new posts to score', source='reddit')
+
+        # Close the cache of model outputs
+        self.__close_inference_cache()
+
+        # Close logging
+        self.__log_event(msg_id=-1, screen_print=False)
+
+
+    async def score_stream(self,
+                           row_queue):
+        '''
+        Method to score new posts as they are fetched.  Lists of new posts are taken from
+        the queue until a None is received and scored in micro-batches of at least
+        micro_batch_size posts in a worker thread, so the fetch keeps running while the
+        models work.  The queue is bounded, so a fetch that gets ahead of scoring waits.
+
+        If scoring fails the queue is still drained, so the fetch is never left waiting,
+        and the error is raised once the None is received.
+
+        Input:
+            row_queue: asyncio.Queue
+                Queue of lists of dictionaries of new posts, ended by None
+
+        '''
+
+        rows = []
+        stream_error = None
+
+        while True:
+
+            new_rows = await row_queue.get()
+
+            # End of stream
+            if new_rows is None:
+                break
+
+            # Keep draining the queue after a failure
+            if stream_error is not None:
+                continue
+
+            rows.extend(new_rows)
+
+            # Score a full micro-batch
+            if len(rows) >= self.micro_batch_size:
+                try:
+                    await asyncio.to_thread(self.score_batch, rows)
+
+                except Exception as e:
+                    stream_error = e
+                    self.__log_event(msg_id=1, screen_print=True, event='scoring exception',
+                                     exception_info=str(e), source='reddit')
+
+                rows = []
+
+        if stream_error is not None:
+            raise RuntimeError(stream_error)
+
+        # Score what is left and save
+        if len(rows) > 0:
+            await asyncio.to_thread(self.score_batch, rows)
+
+        await asyncio.to_thread(self.finish_stream)
 
 
     def write_posts_file(self):
@@ -348,27 +726,31 @@ class ScorePosts():
         # msg_id = -1 - Close logger
         if self.score_logging and msg_id == -1:
 
-            # Close any open logs
-            logging.shutdown()
+            # Close the log file
+            for handler in self.logger.handlers[:]:
+                handler.close()
+                self.logger.removeHandler(handler)
 
         # msg_id = 0 - Set up the logger
         if self.score_logging and msg_id == 0:
 
-            # Close any open logs
-            logging.shutdown()
-
             # Name a new log file
             log_file = f"{kwargs['logfile_stub']}_logfile.log"
 
+            # Use a named logger rather than the root logger so that pipelines running at
+            # the same time (see run_scrapers.py) do not reconfigure each other's logs
+            self.logger = logging.getLogger("gvceh.scorer.{}".format(kwargs['logfile_stub']))
+            for handler in self.logger.handlers[:]:
+                handler.close()
+                self.logger.removeHandler(handler)
+
             # Configure the logging system
-            logging.basicConfig(filename=os.path.join(self.logs_file_path, log_file),
-                                filemode='w',
-                                format='%(levelname)s - %(message)s',
-                                level=logging.INFO,
-                                force=True)
-
-            # Create a logger
-            self.logger = logging.getLogger()
+            handler = logging.FileHandler(filename=os.path.join(self.logs_file_path, log_file),
+                                          mode='w')
+            handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
 
         # msg_id = 1 - Data fetch start
         elif self.score_logging and msg_id == 1:
@@ -0,0 +1,103 @@
+##############
+# File to run the local model server which keeps
+# the relevance and sentiment models loaded between
+# scraper runs
+#
+##############
+
+# Core Python
+import os, sys
+
+# GVCEH objects
+sys.path.insert(0, "reddit/")
+import reddit_scorer as rds
+
+# GVCEH objectscl
+sys.path.insert(0, "xtwitter/")
+import x_twitter_scorer as xts
+
+# GVCEH objectscl
+sys.path.insert(0, "utils/")
+import gcp_tools as gt
+import model_registry as mr
+import model_server as ms
+
+# Model server address (set model_server_url = "http://127.0.0.1:8765" in the scorers to use it)
+model_server_host = "127.0.0.1"
+model_server_port = 8765
+
+
+if __name__ == "__main__":
+
+    '''
+    This function loads the models used by ScorePosts and ScoreTweets and serves them
+    on localhost until stopped.  Restart it after a new model is saved.
+
+    To run locally (from the /code subdirectory):
+
+        python run_model_server.py local
+
+    '''
+
+    # GCP project
+    project_id = "npaicivitas"
+
+    # Version of GCP secret
+    version_id = "1"
+
+    if len(sys.argv) > 1 and sys.argv[1].lower() == "local":
+
+        # Model locations
+        reddit_models_file_path = "../data/models/reddit"
+        gcp_credentials = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "")
+
+    else:
+
+        # Model locations
+        bucket_name = "gvceh-03a-storage"
+        reddit_models_file_path = "gs://{}/reddit/models".format(bucket_name)
+        gcp_credentials = gt.get_gcpsecrets(project_id, "GOOGLE_APPLICATION_CREDENTIALS", version_id)
+
+    # Models used by the scorers
+    reddit_relevance_file_name = rds.ScorePosts.relevance_model1_filename
+    xtwitter_relevance_hf_location = xts.ScoreTweets.relevance_model_hf_location
+    sentiment_hf_location = rds.ScorePosts.sentiment_model_hf_location
+
+    registry = mr.ModelRegistry(cache_path=rds.ScorePosts.model_cache_file_path,
+                                gcp_credentials=gcp_credentials)
+
+    # Load the models now so the first request doesn't wait
+    print('Loading models')
+    _, reddit_relevance_version = registry.load_joblib_model(model_path=reddit_models_file_path,
+                                                             file_name=reddit_relevance_file_name)
+    registry.load_setfit_model(hf_location=xtwitter_relevance_hf_location)
+    registry.load_sentiment_pipeline(hf_location=sentiment_hf_location)
+
+    predictors = {"reddit_relevance": lambda texts: registry.predict_joblib_setfit(model_path=reddit_models_file_path,
+                                                                                   file_name=reddit_relevance_file_name,
+                                                                                   texts=texts),
+                  "xtwitter_relevance": lambda texts: registry.predict_setfit(hf_location=xtwitter_relevance_hf_location,
+                                                                              texts=texts),
+                  "sentiment": lambda texts: registry.predict_sentiment(hf_location=sentiment_hf_location,
+                                                                        texts=texts,
+                                                                        batch_size=rds.ScorePosts.sentiment_batch_size)}
+
+    # Versions of the models served, in the form the scorers save with their scores
+    versions = {"reddit_relevance": "{}@{}".format(reddit_relevance_file_name, reddit_relevance_version),
+                "xtwitter_relevance": registry.get_hf_version(xtwitter_relevance_hf_location),
+                "sentiment": registry.get_hf_version(sentiment_hf_location)}
+
+    server = ms.ModelServer(predictors=predictors,
+                            versions=versions,
+                            host=model_server_host,
+                            port=model_server_port)
+
+    print('Model server listening on http://{}:{}'.format(model_server_host, model_server_port))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        server.shutdown()
+
+    print('Model server stopped')
@@ -8,6 +8,7 @@
 
 # Core Python
 import os, sys
+import time
 
 # Environment variables for API credential storage
 import dotenv
@@ -29,6 +30,138 @@ import x_twitter_scorer as xts
 sys.path.insert(0, "utils/")
 import gcp_tools as gt
 
+# Maximum number of lists of new rows waiting to be scored when streaming
+row_queue_size = 20
+
+
+async def run_stage(stage_name,
+                    stage,
+                    stage_times):
+    '''
+    Function to run one pipeline stage and record how long it took
+
+    Inputs:
+        stage_name: str
+            Name of the stage used in the timing summary
+        stage: coroutine
+            Stage to run
+        stage_times: dict
+            Dictionary of stage name to run time in seconds
+
+    '''
+
+    start_time = time.perf_counter()
+
+    try:
+        return await stage
+
+    finally:
+        stage_times[stage_name] = time.perf_counter() - start_time
+
+
+async def run_source_pipeline(source_name,
+                              data_fetcher,
+                              fetch,
+                              scorer_class,
+                              scorer_kwargs,
+                              stage_times,
+                              stream_scoring=False):
+    '''
+    Function to fetch one source's data and score it.  Scoring is CPU bound, so it
+    runs in worker threads to keep the event loop free for the other source's fetch.
+
+    Without streaming, scoring starts once the fetch has finished and reads the new
+    data file written by the fetch.  With streaming, the fetcher puts its new rows on
+    a bounded queue as it goes and the scorer scores them in micro-batches while the
+    fetch is still running.
+
+    Inputs:
+        source_name: str
+            Name of the source used in the timing summary (e.g. Reddit)
+        data_fetcher: GVCEHReddit or GVCEHXTwitter
+            Data fetcher for the source
+        fetch: function
+            Data fetcher's asynchronous fetch method
+        scorer_class: class
+            ScorePosts or ScoreTweets
+        scorer_kwargs: dict
+            Arguments for the scorer
+        stage_times: dict
+            Dictionary of stage name to run time in seconds
+        stream_scoring: bool
+            True to score new rows as they are fetched
+
+    '''
+
+    if not stream_scoring:
+        await run_stage("{} fetch".format(source_name), fetch(), stage_times)
+        await run_stage("{} score".format(source_name), asyncio.to_thread(scorer_class, **scorer_kwargs), stage_times)
+        return
+
+    # Set up the scorer - loading the models happens with the first micro-batch
+    scorer = await asyncio.to_thread(scorer_class, streaming=True, **scorer_kwargs)
+
+    # Queue of new rows from the fetch to the scorer
+    row_queue = asyncio.Queue(maxsize=row_queue_size)
+    data_fetcher.row_queue = row_queue
+
+    # Start scoring, then fetch
+    scoring = asyncio.create_task(run_stage("{} score".format(source_name), scorer.score_stream(row_queue), stage_times))
+
+    try:
+        await run_stage("{} fetch".format(source_name), fetch(), stage_times)
+
+    finally:
+        # End the stream, then wait for the last micro-batch to be scored and saved
+        await row_queue.put(None)
+        await scoring
+
+
+async def run_pipelines(reddit_fetcher,
+                        reddit_scorer_kwargs,
+                        xtwitter_fetcher,
+                        xtwitter_scorer_kwargs,
+                        stream_scoring=False):
+    '''
+    Function to run the Reddit and X (Twitter) pipelines at the same time.  Each
+    pipeline scores its data as soon as its own fetch is finished (or while it runs if
+    streaming), so the whole run takes about as long as the slower pipeline.  A summary of the time taken by each
+    stage is printed at the end, even if a pipeline fails; the first failure is then
+    raised.
+    '''
+
+    stage_times = {}
+    start_time = time.perf_counter()
+
+    # Run both pipelines - a failure in one does not stop the other
+    results = await asyncio.gather(run_source_pipeline(source_name="Reddit",
+                                                       data_fetcher=reddit_fetcher,
+                                                       fetch=reddit_fetcher.fetch_search_data,
+                                                       scorer_class=rds.ScorePosts,
+                                                       scorer_kwargs=reddit_scorer_kwargs,
+                                                       stage_times=stage_times,
+                                                       stream_scoring=stream_scoring),
+                                   run_source_pipeline(source_name="X",
+                                                       data_fetcher=xtwitter_fetcher,
+                                                       fetch=xtwitter_fetcher.batch_scrape_async,
+                                                       scorer_class=xts.ScoreTweets,
+                                                       scorer_kwargs=xtwitter_scorer_kwargs,
+                                                       stage_times=stage_times,
+                                                       stream_scoring=stream_scoring),
+                                   return_exceptions=True)
+
+    # Timing summary
+    print('Stage timings (seconds):')
+    for stage_name, stage_time in stage_times.items():
+        print('    {:<15}{:>10.1f}'.format(stage_name, stage_time))
+    print('    {:<15}{:>10.1f}'.format('Total', time.perf_counter() - start_time))
+
+    # Raise the first failure
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
 if __name__ == "__main__":
 
     '''
@@ -51,6 +184,9 @@ if __name__ == "__main__":
     # Version of GCP secret
     version_id = "1"
 
+    # Score new posts and tweets while they are being fetched (python run_scrapers.py [local] stream)
+    stream_scoring = "stream" in [arg.lower() for arg in sys.argv[1:]]
+
 
     if len(sys.argv) > 1 and sys.argv[1].lower() == "local":
         # Reddit credentials
@@ -68,9 +204,12 @@ if __name__ == "__main__":
         # File locations
         reddit_posts_file_path = "../data/reddit/posts"
         reddit_logs_file_path = "../data/reddit/logs"
+        reddit_store_file_path = "../data/reddit/store"
         reddit_models_file_path ="../data/models/reddit"
         xtwitter_tweets_file_path = "../data/xtwitter/tweets"
         xtwitter_logs_file_path = "../data/xtwitter/logs"
+        xtwitter_store_file_path = "../data/xtwitter/store"
+        inference_cache_file_path = "../data/store"
 
         keywords_file_path = "../data/keywords"
 
@@ -100,56 +239,57 @@ if __name__ == "__main__":
         # reddit_models_file_path ="../data/models/reddit"
         reddit_models_file_path = "{}/reddit/models".format(bucket_path)
         reddit_logs_file_path = "../data/reddit/logs"
+        reddit_store_file_path = "../data/reddit/store"
 
         xtwitter_tweets_file_path = "{}/xtwitter/tweets".format(bucket_path)
         # xtwitter_logs_file_path = "{}/xtwitter/logs".format(bucket_path)
         xtwitter_logs_file_path = "../data/xtwitter/logs"
+        xtwitter_store_file_path = "../data/xtwitter/store"
+        inference_cache_file_path = "../data/store"
 
         keywords_file_path = "{}/keywords".format(bucket_path)
 
     # Update user
-    print('Collecting Reddit data ')
+    print('Collecting Reddit and X (Twitter) data ')
 
     # Step 2: Initialize GVCEHReddit object
-    data_fetcher = rdf.GVCEHReddit(client_id=REDDIT_CLIENT_ID,
-                                   client_secret=REDDIT_CLIENT_SECRET,
-                                   user_agent=REDDIT_USER_AGENT,
-                                   posts_file_path=reddit_posts_file_path,
-                                   logs_file_path=reddit_logs_file_path,
-                                   keywords_file_path=keywords_file_path)
-
-    # Step 3: Fetch reddit data
-    asyncio.run(data_fetcher.fetch_search_data())
-
-    # Step 4. Score posts
-    rds.ScorePosts(posts_file_path=reddit_posts_file_path,
-                   logs_file_path=reddit_logs_file_path,
-                   relevance_model_path=reddit_models_file_path,
-                   gcp_credentials=os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
-
-    # Update user
-    print('Collecting X (Twitter) data ')
-
-    # Step 5: Initialize GVCEHXTwitter object
-    data_fetcher = xtdf.GVCEHXTwitter(bearer_token=TWITTER_BEARER_TOKEN,
-                                      consumer_key=TWITTER_CONSUMER_KEY,
-                                      consumer_secret=TWITTER_CONSUMER_SECRET,
-                                      access_token=TWITTER_ACCESS_TOKEN,
-                                      access_token_secret=TWITTER_ACCESS_TOKEN_SECRET,
-                                      tweets_file_path=xtwitter_tweets_file_path,
-                                      logs_file_path=xtwitter_logs_file_path,
-                                      keywords_file_path=keywords_file_path)
-
-    # Step 6: Fetch Twitter data
-    data_fetcher.batch_scrape()
-
-    # Step 7. Score tweets
-    xts.ScoreTweets(tweets_file_path=xtwitter_tweets_file_path,
-                    logs_file_path=xtwitter_logs_file_path,
-                    gcp_project_id=project_id)
+    reddit_fetcher = rdf.GVCEHReddit(client_id=REDDIT_CLIENT_ID,
+                                     client_secret=REDDIT_CLIENT_SECRET,
+                                     user_agent=REDDIT_USER_AGENT,
+                                     posts_file_path=reddit_posts_file_path,
+                                     logs_file_path=reddit_logs_file_path,
+                                     store_file_path=reddit_store_file_path,
+                                     keywords_file_path=keywords_file_path)
+
+    # Step 3: Set up Reddit post scoring
+    reddit_scorer_kwargs = dict(posts_file_path=reddit_posts_file_path,
+                                logs_file_path=reddit_logs_file_path,
+                                relevance_model_path=reddit_models_file_path,
+                                inference_cache_file_path=inference_cache_file_path,
+                                gcp_credentials=os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
+
+    # Step 4: Initialize GVCEHXTwitter object
+    xtwitter_fetcher = xtdf.GVCEHXTwitter(bearer_token=TWITTER_BEARER_TOKEN,
+                                          consumer_key=TWITTER_CONSUMER_KEY,
+                                          consumer_secret=TWITTER_CONSUMER_SECRET,
+                                          access_token=TWITTER_ACCESS_TOKEN,
+                                          access_token_secret=TWITTER_ACCESS_TOKEN_SECRET,
+                                          tweets_file_path=xtwitter_tweets_file_path,
+                                          logs_file_path=xtwitter_logs_file_path,
+                                          store_file_path=xtwitter_store_file_path,
+                                          keywords_file_path=keywords_file_path)
+
+    # Step 5: Set up tweet scoring
+    xtwitter_scorer_kwargs = dict(tweets_file_path=xtwitter_tweets_file_path,
+                                  logs_file_path=xtwitter_logs_file_path,
+                                  inference_cache_file_path=inference_cache_file_path,
+                                  gcp_project_id=project_id)
+
+    # Step 6: Fetch and score Reddit posts and tweets - the two pipelines run at the same time
+    asyncio.run(run_pipelines(reddit_fetcher=reddit_fetcher,
+                              reddit_scorer_kwargs=reddit_scorer_kwargs,
+                              xtwitter_fetcher=xtwitter_fetcher,
+                              xtwitter_scorer_kwargs=xtwitter_scorer_kwargs,
+                              stream_scoring=stream_scoring))
 
     print('Scrapers run complete')
-
-
-
-
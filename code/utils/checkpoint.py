@@ -0,0 +1,188 @@
+# Checkpoint files letting GVCEH fetches resume after a failure
+
+# Core python
+import os
+import json
+import uuid
+
+# Time
+from datetime import datetime, timedelta
+
+
+class FetchCheckpoint():
+    '''
+    Checkpoint file recording the progress of a fetch: when the run started, which
+    units of work (e.g. subreddit and query pairs) are complete and, optionally, rows
+    buffered but not yet saved.  A fetch saves its checkpoint every so often and on
+    failure; a restarted fetch loads it to skip completed work, and the checkpoint is
+    cleared when the fetch finishes.
+
+    The checkpoint file is written to a temporary file first and then renamed, so a
+    crash while saving never leaves a half written checkpoint.  Rows are appended to a
+    separate rows file (one JSON row per line), so each save only writes the rows added
+    since the last one.  The checkpoint file records how much of the rows file it
+    covers, and anything written after that is dropped when the checkpoint is loaded.
+    Checkpoints older than max_age are ignored.
+
+    Inputs:
+        __init__ :
+            checkpoint_file: Path to the checkpoint file (must be on local disk)
+            max_age: Age (timedelta) after which a checkpoint is no longer resumed
+
+    Attributes:
+        run_start: Start time of the run the checkpoint belongs to
+        run_id: Unique ID of the run the checkpoint belongs to
+        completed: Set of completed units of work
+        rows: Rows restored from the checkpoint of an unfinished run
+        row_count: Number of rows saved with the checkpoint
+        rows_file: Path to the file of rows saved with the checkpoint
+        dtformat: String format for time values
+
+    '''
+
+    # Date format
+    dtformat = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self,
+                 checkpoint_file,
+                 max_age=timedelta(days=1)):
+        '''
+        Initialize the FetchCheckpoint class.
+        '''
+
+        self.checkpoint_file = checkpoint_file
+        self.rows_file = "{}_rows.jsonl".format(os.path.splitext(checkpoint_file)[0])
+        self.max_age = max_age
+
+        # Make sure the checkpoint's folder exists
+        checkpoint_path = os.path.dirname(checkpoint_file)
+        if len(checkpoint_path) > 0:
+            os.makedirs(checkpoint_path, exist_ok=True)
+
+        # Progress of a new run
+        self.run_start = datetime.now().strftime(self.dtformat)
+        self.run_id = uuid.uuid4().hex
+        self.completed = set()
+        self.rows = []
+        self.row_count = 0
+        self.rows_size = 0
+        self.resumed = False
+
+    def load(self):
+        '''
+        Method to load the checkpoint left by an unfinished run, if there is a recent one.
+
+        Output:
+            True if a checkpoint was loaded
+
+        '''
+
+        try:
+            with open(self.checkpoint_file, "r") as f:
+                state = json.load(f)
+
+        except (FileNotFoundError, ValueError):
+            self.__remove_rows_file()
+            return False
+
+        # Ignore old checkpoints
+        run_start = datetime.strptime(state["run_start"], self.dtformat)
+        if datetime.now() - run_start > self.max_age:
+            self.__remove_rows_file()
+            return False
+
+        self.run_start = state["run_start"]
+        self.run_id = state.get("run_id", self.run_id)
+        self.completed = set([self.__to_unit(unit) for unit in state["completed"]])
+        self.rows = self.__read_rows(rows_size=state.get("rows_size", 0))
+        self.row_count = len(self.rows)
+        self.rows_size = state.get("rows_size", 0)
+        self.resumed = True
+
+        return True
+
+    def save(self,
+             rows=None):
+        '''
+        Method to save the checkpoint
+
+        Input:
+            rows: list
+                Rows (dictionaries) buffered since the last save, added to those saved
+                with the checkpoint
+
+        '''
+
+        # Append the new rows to the rows file
+        if rows is not None and len(rows) > 0:
+            with open(self.rows_file, "ab") as f:
+                f.write("".join([json.dumps(row, default=str) + "\n" for row in rows]).encode("utf-8"))
+                self.rows_size = f.tell()
+            self.row_count += len(rows)
+
+        state = {"run_start": self.run_start,
+                 "run_id": self.run_id,
+                 "saved_at": datetime.now().strftime(self.dtformat),
+                 "completed": sorted([list(unit) if isinstance(unit, tuple) else unit for unit in self.completed]),
+                 "row_count": self.row_count,
+                 "rows_size": self.rows_size}
+
+        # Write then rename so the checkpoint is replaced in one step
+        temp_file = "{}.tmp".format(self.checkpoint_file)
+        with open(temp_file, "w") as f:
+            json.dump(state, f, default=str)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def clear(self):
+        '''
+        Method to remove the checkpoint once the fetch has finished
+        '''
+
+        try:
+            os.remove(self.checkpoint_file)
+        except FileNotFoundError:
+            pass
+
+        self.__remove_rows_file()
+
+    def __read_rows(self,
+                    rows_size):
+        '''
+        Method to read the rows saved with the checkpoint - the first rows_size bytes of
+        the rows file.  Rows written after the checkpoint was saved are removed.
+
+        Output:
+            List of rows (dictionaries)
+
+        '''
+
+        try:
+            with open(self.rows_file, "rb+") as f:
+                data = f.read(rows_size)
+                f.truncate(rows_size)
+
+        except FileNotFoundError:
+            return []
+
+        return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+    def __remove_rows_file(self):
+        '''
+        Method to remove the rows file
+        '''
+
+        try:
+            os.remove(self.rows_file)
+        except FileNotFoundError:
+            pass
+
+    def __to_unit(self,
+                  unit):
+        '''
+        Method to convert a unit of work read from JSON back to a hashable value
+        '''
+
+        if isinstance(unit, list):
+            return tuple(unit)
+
+        return unit
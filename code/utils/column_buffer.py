@@ -0,0 +1,100 @@
+# Columnar row buffer shared by the GVCEH data fetchers
+
+# Data
+import pandas as pd
+
+
+class ColumnBuffer():
+    '''
+    Append buffer holding rows as one list per column.  Appending a row only adds its
+    values to the column lists, so a fetch loop can collect any number of rows at a
+    linear cost and build a single dataframe once at the end, instead of concatenating
+    a dataframe per query.
+
+    The columns are fixed by the first rows appended unless given when the buffer is
+    created.  Missing values are stored as None and keys outside the buffer's columns
+    are ignored.
+
+    Inputs:
+        __init__ :
+            columns: Columns of the buffered rows (optional)
+
+    Attributes:
+        columns: Columns of the buffered rows
+        data: Dictionary of column name to list of values
+
+    '''
+
+    def __init__(self,
+                 columns=None):
+        '''
+        Initialize the ColumnBuffer class.
+        '''
+
+        self.columns = None
+        self.data = {}
+        self.row_count = 0
+
+        if columns is not None:
+            self.__set_columns(columns)
+
+    def __set_columns(self,
+                      columns):
+        '''
+        Method to set the buffer's columns
+        '''
+
+        self.columns = list(columns)
+        self.data = {col: [] for col in self.columns}
+
+    def __len__(self):
+        '''
+        Method to get the number of buffered rows
+        '''
+
+        return self.row_count
+
+    def append_rows(self,
+                    rows):
+        '''
+        Method to append rows to the buffer
+
+        Input:
+            rows: list
+                List of dictionaries
+
+        '''
+
+        for row in rows:
+
+            # Take the columns from the first row if none were given
+            if self.columns is None:
+                self.__set_columns(row.keys())
+
+            for col in self.columns:
+                self.data[col].append(row.get(col))
+
+            self.row_count += 1
+
+    def to_records(self,
+                   start=0):
+        '''
+        Method to get the buffered rows as a list of dictionaries
+
+        Input:
+            start: int
+                Index of the first row to get (e.g. the first row not yet checkpointed)
+
+        '''
+
+        if self.columns is None:
+            return []
+
+        return [dict(zip(self.columns, values)) for values in zip(*[self.data[col][start:] for col in self.columns])]
+
+    def to_dataframe(self):
+        '''
+        Method to build a dataframe from the buffered rows
+        '''
+
+        return pd.DataFrame(self.data, columns=self.columns)
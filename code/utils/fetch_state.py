@@ -0,0 +1,152 @@
+# Persistent fetch state shared by the GVCEH data fetchers
+
+# Core python
+import os
+import sqlite3
+
+# Time
+from datetime import datetime
+
+
+class FetchState():
+    '''
+    Small SQLite store of high-water marks - the newest post seen by a fetch for a
+    given key (e.g. a subreddit and search query pair).  Fetches use them to stop
+    paging once they reach posts they have already seen in an earlier run.
+
+    Each mark holds the ID (or Reddit fullname) of the newest post and its creation
+    time in seconds since the epoch.
+
+    A fetch that stops paging before reaching its high-water mark (e.g. at a page limit)
+    leaves a gap between the mark and the oldest post it read.  It saves a resume point
+    instead of moving the mark: the oldest post read (where the next fetch picks up) and
+    the newest post read (the mark to move to once the gap has been read).
+
+    Inputs:
+        __init__ :
+            db_file: Path to the SQLite database file
+            source: Name of the data source using the state (e.g. reddit or xtwitter)
+
+    Attributes:
+        conn: SQLite connection
+        dtformat: String format for time values
+
+    '''
+
+    # Date format
+    dtformat = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self,
+                 db_file,
+                 source):
+        '''
+        Initialize the FetchState class.
+        '''
+
+        self.db_file = db_file
+        self.source = source
+
+        # Make sure the state's folder exists
+        db_path = os.path.dirname(db_file)
+        if len(db_path) > 0:
+            os.makedirs(db_path, exist_ok=True)
+
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS high_water_marks "
+                          "(source TEXT, key TEXT, post_id TEXT, created_utc REAL, updated_at TEXT, "
+                          "PRIMARY KEY (source, key))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS resume_points "
+                          "(source TEXT, key TEXT, until_id TEXT, until_created_utc REAL, "
+                          "top_id TEXT, top_created_utc REAL, updated_at TEXT, "
+                          "PRIMARY KEY (source, key))")
+        self.conn.commit()
+
+    def get_high_water_mark(self,
+                            key):
+        '''
+        Method to get the high-water mark for a key
+
+        Output:
+            Tuple of (post ID, created_utc) or (None, None) if there is no mark yet
+
+        '''
+
+        cur = self.conn.execute("SELECT post_id, created_utc FROM high_water_marks WHERE source = ? AND key = ?",
+                                (self.source, key))
+        row = cur.fetchone()
+
+        if row is None:
+            return None, None
+
+        return row[0], row[1]
+
+    def set_high_water_mark(self,
+                            key,
+                            post_id,
+                            created_utc):
+        '''
+        Method to save the high-water mark for a key.  An older post never replaces a
+        newer mark.
+        '''
+
+        _, current_created_utc = self.get_high_water_mark(key=key)
+        if current_created_utc is not None and created_utc < current_created_utc:
+            return
+
+        self.conn.execute("INSERT OR REPLACE INTO high_water_marks VALUES (?, ?, ?, ?, ?)",
+                          (self.source, key, str(post_id), float(created_utc),
+                           datetime.now().strftime(self.dtformat)))
+        self.conn.commit()
+
+    def get_resume_point(self,
+                         key):
+        '''
+        Method to get the resume point for a key
+
+        Output:
+            Tuple of (oldest post ID read, its created_utc, newest post ID read, its created_utc)
+            or None if there is no resume point
+
+        '''
+
+        cur = self.conn.execute("SELECT until_id, until_created_utc, top_id, top_created_utc "
+                                "FROM resume_points WHERE source = ? AND key = ?",
+                                (self.source, key))
+        row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        return tuple(row)
+
+    def set_resume_point(self,
+                         key,
+                         resume_point):
+        '''
+        Method to save the resume point for a key
+
+        Input:
+            resume_point: tuple
+                Tuple of (oldest post ID read, its created_utc, newest post ID read, its
+                created_utc), or None to remove the key's resume point
+
+        '''
+
+        if resume_point is None:
+            self.conn.execute("DELETE FROM resume_points WHERE source = ? AND key = ?", (self.source, key))
+
+        else:
+            until_id, until_created_utc, top_id, top_created_utc = resume_point
+            self.conn.execute("INSERT OR REPLACE INTO resume_points VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (self.source, key, str(until_id), float(until_created_utc),
+                               str(top_id), float(top_created_utc), datetime.now().strftime(self.dtformat)))
+
+        self.conn.commit()
+
+    def close(self):
+        '''
+        Method to close the state store
+        '''
+
+        self.conn.close()
@@ -0,0 +1,244 @@
+# Append-only history store shared by the GVCEH data fetchers
+
+# Core python
+import os
+import sqlite3
+
+# Data
+import pandas as pd
+
+# Time
+from datetime import datetime
+
+
+class HistoryStore():
+    '''
+    Append-only store of fetched posts kept in an embedded SQLite table keyed on the
+    post ID.  Rows are grouped into partitions (e.g. one per subreddit).  New rows are
+    appended with INSERT OR IGNORE so rows already in the store are skipped by the
+    primary key index, and nothing already stored is ever rewritten.
+
+    Each row records its partition, its insert time and the ID of the run that added
+    it.  The combined view of the history is read lazily with read, optionally limited
+    to some partitions, to rows inserted since a given time or to the rows of one run
+    (insert times only have second resolution, so a run's rows are found by run ID).
+
+    SQLite needs a local file, so the store is kept on local disk even when the posts
+    files are in cloud storage.
+
+    Inputs:
+        __init__ :
+            db_file: Path to the SQLite database file
+            columns: Columns of the stored rows
+            key_col: Column with the unique row ID
+            table: Name of the table holding the rows
+
+    Attributes:
+        conn: SQLite connection
+        dtformat: String format for time values
+
+    '''
+
+    # Date format
+    dtformat = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self,
+                 db_file,
+                 columns,
+                 key_col="id",
+                 table="posts"):
+        '''
+        Initialize the HistoryStore class.
+        '''
+
+        self.db_file = db_file
+        self.columns = list(columns)
+        self.key_col = key_col
+        self.table = table
+
+        # Make sure the store's folder exists
+        db_path = os.path.dirname(db_file)
+        if len(db_path) > 0:
+            os.makedirs(db_path, exist_ok=True)
+
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+        # Columns are left untyped so values keep the type they were written with
+        col_defs = ", ".join(['"{}"{}'.format(col, " PRIMARY KEY" if col == self.key_col else "")
+                              for col in self.columns])
+
+        # Table of rows plus the partition, insert time and run of each row
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "{}" ("partition" TEXT, "inserted_at" TEXT, "run_id" TEXT, {})'
+                          .format(self.table, col_defs))
+
+        # Stores created before run IDs were kept get the column added
+        table_cols = [row[1] for row in self.conn.execute('PRAGMA table_info("{}")'.format(self.table))]
+        if "run_id" not in table_cols:
+            self.conn.execute('ALTER TABLE "{}" ADD COLUMN "run_id" TEXT'.format(self.table))
+
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "{0}_partition" ON "{0}" ("partition")'.format(self.table))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "{0}_inserted_at" ON "{0}" ("inserted_at")'.format(self.table))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "{0}_run_id" ON "{0}" ("run_id")'.format(self.table))
+
+        # Table of partitions known to the store
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "{}_partitions" ("partition" TEXT PRIMARY KEY, "created_at" TEXT)'
+                          .format(self.table))
+        self.conn.commit()
+
+    def has_partition(self,
+                      partition):
+        '''
+        Method to check if a partition has been registered with the store
+        '''
+
+        cur = self.conn.execute('SELECT 1 FROM "{}_partitions" WHERE "partition" = ?'.format(self.table),
+                                (partition,))
+
+        return cur.fetchone() is not None
+
+    def add_partition(self,
+                      partition):
+        '''
+        Method to register a partition with the store (e.g. once its legacy history is imported)
+        '''
+
+        self.conn.execute('INSERT OR IGNORE INTO "{}_partitions" VALUES (?, ?)'.format(self.table),
+                          (partition, datetime.now().strftime(self.dtformat)))
+        self.conn.commit()
+
+    def partition_count(self,
+                        partition):
+        '''
+        Method to count the rows stored in a partition
+        '''
+
+        cur = self.conn.execute('SELECT COUNT(*) FROM "{}" WHERE "partition" = ?'.format(self.table),
+                                (partition,))
+
+        return cur.fetchone()[0]
+
+    def ids(self,
+            partition=None):
+        '''
+        Method to get the set of row IDs in the store or in one partition
+        '''
+
+        if partition is None:
+            cur = self.conn.execute('SELECT "{}" FROM "{}"'.format(self.key_col, self.table))
+        else:
+            cur = self.conn.execute('SELECT "{}" FROM "{}" WHERE "partition" = ?'.format(self.key_col, self.table),
+                                    (partition,))
+
+        return set([row[0] for row in cur])
+
+    def append(self,
+               partition,
+               rows,
+               inserted_at=None,
+               run_id=None):
+        '''
+        Method to append rows to a partition.  Rows whose ID is already in the store are
+        skipped.
+
+        Inputs:
+            partition: str
+                Partition the rows belong to
+            rows: list or pandas.DataFrame
+                List of dictionaries (or a dataframe) with the store's columns
+            inserted_at: str
+                Insert time recorded with the rows (defaults to now)
+            run_id: str
+                ID of the run adding the rows (None for rows not added by a run, e.g. imported history)
+
+        Output:
+            Number of rows added to the store
+
+        '''
+
+        if isinstance(rows, pd.DataFrame):
+            rows = rows.to_dict(orient="records")
+
+        if inserted_at is None:
+            inserted_at = datetime.now().strftime(self.dtformat)
+
+        # Values in column order - anything sqlite can't store directly (datetimes,
+        # Reddit objects) is kept as its string value, as it would be in a CSV file
+        values = [[partition, inserted_at, run_id] + [self.__to_sql_value(row.get(col)) for col in self.columns]
+                  for row in rows]
+
+        # Columns are named as stores created before run IDs have the run_id column last
+        col_list = ", ".join(['"{}"'.format(col) for col in ["partition", "inserted_at", "run_id"] + self.columns])
+
+        before = self.conn.total_changes
+        self.conn.executemany('INSERT OR IGNORE INTO "{}" ({}) VALUES ({})'
+                              .format(self.table, col_list, ", ".join(["?"] * (len(self.columns) + 3))),
+                              values)
+        self.conn.commit()
+
+        return self.conn.total_changes - before
+
+    def read(self,
+             partitions=None,
+             inserted_since=None,
+             run_id=None):
+        '''
+        Method to read stored rows into a dataframe with the store's columns
+
+        Inputs:
+            partitions: list
+                Partitions to read (defaults to all)
+            inserted_since: str
+                Only read rows inserted at or after this time
+            run_id: str
+                Only read rows added by this run
+
+        Output:
+            pandas.DataFrame
+
+        '''
+
+        col_list = ", ".join(['"{}"'.format(col) for col in self.columns])
+
+        conditions = []
+        params = []
+        if partitions is not None:
+            conditions.append('"partition" IN ({})'.format(", ".join(["?"] * len(partitions))))
+            params.extend(partitions)
+        if inserted_since is not None:
+            conditions.append('"inserted_at" >= ?')
+            params.append(inserted_since)
+        if run_id is not None:
+            conditions.append('"run_id" = ?')
+            params.append(run_id)
+
+        query = 'SELECT {} FROM "{}"'.format(col_list, self.table)
+        if len(conditions) > 0:
+            query = "{} WHERE {}".format(query, " AND ".join(conditions))
+
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def close(self):
+        '''
+        Method to close the store
+        '''
+
+        self.conn.close()
+
+    def __to_sql_value(self,
+                       value):
+        '''
+        Method to convert a value to a type SQLite can store
+        '''
+
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+
+        if isinstance(value, datetime):
+            return value.strftime(self.dtformat)
+
+        # numpy scalars
+        if hasattr(value, "item"):
+            return value.item()
+
+        return str(value)
@@ -0,0 +1,67 @@
+# Incremental scoring helpers shared by the GVCEH scorers
+
+# Core python
+import hashlib
+
+# Data
+import pandas as pd
+
+
+# Columns identifying what a row's scores were computed from
+key_cols = ["text_hash", "model_version"]
+
+
+def hash_texts(texts):
+    '''
+    Hash the texts fed to the scoring models.  Rows whose text hash and model version
+    are unchanged since they were last scored keep their scores.
+
+    Input:
+        texts: iterable
+            Texts fed to the models
+
+    Output:
+        List of MD5 hex digests
+
+    '''
+
+    return [hashlib.md5(str(text).encode("utf-8")).hexdigest() for text in texts]
+
+
+def split_scored_rows(df,
+                      df_scored,
+                      score_cols):
+    '''
+    Split rows into those needing scores and those whose scores can be copied from
+    previously scored rows with the same text hash and model version.
+
+    Inputs:
+        df: pandas dataframe
+            Rows to score, with text_hash and model_version columns
+        df_scored: pandas dataframe
+            Previously scored rows (None if there are none)
+        score_cols: list
+            Columns holding the model scores
+
+    Output:
+        Tuple of (rows needing scores, rows with copied scores)
+
+    '''
+
+    # Scored rows written before hashes were kept can't be matched
+    if df_scored is None or any(col not in df_scored.columns for col in key_cols + score_cols):
+        return df, df.iloc[0:0]
+
+    # Scores of each previously scored text and model version
+    df_prior = df_scored[key_cols + score_cols].drop_duplicates(subset=key_cols)
+
+    # Rows whose text and models are unchanged
+    row_keys = pd.MultiIndex.from_frame(df[key_cols].astype(str))
+    prior_keys = pd.MultiIndex.from_frame(df_prior[key_cols].astype(str))
+    is_scored = row_keys.isin(prior_keys)
+
+    # Copy the scores of unchanged rows
+    df_reused = df[is_scored].drop(columns=[col for col in score_cols if col in df.columns])
+    df_reused = df_reused.merge(df_prior.astype({col: str for col in key_cols}), on=key_cols, how="left")
+
+    return df[~is_scored], df_reused
@@ -0,0 +1,204 @@
+# Persistent cache of model outputs shared by the GVCEH scorers
+
+# Core python
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+
+class InferenceCache():
+    '''
+    SQLite cache of model outputs keyed on (model, text hash), so text already run
+    through a model - cross-posted submissions, tweets found by several queries,
+    repeated lines such as signatures - is not scored again.  The cache can be shared
+    by several scorers (and threads) as each model has its own key.
+
+    Texts are hashed exactly as they are sent to the model (tokenisers can keep extra
+    whitespace, so texts differing only in whitespace may score differently).  Outputs
+    are stored as JSON, so they need to be JSON serialisable (e.g. a label or a
+    dictionary of label and score).
+
+    The cache is bounded: once it holds more than max_entries outputs the least
+    recently used are removed, down to eviction_fraction below max_entries so
+    evictions happen in occasional batches.  The number of entries is kept as a
+    running count and only counted in the database before evicting (other processes
+    may share the cache).  Hits and misses are counted for each model.
+
+    Inputs:
+        __init__ :
+            db_file: Path to the SQLite database file (must be on local disk)
+            max_entries: Maximum number of cached outputs
+
+    Attributes:
+        conn: SQLite connection
+        hits: Dictionary of model to number of texts found in the cache
+        misses: Dictionary of model to number of texts not found in the cache
+        entry_count: Number of cached outputs
+        evictions: Number of outputs removed to keep the cache under max_entries
+
+    '''
+
+    # Number of hashes looked up in one query (SQLite limits query parameters)
+    lookup_chunk_size = 500
+
+    # Share of max_entries removed when the cache is full
+    eviction_fraction = 0.1
+
+    def __init__(self,
+                 db_file,
+                 max_entries=500000):
+        '''
+        Initialize the InferenceCache class.
+        '''
+
+        self.db_file = db_file
+        self.max_entries = max_entries
+
+        # Counters
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+        # Make sure the cache's folder exists
+        db_path = os.path.dirname(db_file)
+        if len(db_path) > 0:
+            os.makedirs(db_path, exist_ok=True)
+
+        # Scorers work in worker threads, one call at a time
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS inference_cache "
+                          "(model TEXT, text_hash TEXT, result TEXT, last_used REAL, "
+                          "PRIMARY KEY (model, text_hash)) WITHOUT ROWID")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS inference_cache_last_used ON inference_cache (last_used)")
+        self.conn.commit()
+
+        # Running count of cached outputs
+        self.entry_count = self.conn.execute("SELECT COUNT(*) FROM inference_cache").fetchone()[0]
+
+    def hash_text(self,
+                  text):
+        '''
+        Method to hash a text exactly as it is sent to the model
+        '''
+
+        return hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+
+    def predict(self,
+                model,
+                texts,
+                predict_fn):
+        '''
+        Method to get a model's outputs for a list of texts, running only texts not in
+        the cache (each distinct text once) through the model.
+
+        Inputs:
+            model: str
+                Identifier of the model (and version)
+            texts: list
+                Texts to score
+            predict_fn: function
+                Function taking a list of texts and returning a list of their outputs
+
+        Output:
+            List of outputs in the order of texts
+
+        '''
+
+        text_hashes = [self.hash_text(text) for text in texts]
+
+        # Look up cached outputs
+        cached = self.__lookup(model=model, text_hashes=text_hashes)
+
+        # Distinct texts missing from the cache
+        missing = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+
+        self.hits[model] = self.hits.get(model, 0) + len(texts) - len(missing)
+        self.misses[model] = self.misses.get(model, 0) + len(missing)
+
+        # Score the missing texts and cache their outputs
+        if len(missing) > 0:
+            results = predict_fn(list(missing.values()))
+            new_results = dict(zip(missing.keys(), results))
+            self.__store(model=model, results=new_results)
+            cached.update(new_results)
+
+        return [cached[text_hash] for text_hash in text_hashes]
+
+    def __lookup(self,
+                 model,
+                 text_hashes):
+        '''
+        Method to get the cached outputs of a model for a list of text hashes and mark
+        them as used
+
+        Output:
+            Dictionary of text hash to output
+
+        '''
+
+        found = {}
+        unique_hashes = list(set(text_hashes))
+
+        for chunk_start in range(0, len(unique_hashes), self.lookup_chunk_size):
+            chunk = unique_hashes[chunk_start: chunk_start + self.lookup_chunk_size]
+            cur = self.conn.execute("SELECT text_hash, result FROM inference_cache "
+                                    "WHERE model = ? AND text_hash IN ({})".format(",".join(["?"] * len(chunk))),
+                                    [model] + chunk)
+            for text_hash, result in cur.fetchall():
+                found[text_hash] = json.loads(result)
+
+        # Mark the cached outputs as recently used
+        if len(found) > 0:
+            last_used = time.time()
+            self.conn.executemany("UPDATE inference_cache SET last_used = ? WHERE model = ? AND text_hash = ?",
+                                  [(last_used, model, text_hash) for text_hash in found])
+            self.conn.commit()
+
+        return found
+
+    def __store(self,
+                model,
+                results):
+        '''
+        Method to cache a model's outputs and remove the least recently used outputs
+        once the cache is full
+
+        Input:
+            results: dict
+                Dictionary of text hash to output
+
+        '''
+
+        # Outputs cached meanwhile (e.g. by another process) are kept - they are for the same model and text
+        last_used = time.time()
+        cur = self.conn.executemany("INSERT OR IGNORE INTO inference_cache VALUES (?, ?, ?, ?)",
+                                    [(model, text_hash, json.dumps(result), last_used)
+                                     for text_hash, result in results.items()])
+        self.entry_count += cur.rowcount
+
+        # Remove the least recently used outputs once the cache is full
+        if self.entry_count > self.max_entries:
+            self.entry_count = self.conn.execute("SELECT COUNT(*) FROM inference_cache").fetchone()[0]
+
+            if self.entry_count > self.max_entries:
+                evict_count = self.entry_count - int(self.max_entries * (1 - self.eviction_fraction))
+                self.conn.execute("DELETE FROM inference_cache WHERE (model, text_hash) IN "
+                                  "(SELECT model, text_hash FROM inference_cache ORDER BY last_used LIMIT ?)",
+                                  (evict_count,))
+                self.entry_count -= evict_count
+                self.evictions += evict_count
+
+        self.conn.commit()
+
+    def close(self):
+        '''
+        Method to close the cache
+        '''
+
+        self.conn.close()
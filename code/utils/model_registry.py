@@ -0,0 +1,330 @@
+# Registry of the models used by the GVCEH scorers
+
+# Core python
+import os
+import json
+import threading
+
+# Models
+from transformers import pipeline
+from setfit import SetFitModel
+import joblib
+from huggingface_hub import HfApi
+from huggingface_hub.constants import HF_HUB_CACHE
+
+# GCP
+from google.cloud import storage
+from google.oauth2 import service_account
+
+
+# Models loaded by this process, shared by every registry
+loaded_models = {}
+
+# Local copies (and versions) of the model files used by this process
+model_files = {}
+
+# Revisions of the Hugging Face models used by this process
+hf_revisions = {}
+
+# Locks guarding the loading and use of each model
+model_locks = {}
+model_locks_lock = threading.Lock()
+
+
+class ModelRegistry():
+    '''
+    Registry loading the scoring models once per process, so scorers running in the
+    same process (e.g. the Reddit and X scorers, or the model server) share them.
+
+    Model files in GCP storage are downloaded to a local cache and reused for as long
+    as the GCS object's generation and ETag are unchanged.  Each file is checked once
+    per process.  Hugging Face models are cached on disk by Hugging Face itself; the
+    revision (commit hash) of each is resolved once per process and loaded, so the
+    model used always matches the version reported by get_hf_revision.
+
+    Calls to a model are made one at a time (a lock per model), as a model can be
+    shared by scorers working in different threads.
+
+    Inputs:
+        __init__ :
+            cache_path: Path to the local cache of model files downloaded from GCP storage
+            gcp_credentials: GCP service account credentials (JSON) used to read GCP storage
+
+    Attributes:
+        storage_client: GCP storage client, created when first needed
+
+    '''
+
+    def __init__(self,
+                 cache_path="../data/models/cache",
+                 gcp_credentials=""):
+        '''
+        Initialize the ModelRegistry class.
+        '''
+
+        self.cache_path = cache_path
+        self.gcp_credentials = gcp_credentials
+
+        self.storage_client = None
+
+    def get_lock(self,
+                 key):
+        '''
+        Method to get the lock guarding a model
+        '''
+
+        with model_locks_lock:
+            return model_locks.setdefault(key, threading.RLock())
+
+    def get_model(self,
+                  key,
+                  loader):
+        '''
+        Method to get a model, loading it with loader if this process has not loaded it yet
+
+        Inputs:
+            key: tuple
+                Key identifying the model (and version)
+            loader: function
+                Function without arguments returning the model
+
+        Output:
+            Model
+
+        '''
+
+        with self.get_lock(key):
+            if key not in loaded_models:
+                loaded_models[key] = loader()
+
+        return loaded_models[key]
+
+    def get_file_version(self,
+                         model_path,
+                         file_name):
+        '''
+        Method to get the version of a model file - its generation in GCP storage or its
+        modification time on local disk - without downloading it
+        '''
+
+        # Files already checked by this process
+        if (model_path, file_name) in model_files:
+            return model_files[(model_path, file_name)][1]
+
+        if model_path.startswith("gs://"):
+            return str(self.__get_blob(model_path=model_path, file_name=file_name).generation)
+
+        return str(os.path.getmtime(os.path.join(model_path, file_name)))
+
+    def get_hf_revision(self,
+                        hf_location):
+        '''
+        Method to get the revision (commit hash) of a Hugging Face model.  If the Hub
+        can't be reached the revision last downloaded to the Hugging Face cache is used.
+
+        Output:
+            Commit hash, or None if it is not known
+
+        '''
+
+        if hf_location not in hf_revisions:
+            try:
+                hf_revisions[hf_location] = HfApi().model_info(hf_location).sha
+
+            except Exception:
+
+                # Revision Hugging Face cached last
+                ref_file = os.path.join(HF_HUB_CACHE, "models--{}".format(hf_location.replace("/", "--")),
+                                        "refs", "main")
+                try:
+                    with open(ref_file, "r") as f:
+                        hf_revisions[hf_location] = f.read().strip()
+                except FileNotFoundError:
+                    hf_revisions[hf_location] = None
+
+        return hf_revisions[hf_location]
+
+    def get_hf_version(self,
+                       hf_location):
+        '''
+        Method to get the version of a Hugging Face model used in model versions and
+        inference cache keys (location and revision)
+        '''
+
+        return "{}@{}".format(hf_location, self.get_hf_revision(hf_location=hf_location) or "unknown")
+
+    def get_model_file(self,
+                       model_path,
+                       file_name):
+        '''
+        Method to get a local copy of a model file.  Files in GCP storage are downloaded
+        to the cache unless the cached copy has the same generation and ETag.
+
+        Output:
+            Tuple of (local file path, file version)
+
+        '''
+
+        # Files already checked by this process
+        if (model_path, file_name) in model_files:
+            return model_files[(model_path, file_name)]
+
+        # Local files are used where they are
+        if not model_path.startswith("gs://"):
+            model_files[(model_path, file_name)] = (os.path.join(model_path, file_name),
+                                                    self.get_file_version(model_path=model_path,
+                                                                          file_name=file_name))
+            return model_files[(model_path, file_name)]
+
+        blob = self.__get_blob(model_path=model_path, file_name=file_name)
+        blob_version = {"generation": blob.generation, "etag": blob.etag}
+
+        # Version of the cached copy
+        local_file = os.path.join(self.cache_path, blob.bucket.name, blob.name)
+        version_file = "{}.version.json".format(local_file)
+        try:
+            with open(version_file, "r") as f:
+                cached_version = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cached_version = None
+
+        # Download the file if it changed
+        if cached_version != blob_version or not os.path.exists(local_file):
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+
+            # Download then rename so a failed download never replaces the cached copy
+            temp_file = "{}.tmp".format(local_file)
+            blob.download_to_filename(temp_file, if_generation_match=blob.generation)
+            os.replace(temp_file, local_file)
+
+            with open(version_file, "w") as f:
+                json.dump(blob_version, f)
+
+        model_files[(model_path, file_name)] = (local_file, str(blob.generation))
+
+        return model_files[(model_path, file_name)]
+
+    def load_joblib_model(self,
+                          model_path,
+                          file_name):
+        '''
+        Method to get a model saved with joblib (e.g. the Reddit relevance model)
+
+        Output:
+            Tuple of (model, file version)
+
+        '''
+
+        local_file, version = self.get_model_file(model_path=model_path, file_name=file_name)
+
+        model = self.get_model(key=("joblib", local_file, version),
+                               loader=lambda: joblib.load(local_file))
+
+        return model, version
+
+    def load_setfit_model(self,
+                          hf_location):
+        '''
+        Method to get a SetFit model from Hugging Face (e.g. the X relevance model)
+        '''
+
+        revision = self.get_hf_revision(hf_location=hf_location)
+
+        return self.get_model(key=("setfit", hf_location, revision),
+                              loader=lambda: SetFitModel.from_pretrained(hf_location, revision=revision))
+
+    def load_sentiment_pipeline(self,
+                                hf_location):
+        '''
+        Method to get a sentiment analysis pipeline for a Hugging Face model.  Texts
+        longer than 512 tokens need to be truncated when calling the pipeline.
+        '''
+
+        revision = self.get_hf_revision(hf_location=hf_location)
+
+        def load_pipeline():
+            # -1 = cpu, 0 = gpu
+            sentiment_analyzer = pipeline(task="sentiment-analysis",
+                                          model=hf_location,
+                                          revision=revision,
+                                          device=-1)
+            sentiment_analyzer.tokenizer.model_max_length = 512
+
+            return sentiment_analyzer
+
+        return self.get_model(key=("sentiment", hf_location, revision),
+                              loader=load_pipeline)
+
+    def predict_joblib_setfit(self,
+                              model_path,
+                              file_name,
+                              texts):
+        '''
+        Method to predict with a SetFit model saved with joblib (the model's model attribute)
+
+        Output:
+            List of predictions in the order of the texts
+
+        '''
+
+        model, version = self.load_joblib_model(model_path=model_path, file_name=file_name)
+
+        with self.get_lock(("joblib", model_path, file_name)):
+            return [prediction.tolist() for prediction in model.model.predict(texts)]
+
+    def predict_setfit(self,
+                       hf_location,
+                       texts):
+        '''
+        Method to predict with a SetFit model from Hugging Face
+
+        Output:
+            List of predictions in the order of the texts
+
+        '''
+
+        model = self.load_setfit_model(hf_location=hf_location)
+
+        with self.get_lock(("setfit", hf_location)):
+            return model(texts).cpu().numpy().tolist()
+
+    def predict_sentiment(self,
+                          hf_location,
+                          texts,
+                          batch_size=32):
+        '''
+        Method to analyze sentiment with a Hugging Face pipeline
+
+        Output:
+            List of dictionaries of sentiment label and score in the order of the texts
+
+        '''
+
+        sentiment_analyzer = self.load_sentiment_pipeline(hf_location=hf_location)
+
+        with self.get_lock(("sentiment", hf_location)):
+            return [{"label": res["label"], "score": float(res["score"])}
+                    for res in sentiment_analyzer(texts, batch_size=batch_size, truncation=True)]
+
+    def __get_blob(self,
+                   model_path,
+                   file_name):
+        '''
+        Method to get the GCP storage object (with its metadata) of a model file
+        '''
+
+        # Get bucket name and object name from model path
+        bucket_name, _, folder = model_path[len("gs://"):].partition("/")
+        blob_name = "/".join([part for part in [folder.strip("/"), file_name] if len(part) > 0])
+
+        # Set up GCP storage client
+        if self.storage_client is None:
+            json_acct_info = json.loads(self.gcp_credentials)
+            credentials = service_account.Credentials.from_service_account_info(json_acct_info)
+            self.storage_client = storage.Client(credentials=credentials, project=json_acct_info["project_id"])
+
+        blob = self.storage_client.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise RuntimeError("Model file not found: {}/{}".format(model_path, file_name))
+
+        return blob
@@ -0,0 +1,158 @@
+# Local scoring server keeping the GVCEH scoring models loaded between runs
+
+# Core python
+import json
+
+# Serving
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import request as urlrequest
+from urllib.error import URLError
+
+
+class ModelServer():
+    '''
+    Long lived HTTP server, listening on localhost only, that keeps the scoring models
+    loaded so scorers started by later runs don't pay the model start up time.
+
+    The server runs named predictors - functions taking a list of texts and returning
+    a list of JSON serialisable outputs:
+
+        GET  /health           - {"models": {name: version}}
+        POST /predict/<name>   - {"texts": [...]} returns {"results": [...]}
+
+    Inputs:
+        __init__ :
+            predictors: Dictionary of predictor name to function
+            versions: Dictionary of predictor name to model version
+            host: Host name to listen on
+            port: Port to listen on
+
+    Attributes:
+        httpd: HTTP server
+
+    '''
+
+    def __init__(self,
+                 predictors,
+                 versions,
+                 host="127.0.0.1",
+                 port=8765):
+        '''
+        Initialize the ModelServer class.
+        '''
+
+        self.predictors = predictors
+        self.versions = versions
+
+        server = self
+
+        class ModelRequestHandler(BaseHTTPRequestHandler):
+            '''
+            Handler for model server requests
+            '''
+
+            def do_GET(self):
+                if self.path != "/health":
+                    self.send_error(404)
+                    return
+
+                self.__send_json({"models": server.versions})
+
+            def do_POST(self):
+                name = self.path[len("/predict/"):] if self.path.startswith("/predict/") else None
+                if name not in server.predictors:
+                    self.send_error(404)
+                    return
+
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    results = server.predictors[name](body["texts"])
+
+                except Exception as e:
+                    self.send_error(500, explain=str(e))
+                    return
+
+                self.__send_json({"results": results})
+
+            def __send_json(self,
+                            content):
+                data = json.dumps(content).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                # Keep request logs off the screen
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), ModelRequestHandler)
+
+    def serve_forever(self):
+        '''
+        Method to serve requests until shutdown is called
+        '''
+
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        '''
+        Method to stop the server
+        '''
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ModelServerClient():
+    '''
+    Client used by the scorers to run models on a ModelServer
+
+    Inputs:
+        __init__ :
+            url: URL of the model server (e.g. http://127.0.0.1:8765)
+            timeout: Seconds to wait for a response
+
+    '''
+
+    def __init__(self,
+                 url,
+                 timeout=600):
+        '''
+        Initialize the ModelServerClient class.
+        '''
+
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def get_versions(self):
+        '''
+        Method to get the versions of the models served, or None if the server can't be reached
+        '''
+
+        try:
+            with urlrequest.urlopen("{}/health".format(self.url), timeout=5) as response:
+                return json.loads(response.read())["models"]
+
+        except (URLError, OSError, ValueError):
+            return None
+
+    def predict(self,
+                name,
+                texts):
+        '''
+        Method to run a predictor on the server
+
+        Output:
+            List of outputs in the order of the texts
+
+        '''
+
+        req = urlrequest.Request("{}/predict/{}".format(self.url, name),
+                                 data=json.dumps({"texts": list(texts)}).encode("utf-8"),
+                                 headers={"Content-Type": "application/json"},
+                                 method="POST")
+
+        with urlrequest.urlopen(req, timeout=self.timeout) as response:
+            return json.loads(response.read())["results"]
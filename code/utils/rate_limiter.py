@@ -0,0 +1,345 @@
+# API rate limiting shared by the GVCEH data fetchers
+
+# Core python
+import time
+import random
+
+# Asynchronous work
+import asyncio
+
+
+class AsyncRateLimiter():
+    '''
+    Asyncio token bucket used to keep API calls within a rate limit.  The bucket
+    holds up to call_limit tokens and refills continuously at call_limit tokens per
+    window_seconds.  Each API call takes one token and acquire only waits when the
+    bucket is empty, so calls run at full speed while there is budget left.
+
+    One limiter can be shared by any number of concurrent tasks; waiting tasks are
+    served in the order they arrived.
+
+    When the API reports its own rate limit state (remaining calls and seconds until
+    the window resets) the limiter can be synced to it with sync_with_server.  Each
+    response is only synced once, and the budget is never raised above the local
+    estimate, so calls made since the server's count are not forgotten.
+
+    Inputs:
+        __init__ :
+            call_limit: Maximum number of API calls within the rate limit window
+            window_seconds: Length of the rate limit window in seconds
+
+    Attributes:
+        capacity: Maximum number of tokens held by the bucket
+        refill_rate: Tokens added per second
+        tokens: Tokens currently available
+        blocked_until: Monotonic time before which no calls may be made
+        call_count: Number of calls made through the limiter
+        wait_count: Number of times a call had to wait for budget
+
+    '''
+
+    def __init__(self,
+                 call_limit,
+                 window_seconds):
+        '''
+        Initialize the AsyncRateLimiter class.
+        '''
+
+        # Bucket size and refill rate
+        self.capacity = float(call_limit)
+        self.refill_rate = float(call_limit) / float(window_seconds)
+
+        # Start with a full bucket
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+        # Response whose rate limit state was last synced
+        self.synced_response_id = None
+
+        # Counters
+        self.call_count = 0
+        self.wait_count = 0
+
+        # Lock serving waiting tasks in arrival order
+        self.lock = asyncio.Lock()
+
+    def __refill(self):
+        '''
+        Method to add the tokens earned since the last update
+        '''
+
+        now = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        '''
+        Method to wait until an API call can be made and take a token for it.
+
+        Output:
+            Number of seconds spent waiting (0 if budget was available)
+
+        '''
+
+        waited = 0.0
+
+        async with self.lock:
+
+            while True:
+
+                # Bring the bucket up to date
+                self.__refill()
+                now = time.monotonic()
+
+                # The server told us to stop until its window resets
+                if now < self.blocked_until:
+                    wait_time = self.blocked_until - now
+
+                # Budget available - take a token
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.call_count += 1
+                    if waited > 0:
+                        self.wait_count += 1
+                    return waited
+
+                # Otherwise wait for the next token
+                else:
+                    wait_time = (1 - self.tokens) / self.refill_rate
+
+                await asyncio.sleep(wait_time)
+                waited += wait_time
+
+    def sync_with_server(self,
+                         remaining,
+                         reset_seconds,
+                         response_id=None):
+        '''
+        Method to sync the local budget estimate with the rate limit state reported by
+        the API.  The state of a response already synced is ignored - syncing it again
+        would bring back the calls spent since.  The lower of the local and server
+        budgets is kept, as calls still in flight are not in the server's count yet.
+
+        Inputs:
+            remaining: float
+                Number of calls the server still allows in the current window
+            reset_seconds: float
+                Seconds until the server's window resets
+            response_id: hashable
+                Value identifying the response the state came from (None to always sync)
+
+        '''
+
+        # Ignore missing header values
+        if remaining is None or reset_seconds is None:
+            return
+
+        # Only sync each response once
+        if response_id is not None and response_id == self.synced_response_id:
+            return
+        self.synced_response_id = response_id
+
+        self.__refill()
+
+        # Keep the lower of the local and server budgets
+        self.tokens = min(self.tokens, max(0.0, float(remaining)))
+
+        # If nothing is left, hold all calls until the server's window resets
+        if self.tokens < 1:
+            self.blocked_until = time.monotonic() + max(0.0, float(reset_seconds))
+
+        else:
+            self.blocked_until = 0.0
+
+
+class EndpointRateController():
+    '''
+    Rate controller for APIs that report their rate limit state in response headers
+    (x-rate-limit-limit, x-rate-limit-remaining and x-rate-limit-reset, as the X API
+    does).  Each endpoint has its own budget, since the API counts calls to each
+    endpoint separately.
+
+    Calls are made through three steps:
+
+        wait_time = controller.reserve(endpoint)       - sleep this long, then call
+        controller.update(endpoint, response.headers)  - after a successful call
+        controller.backoff(endpoint, attempt, headers) - after a 429 response
+
+    The controller only works out wait times and never sleeps itself, so the same
+    controller serves blocking (time.sleep) and asyncio (asyncio.sleep) callers.
+    Endpoints whose limits are not known yet (no response seen) are not held back.
+
+    Inputs:
+        __init__ :
+            reset_margin: Seconds added to the server's reset time before calling again
+            backoff_base: Base wait in seconds for 429 backoff (also the maximum jitter)
+            backoff_max: Maximum wait in seconds for 429 backoff without a reset header
+
+    Attributes:
+        endpoints: Dictionary of endpoint to its rate limit state
+        call_count: Number of calls made through the controller
+        wait_count: Number of calls that had to wait for budget
+        backoff_count: Number of 429 responses handled
+
+    '''
+
+    def __init__(self,
+                 reset_margin=1.0,
+                 backoff_base=2.0,
+                 backoff_max=900.0):
+        '''
+        Initialize the EndpointRateController class.
+        '''
+
+        self.reset_margin = reset_margin
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Rate limit state of each endpoint
+        self.endpoints = {}
+
+        # Counters
+        self.call_count = 0
+        self.wait_count = 0
+        self.backoff_count = 0
+
+    def __get_state(self,
+                    endpoint):
+        '''
+        Method to get an endpoint's rate limit state, creating it if needed
+        '''
+
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {"limit": None,
+                                        "remaining": None,
+                                        "reset_at": 0.0,
+                                        "blocked_until": 0.0}
+
+        return self.endpoints[endpoint]
+
+    def reserve(self,
+                endpoint):
+        '''
+        Method to take one call from an endpoint's budget.
+
+        Input:
+            endpoint: str
+                Endpoint (e.g. API route) called
+
+        Output:
+            Number of seconds to wait before making the call
+
+        '''
+
+        state = self.__get_state(endpoint)
+        now = time.time()
+
+        # The server's window has reset since the last response - the budget is back
+        if state["remaining"] is not None and 0 < state["reset_at"] <= now:
+            state["remaining"] = state["limit"]
+            state["reset_at"] = 0.0
+
+        # Wait out any hold from a 429 or an exhausted window
+        wait_time = max(0.0, state["blocked_until"] - now)
+
+        if state["remaining"] is not None:
+
+            # Budget used up - hold calls until the window resets, then start a full budget
+            if state["remaining"] < 1:
+                reset_at = state["reset_at"] if state["reset_at"] > now else now + self.backoff_base
+                state["blocked_until"] = max(state["blocked_until"], reset_at + self.reset_margin)
+                wait_time = state["blocked_until"] - now
+                state["remaining"] = state["limit"] or 1
+                state["reset_at"] = 0.0
+
+            state["remaining"] -= 1
+
+        # Counters
+        self.call_count += 1
+        if wait_time > 0:
+            self.wait_count += 1
+
+        return wait_time
+
+    def update(self,
+               endpoint,
+               headers):
+        '''
+        Method to update an endpoint's budget from the rate limit headers of a response
+
+        Inputs:
+            endpoint: str
+                Endpoint (e.g. API route) called
+            headers: dict
+                Response headers
+
+        '''
+
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        limit = headers.get("x-rate-limit-limit")
+
+        # Ignore responses without rate limit headers
+        if remaining is None or reset is None:
+            return
+
+        state = self.__get_state(endpoint)
+
+        if limit is not None:
+            state["limit"] = int(limit)
+
+        # Responses to concurrent calls can arrive out of order - keep the lowest count seen in a window
+        reset_at = float(reset)
+        if reset_at == state["reset_at"] and state["remaining"] is not None:
+            state["remaining"] = min(state["remaining"], int(remaining))
+        else:
+            state["remaining"] = int(remaining)
+        state["reset_at"] = reset_at
+
+    def backoff(self,
+                endpoint,
+                attempt,
+                headers=None):
+        '''
+        Method to hold an endpoint's calls after a 429 (too many requests) response.
+        Calls wait until the reset time given in the headers or, without one, for an
+        exponentially growing time.  A random jitter keeps concurrent callers from
+        retrying together.
+
+        Inputs:
+            endpoint: str
+                Endpoint (e.g. API route) called
+            attempt: int
+                Number of retries already made for this call
+            headers: dict
+                Headers of the 429 response
+
+        Output:
+            Number of seconds calls to the endpoint are held
+
+        '''
+
+        state = self.__get_state(endpoint)
+        now = time.time()
+
+        self.backoff_count += 1
+
+        # Wait until the server's window resets if it says when that is
+        reset = None if headers is None else headers.get("x-rate-limit-reset")
+        if reset is not None:
+            wait_time = max(0.0, float(reset) - now) + self.reset_margin
+            state["remaining"] = None
+            state["reset_at"] = 0.0
+
+        # Otherwise back off exponentially
+        else:
+            wait_time = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+
+        # Jitter
+        wait_time += random.uniform(0, self.backoff_base)
+
+        state["blocked_until"] = max(state["blocked_until"], now + wait_time)
+
+        return state["blocked_until"] - now
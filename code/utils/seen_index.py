@@ -0,0 +1,143 @@
+# Persistent index of post IDs already fetched by the GVCEH data fetchers
+
+# Core python
+import os
+import sqlite3
+
+
+class SeenIdIndex():
+    '''
+    On-disk index of the post IDs a fetcher has already stored, kept in an SQLite
+    table keyed on (source, id).  IDs are stored as 64 bit integers: tweet IDs are
+    already integers and Reddit's base 36 submission IDs are converted (id_base=36).
+
+    Opening the index does not load it, so start up time does not grow with the
+    history, and each lookup is a primary key search.  The index behaves like a set
+    for the fetch loops:
+
+        submission.id in index     - True if stored or claimed during this run
+        index.add(submission.id)   - claim an ID for this run (kept in memory)
+        index.persist(ids)         - record IDs once their rows have been saved
+        index.is_persisted(id)     - True only if stored (ignores IDs claimed in this run)
+
+    Claimed IDs are only written to disk by persist, so a run that fails before
+    saving its rows does not hide those posts from the next run.
+
+    Inputs:
+        __init__ :
+            db_file: Path to the SQLite database file
+            source: Name of the data source using the index (e.g. reddit or xtwitter)
+            id_base: Base of string IDs (36 for Reddit, 10 for X)
+
+    Attributes:
+        conn: SQLite connection
+        claimed: IDs claimed during this run but not yet persisted
+
+    '''
+
+    def __init__(self,
+                 db_file,
+                 source,
+                 id_base=10):
+        '''
+        Initialize the SeenIdIndex class.
+        '''
+
+        self.db_file = db_file
+        self.source = source
+        self.id_base = id_base
+
+        # IDs claimed in this run
+        self.claimed = set()
+
+        # Make sure the index's folder exists
+        db_path = os.path.dirname(db_file)
+        if len(db_path) > 0:
+            os.makedirs(db_path, exist_ok=True)
+
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen_ids "
+                          "(source TEXT, id INTEGER, PRIMARY KEY (source, id)) WITHOUT ROWID")
+        self.conn.commit()
+
+    def __to_key(self,
+                 item_id):
+        '''
+        Method to convert a post ID to the integer stored in the index
+        '''
+
+        if isinstance(item_id, str):
+            return int(item_id.strip(), self.id_base)
+
+        return int(item_id)
+
+    def __contains__(self,
+                     item_id):
+        '''
+        Method to check if an ID has been stored or claimed
+        '''
+
+        key = self.__to_key(item_id)
+
+        if key in self.claimed:
+            return True
+
+        cur = self.conn.execute("SELECT 1 FROM seen_ids WHERE source = ? AND id = ?",
+                                (self.source, key))
+
+        return cur.fetchone() is not None
+
+    def is_persisted(self,
+                     item_id):
+        '''
+        Method to check if an ID has been stored, ignoring IDs only claimed during this run
+        '''
+
+        cur = self.conn.execute("SELECT 1 FROM seen_ids WHERE source = ? AND id = ?",
+                                (self.source, self.__to_key(item_id)))
+
+        return cur.fetchone() is not None
+
+    def is_empty(self):
+        '''
+        Method to check if no IDs have been stored for this source yet
+        '''
+
+        cur = self.conn.execute("SELECT 1 FROM seen_ids WHERE source = ? LIMIT 1", (self.source,))
+
+        return cur.fetchone() is None
+
+    def add(self,
+            item_id):
+        '''
+        Method to claim an ID for this run
+        '''
+
+        self.claimed.add(self.__to_key(item_id))
+
+    def persist(self,
+                item_ids):
+        '''
+        Method to record IDs whose rows have been saved
+
+        Input:
+            item_ids: iterable
+                IDs to record
+
+        '''
+
+        keys = [self.__to_key(item_id) for item_id in item_ids]
+
+        self.conn.executemany("INSERT OR IGNORE INTO seen_ids VALUES (?, ?)",
+                              [(self.source, key) for key in keys])
+        self.conn.commit()
+
+        self.claimed.difference_update(keys)
+
+    def close(self):
+        '''
+        Method to close the index
+        '''
+
+        self.conn.close()
@@ -0,0 +1,82 @@
+# Rate controlled version of tweepy's asynchronous client, used by GVCEHXTwitter.batch_scrape_async
+# (kept apart so the fetcher imports without tweepy's async extras - aiohttp and async-lru)
+
+# Asynchronous work
+import asyncio
+
+import tweepy as tw
+from tweepy.asynchronous import AsyncClient
+
+
+class AsyncRateControlledClient(AsyncClient):
+    '''
+    Asynchronous version of RateControlledClient built on tweepy's AsyncClient.  Waits
+    use asyncio.sleep, so other tasks keep running while a request waits for its
+    endpoint's budget.  A rate controller can be shared with a RateControlledClient.
+
+    Inputs:
+        __init__ :
+            rate_controller: EndpointRateController shared by the client's requests
+            max_retries: Maximum number of retries of a request after 429 responses
+            wait_callback: Function called with (endpoint, wait_time, event) before waiting
+            Other arguments are passed to tweepy.asynchronous.AsyncClient
+
+    '''
+
+    def __init__(self,
+                 rate_controller,
+                 max_retries=3,
+                 wait_callback=None,
+                 **kwargs):
+        '''
+        Initialize the AsyncRateControlledClient class.
+        '''
+
+        super().__init__(**kwargs)
+
+        self.rate_controller = rate_controller
+        self.max_retries = max_retries
+        self.wait_callback = wait_callback
+
+    async def request(self,
+                      method,
+                      route,
+                      *args,
+                      **kwargs):
+        '''
+        Method to make a rate controlled request to the API
+        '''
+
+        attempt = 0
+        while True:
+
+            # Wait for the endpoint's budget
+            wait_time = self.rate_controller.reserve(endpoint=route)
+            if wait_time > 0:
+                if self.wait_callback is not None:
+                    self.wait_callback(route, wait_time, 'rate limit reached')
+                await asyncio.sleep(wait_time)
+
+            try:
+                response = await super().request(method, route, *args, **kwargs)
+
+            except tw.TooManyRequests as e:
+
+                # Give up after max_retries
+                if attempt >= self.max_retries:
+                    raise
+
+                # Hold the endpoint's calls before retrying
+                wait_time = self.rate_controller.backoff(endpoint=route,
+                                                         attempt=attempt,
+                                                         headers=e.response.headers)
+                if self.wait_callback is not None:
+                    self.wait_callback(route, wait_time, 'too many requests')
+
+                attempt += 1
+                continue
+
+            # Update the endpoint's budget from the response
+            self.rate_controller.update(endpoint=route, headers=response.headers)
+
+            return response
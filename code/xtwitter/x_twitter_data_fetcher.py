@@ -1,23 +1,112 @@
 
-import os
+import os, sys
 import time
-from collections import deque
+import re
 
 from datetime import datetime, timedelta
 
 # Logging and monitoring
 import logging
 
+# Asynchronous work
+import asyncio
+
 import tweepy as tw
 import pandas as pd
 
+# GVCEH objects
+# Utilities folder, found from this file so the standalone scrapers (run from their own folder) can import it too
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import seen_index as si
+import checkpoint as cp
+import column_buffer as cb
+import fetch_state as fs
+import rate_limiter as rl
+
+
+class RateControlledClient(tw.Client):
+    '''
+    Tweepy client whose requests go through an EndpointRateController.  Each request
+    waits for its endpoint's budget, the budget is updated from the response's rate
+    limit headers, and 429 (too many requests) responses are retried after a jittered
+    backoff up to max_retries times.
+
+    Inputs:
+        __init__ :
+            rate_controller: EndpointRateController shared by the client's requests
+            max_retries: Maximum number of retries of a request after 429 responses
+            wait_callback: Function called with (endpoint, wait_time, event) before waiting
+            Other arguments are passed to tweepy.Client
+
+    '''
+
+    def __init__(self,
+                 rate_controller,
+                 max_retries=3,
+                 wait_callback=None,
+                 **kwargs):
+        '''
+        Initialize the RateControlledClient class.
+        '''
+
+        super().__init__(**kwargs)
+
+        self.rate_controller = rate_controller
+        self.max_retries = max_retries
+        self.wait_callback = wait_callback
+
+    def request(self,
+                method,
+                route,
+                *args,
+                **kwargs):
+        '''
+        Method to make a rate controlled request to the API
+        '''
+
+        attempt = 0
+        while True:
+
+            # Wait for the endpoint's budget
+            wait_time = self.rate_controller.reserve(endpoint=route)
+            if wait_time > 0:
+                if self.wait_callback is not None:
+                    self.wait_callback(route, wait_time, 'rate limit reached')
+                time.sleep(wait_time)
+
+            try:
+                response = super().request(method, route, *args, **kwargs)
+
+            except tw.TooManyRequests as e:
+
+                # Give up after max_retries
+                if attempt >= self.max_retries:
+                    raise
+
+                # Hold the endpoint's calls before retrying
+                wait_time = self.rate_controller.backoff(endpoint=route,
+                                                         attempt=attempt,
+                                                         headers=e.response.headers)
+                if self.wait_callback is not None:
+                    self.wait_callback(route, wait_time, 'too many requests')
+
+                attempt += 1
+                continue
+
+            # Update the endpoint's budget from the response
+            self.rate_controller.update(endpoint=route, headers=response.headers)
+
+            return response
+
+
 class GVCEHXTwitter():
     '''
     Class to handle Twitter API calls for the GVCEH project.
 
     Primary output is the tweet file found in the tweets file path. New data are appended to this file
     every time the batch scrape is run. Note that the logic within the fetch_data excludes any submission IDs
-    already existing in the tweets output file.
+    already existing in the tweets output file, using a persistent index of fetched tweet IDs kept in the
+    store file path (see utils/seen_index.py).
 
     As of Mar 2024, access to X's full-archive search using the API is limited to Pro and Enterprise plans which
     start at $5,000/month. Since it's unlikely that this accounts using this wrapper have that level of access
@@ -42,7 +131,7 @@ class GVCEHXTwitter():
             fetch_logging: True if logging should be one
 
     Outputs:
-        batch_scrape:
+        batch_scrape (or batch_scrape_async):
             Posts files found in the posts_file_path
             Log files found in the logs_file_path
 
@@ -50,21 +139,33 @@ class GVCEHXTwitter():
         tweets_file_path: Path to the retrieved posts or submissions
         logs_file_path: Path to the logs captured during retrieval
         keywords_file_path: Path to the CSV files with keyword search terms
+        store_file_path: Path to the index of fetched tweet IDs (must be on local disk)
+        tweets_file_name: Name of the tweets file
+        seen_index_file_name: Name of the file with the index of fetched tweet IDs
+        checkpoint_file_name: Name of the checkpoint file of an unfinished batch scrape
+        checkpoint_max_age: Age after which an unfinished batch scrape's checkpoint is no longer resumed
+        file_update_trigger: Number of new tweets triggering a checkpoint
 
         hashtags_file_name: File containing hashtag or other key search terms
         keywords_file_name: File containing keywords
 
         search_qualifiers: Addition search qualifiers beyond search terms and keywords
 
-        max_tweets: Maximum returned tweets
+        max_tweets: Maximum returned tweets per page
+        max_pages: Maximum number of pages of results read per query
+        incremental_search: True to only request tweets newer than each query's high-water mark
+        fetch_state_file_name: Name of the file with the queries' high-water marks and resume points
         max_query_length: Maximum length allowed for a query on the Twitter API
         query_start_at: Index of first query from query cache to start the batch_scrape
-        api_call_limit: Maximum number of API calls over the rate_limit_window
-        rate_limit_window: Time window over which API calls are counted
-        api_sleep_time: Sleep time between API calls if there is no pause
+        fetch_concurrency: Maximum number of queries in flight at once in batch_scrape_async
+        row_queue: Optional asyncio.Queue receiving the lists of new tweets as they are fetched by
+                   batch_scrape_async (for streaming scoring)
+        max_retries: Maximum number of retries of an API call after 429 (too many requests) responses
 
-        api_call_times: A doubly ended queue store of timestamps for all API calls
-        pause_indexes: A doubly ended queue store of timestamps indexes at which API fetching was paused
+        rate_controller: Rate controller tracking each API endpoint's limits from the response headers
+        client: Tweepy client used by batch_scrape
+        async_client: Tweepy asynchronous client used by batch_scrape_async (shares the rate controller),
+                      created and closed by each batch_scrape_async
 
         tweet_fields: Tweet fields to return from API calls
         user_fields: User fields to return from API calls
@@ -84,6 +185,23 @@ class GVCEHXTwitter():
     tweets_file_path = "../../data/xtwitter/tweets"
     logs_file_path = "../../data/xtwitter/logs"
     keywords_file_path = "../../data/keywords"
+    store_file_path = "../../data/xtwitter/store"
+
+    # Tweets file
+    tweets_file_name = "xtwitter_tweets.csv"
+
+    # Index of fetched tweet IDs
+    seen_index_file_name = "seen_ids.db"
+
+    # Query high-water marks
+    fetch_state_file_name = "fetch_state.db"
+
+    # Checkpoint of an unfinished batch scrape
+    checkpoint_file_name = "xtwitter_checkpoint.json"
+    checkpoint_max_age = timedelta(days=1)
+
+    # Number of new tweets triggering a checkpoint
+    file_update_trigger = 500
 
     # Input files
     hashtags_file_name = "hashtags_other.csv"
@@ -94,22 +212,24 @@ class GVCEHXTwitter():
 
     ### setting up the config
     max_tweets = 100
+    max_pages = 5
+
+    # Only fetch tweets newer than those found by the last batch scrape
+    incremental_search = True
 
     # Max query length allowed by Twitter API
     max_query_length = 512
 
     query_start_at = 0
 
-    # API Rate limits
-    api_call_limit = 15
-    rate_limit_window = timedelta(minutes=15)
+    # Maximum number of queries in flight at once in batch_scrape_async
+    fetch_concurrency = 4
 
-    # Sleep between API calls (seconds) if there's no pause
-    api_sleep_time = 2.5
+    # Queue receiving new tweets for streaming scoring (None if not streaming)
+    row_queue = None
 
-    # Store timestamps of all API calls
-    api_call_times = deque()
-    pause_indexes = deque()
+    # API Rate limits - read from the API's response headers, with retries after 429 responses
+    max_retries = 3
 
     # API return fields
     tweet_fields = ["context_annotations", "public_metrics", "created_at",
@@ -148,12 +268,24 @@ class GVCEHXTwitter():
         # Update any key word args
         self.__dict__.update(kwargs)
         
-        # establish a tweepy client
-        self.client = tw.Client(bearer_token=bearer_token,
-                                consumer_key=consumer_key,
-                                consumer_secret=consumer_secret,
-                                access_token=access_token,
-                                access_token_secret=access_token_secret)
+        # establish a tweepy client with its calls managed by a rate controller
+        self.rate_controller = rl.EndpointRateController()
+        self.client = RateControlledClient(rate_controller=self.rate_controller,
+                                           max_retries=self.max_retries,
+                                           wait_callback=self.__log_rate_wait,
+                                           bearer_token=bearer_token,
+                                           consumer_key=consumer_key,
+                                           consumer_secret=consumer_secret,
+                                           access_token=access_token,
+                                           access_token_secret=access_token_secret)
+
+        # Credentials of the asynchronous client, created by batch_scrape_async
+        self.async_client = None
+        self.async_client_credentials = {"bearer_token": bearer_token,
+                                         "consumer_key": consumer_key,
+                                         "consumer_secret": consumer_secret,
+                                         "access_token": access_token,
+                                         "access_token_secret": access_token_secret}
 
         # Set start and end times if not None
         if type(start_time) != type(None) or type(end_time) != type(None):
@@ -173,15 +305,19 @@ class GVCEHXTwitter():
         '''
         Method to create a cache of queries to use with the Twitter API. Note that the
         resulting queries will be in this format:
-            (hashtag or other key search term) (keyword1 OR keyword2) lang:en -is:retweet'
+            (hashtag1 OR hashtag2) (keyword1 OR keyword2) lang:en -is:retweet'
 
         For example,
-            (#victoriabc) (housing insecure OR encampment OR homeless OR homelessness OR housing
-            OR shelter OR unhoused OR violence OR home OR affordable housing OR drugs OR evict
-            OR poor OR poverty OR social housing OR substance use OR tent OR addict/addicted OR
-            affordable OR alcoholic OR camp OR camper OR camping OR collude OR crime OR low-income
-            OR narcotics OR overdose OR social problem OR social structure OR stolen OR theft OR thief)
-            lang:en -is:retweet'
+            (#victoriabc OR #yyj OR #bcpoli) (housing insecure OR encampment OR homeless OR
+            homelessness OR housing OR shelter OR unhoused OR violence OR home OR affordable
+            housing OR drugs OR evict OR poor OR poverty OR social housing) lang:en -is:retweet'
+
+        Every hashtag (or other key search term) is searched with every keyword, so the
+        queries are the combinations of a group of hashtags and a group of keywords.  The
+        terms are bin-packed (first fit decreasing) into the groups, and the split of the
+        query length between hashtags and keywords giving the fewest queries is used.
+        Query lengths are measured on the final query strings, so no query is longer than
+        max_query_length.
 
         Key parameters
             max_query_length: Maximum length allowed for a query on the Twitter API
@@ -189,42 +325,68 @@ class GVCEHXTwitter():
 
         '''
 
-        def split_keywords(kwlist: list,
-                           join_str: str,
-                           max_len: int):
+        def pack_terms(terms: list,
+                       join_str: str,
+                       max_len: int):
             '''
-            Function to split keywords into sublists that will
-            keep the API search queries under the maximum length.
+            Function to bin-pack search terms into the fewest groups whose joined length
+            is at most max_len, using first fit decreasing.
 
             Inputs:
-                kwlist: list
-                    List of keyword search terms
+                terms: list
+                    List of search terms
                 join_str: str
                     The string that will join these terms in the search query (e.g. " OR ")
                 max_len: int
-                    The maximum length of this search phrase (e.g. Max Query length - less other phrases)
+                    The maximum length of this search phrase
+
+            Output:
+                List of groups (lists of terms, in their original order) or None if a term
+                is longer than max_len
 
             '''
 
             join_len = len(join_str)
 
-            # Initial values
-            length = 0
-            this_list = []
+            # Each term takes its length plus a join, as does the bin (for the missing last join)
+            groups = []
+            group_lens = []
+            for term in sorted(terms, key=len, reverse=True):
+                if len(term) > max_len:
+                    return None
+
+                for i in range(len(groups)):
+                    if group_lens[i] + join_len + len(term) <= max_len:
+                        groups[i].append(term)
+                        group_lens[i] += join_len + len(term)
+                        break
 
-            # Loop through keywords counting length
-            # Once it's loinger than max yield the list
-            for kw in kwlist:
-                length = length + len(kw) + join_len
-                if length < max_len:
-                    this_list.append(kw)
                 else:
-                    yield this_list
-                    length = 0
-                    this_list = [kw]
+                    groups.append([term])
+                    group_lens.append(len(term))
+
+            # Keep the terms in their original order
+            return [sorted(group, key=terms.index) for group in groups]
+
+        def clean_term(term: str):
+            '''
+            Function to remove unwanted characters from a search term
+            '''
+
+            term = term.replace("&", "")
+            term = " {} ".format(term).replace(" and ", ' "and" ').strip()
+
+            return term
 
-            if this_list == kwlist:
-                yield kwlist
+        def build_query(hashtag_group: list,
+                        keyword_group: list):
+            '''
+            Function to build a query from a group of hashtags and a group of keywords
+            '''
+
+            return "({}) ({}) {}".format(" OR ".join(hashtag_group),
+                                         " OR ".join(keyword_group),
+                                         qualstr)
 
         try:
 
@@ -236,32 +398,48 @@ class GVCEHXTwitter():
             df = pd.read_csv(os.path.join(self.keywords_file_path, self.keywords_file_name), index_col=0)
             keywords = df[df.columns[0]].str.strip().str.lower().unique().tolist()
 
+            # remove unwanted characters
+            hashtags = [clean_term(ht) for ht in hashtags]
+            keywords = [clean_term(kw) for kw in keywords]
+
             # Create a phrase for extra search qualifiers beyond search terms
             qualstr = " ".join(self.search_qualifiers)
 
-            # Create sublists
-            keyword_splits = [k for k in split_keywords(kwlist=keywords,
-                                                        join_str=" OR",
-                                                        max_len=self.max_query_length - len(qualstr))]
+            # Length left for the hashtags and keywords once brackets and qualifiers are added
+            terms_len = self.max_query_length - len(build_query([], []))
+
+            # Try each split of the length between hashtags and keywords - keep the one with fewest queries
+            best_groups = None
+            for hashtag_len in range(1, terms_len):
+                hashtag_groups = pack_terms(terms=hashtags, join_str=" OR ", max_len=hashtag_len)
+                keyword_groups = pack_terms(terms=keywords, join_str=" OR ", max_len=terms_len - hashtag_len)
+
+                if hashtag_groups is None or keyword_groups is None:
+                    continue
+
+                query_cnt = len(hashtag_groups) * len(keyword_groups)
+                if best_groups is None or query_cnt < len(best_groups[0]) * len(best_groups[1]):
+                    best_groups = (hashtag_groups, keyword_groups)
+
+            if best_groups is None:
+                raise ValueError("Search terms too long for max_query_length")
+
             # Create the query cache
             self.query_cache = []
-            for ht in hashtags:
-                for kws in keyword_splits:
-                    kwstr = " OR ".join([k.lower().strip() for k in kws])
-                    q = "({}) ({}) {}".format(ht,
-                                              kwstr,
-                                              qualstr)
+            for hashtag_group in best_groups[0]:
+                for keyword_group in best_groups[1]:
+                    q = build_query(hashtag_group, keyword_group)
 
-                    # remove unwanted characters
-                    q = q.replace("&", "")
-                    q = q.replace(" and ", ' "and" ')
+                    # Log the query's length and size
+                    self.__log_event(msg_id=1, screen_print=False, event='query planned', query_len=len(q),
+                                     hashtag_cnt=len(hashtag_group), keyword_cnt=len(keyword_group))
 
-                    # print(len(q))
-                    self.query_cache.append((q, ht))
+                    self.query_cache.append((q, ", ".join(hashtag_group)))
 
             # Log file found
             self.__log_event(msg_id=1, screen_print=False, event='query cache created',
-                             query_cnt=len(self.query_cache))
+                             query_cnt=len(self.query_cache), hashtag_cnt=len(hashtags), keyword_cnt=len(keywords),
+                             max_query_len=max([len(q[0]) for q in self.query_cache]))
 
         except:
             self.__log_event(msg_id=1, screen_print=True, event='query cache creation failed')
@@ -274,11 +452,352 @@ class GVCEHXTwitter():
                       search_query, 
                       search_hashtag_other):
         """
-        Method to run one query against the API and store it
+        Method to run one query against the API and store it.  Result pages are followed
+        with next_token up to max_pages pages, stopping early at tweets already fetched.
+        In incremental searches only tweets newer than the query's high-water mark are
+        requested (since_id).  If an earlier search was cut short by max_pages, the
+        tweets it did not reach are requested first (until_id) - see __record_query_mark.
         """
 
+        # get tweets - one response per page of results
+        ### limits us last 7 days, need elevated account for longer than that
+        search_params = self.__get_search_params(search_query=search_query)
+
+        pages = []
+        next_token = None
+        for page_num in range(self.max_pages):
+
+            tweets = self.client.search_recent_tweets(next_token=next_token, **search_params)
+
+            # No more results
+            if not tweets.data:
+                next_token = None
+                break
+
+            pages.append(tweets)
+
+            # Stop at the last page or once the results reach tweets already fetched
+            next_token = self.__get_next_token(tweets=tweets)
+            if next_token is None:
+                break
+
+        ### not yielding anything? exit early
+        if len(pages) == 0:
+            self.__record_query_mark(search_query=search_query, pages=pages, next_token=next_token)
+            return []
+
+        # Text of quoted tweets - any missing from the responses are looked up 100 at a time
+        quoted_text, missing_ids = self.__find_quoted_texts(pages=pages)
+        for i in range(0, len(missing_ids), 100):
+            qts = self.client.get_tweets(ids=missing_ids[i:i + 100], tweet_fields=["text"])
+            quoted_text.update({int(qt.id): qt.text for qt in qts.data or []})
+
+        rows = self.__parse_pages(pages=pages,
+                                  quoted_text=quoted_text,
+                                  search_query=search_query,
+                                  search_hashtag_other=search_hashtag_other)
+
+        # Keep the query's new high-water mark until its tweets are buffered
+        self.__record_query_mark(search_query=search_query, pages=pages, next_token=next_token)
+
+        return rows
+
+
+    async def query_twitter_async(self,
+                                  search_query,
+                                  search_hashtag_other):
+        """
+        Asynchronous version of query_twitter using the AsyncClient, so several queries
+        can wait on the API at the same time.
+        """
+
+        # get tweets - one response per page of results
+        search_params = self.__get_search_params(search_query=search_query)
+
+        pages = []
+        next_token = None
+        for page_num in range(self.max_pages):
+
+            tweets = await self.async_client.search_recent_tweets(next_token=next_token, **search_params)
+
+            # No more results
+            if not tweets.data:
+                next_token = None
+                break
+
+            pages.append(tweets)
+
+            # Stop at the last page or once the results reach tweets already fetched
+            next_token = self.__get_next_token(tweets=tweets)
+            if next_token is None:
+                break
+
+        ### not yielding anything? exit early
+        if len(pages) == 0:
+            self.__record_query_mark(search_query=search_query, pages=pages, next_token=next_token)
+            return []
+
+        # Text of quoted tweets - any missing from the responses are looked up 100 at a time
+        quoted_text, missing_ids = self.__find_quoted_texts(pages=pages)
+        for i in range(0, len(missing_ids), 100):
+            qts = await self.async_client.get_tweets(ids=missing_ids[i:i + 100], tweet_fields=["text"])
+            quoted_text.update({int(qt.id): qt.text for qt in qts.data or []})
+
+        rows = self.__parse_pages(pages=pages,
+                                  quoted_text=quoted_text,
+                                  search_query=search_query,
+                                  search_hashtag_other=search_hashtag_other)
+
+        # Keep the query's new high-water mark until its tweets are buffered
+        self.__record_query_mark(search_query=search_query, pages=pages, next_token=next_token)
+
+        return rows
+
+
+    def __record_query_mark(self,
+                            search_query,
+                            pages,
+                            next_token):
+        '''
+        Method to record the newest tweet found by a query as its new high-water mark.
+        The mark is only moved if paging finished - the last page was read or the results
+        reached tweets already fetched.
+
+        If max_pages cut an incremental query short, the mark is kept and a resume point
+        is recorded: the oldest tweet read and the newest.  The next fetch of the query
+        only requests the tweets between the mark and the oldest tweet read (since_id and
+        until_id), as tweets newer than that were already read.  Once that paging
+        finishes the mark moves to the newest tweet of the resume point and the resume
+        point is removed; newer tweets are then fetched by the following fetch.
+
+        The mark and resume point are held in query_marks and only become pending (saved
+        with the tweets at the end of the batch scrape) once the query's tweets are buffered.
+
+        Inputs:
+            search_query: str
+                Query searched
+            pages: list
+                tweepy.Response pages with data
+            next_token: str
+                Token of the page after the last page read (None if paging finished)
+
+        '''
+
+        if not hasattr(self, "query_marks"):
+            return
+
+        fetched_tweets = [tweet for tweets in pages for tweet in tweets.data]
+        resume_point = self.__get_resume_point(search_query=search_query)
+        incremental = self.incremental_search and self.seven_days
+
+        query_mark = {}
+
+        if next_token is None:
+
+            # The tweets missed by an earlier fetch have been read - move the mark to the top of that fetch
+            if resume_point is not None:
+                query_mark["high_water_mark"] = (resume_point[2], resume_point[3])
+
+            elif len(fetched_tweets) > 0:
+                newest_tweet = max(fetched_tweets, key=lambda tweet: tweet.id)
+                query_mark["high_water_mark"] = (newest_tweet.id, newest_tweet.created_at.timestamp())
+
+            if incremental:
+                query_mark["resume_point"] = None
+
+        elif incremental:
+
+            # Keep the mark and resume from the oldest tweet read
+            oldest_tweet = min(fetched_tweets, key=lambda tweet: tweet.id)
+            if resume_point is not None:
+                top = (resume_point[2], resume_point[3])
+            else:
+                newest_tweet = max(fetched_tweets, key=lambda tweet: tweet.id)
+                top = (newest_tweet.id, newest_tweet.created_at.timestamp())
+
+            query_mark["resume_point"] = (oldest_tweet.id, oldest_tweet.created_at.timestamp()) + top
+
+        self.query_marks[search_query] = query_mark
+
+
+    def __parse_pages(self,
+                      pages,
+                      quoted_text,
+                      search_query,
+                      search_hashtag_other):
+        '''
+        Method to build the rows of new tweets from the pages of results of a search
+
+        Inputs:
+            pages: list
+                tweepy.Response pages with data
+            quoted_text: dict
+                Dictionary of quoted tweet ID to text
+            search_query: str
+                Query searched
+            search_hashtag_other: str
+                Query's hashtags, joined with ", "
+
+        Output:
+            List of dictionaries of tweets
+
+        '''
+
         return_data = []
 
+        for tweets in pages:
+
+            ### generate our place information
+            if "places" in tweets.includes.keys():
+                place_info = {
+                    place.id: {
+                        "bbox": place.geo[
+                            "bbox"
+                        ],  # geoJSON, min long, min lat, max long, max lat
+                        "full_name": place.full_name,
+                        # place.name
+                        # place.place_type
+                        # place.full_name
+                        # place.country
+                    }
+                    for place in tweets.includes["places"]
+                }
+
+                ### generate our xtwitter xtwitter
+            for tweet, user in zip(tweets.data, tweets.includes["users"]):
+
+                newtweet = {}
+
+                ### unique ID
+                newtweet["tweet_id"] = tweet.id
+
+                # post time
+                newtweet["created_at"] = str(tweet.created_at)
+
+                # original text
+                newtweet["text"] = tweet.text
+
+                ### scrape time
+                newtweet["scrape_time"] = str(datetime.now())
+
+                ### working on quote tweets:
+                if tweet.referenced_tweets:
+                    # print(tweet.text)
+                    for thist in tweet.referenced_tweets:
+                        if thist.data["type"] == "quoted":
+
+                            # Quoted tweet not available (e.g. deleted)
+                            if int(thist.data["id"]) not in quoted_text:
+                                continue
+
+                            mergetweet = (
+                                    newtweet["text"].strip() + " " + quoted_text[int(thist.data["id"])].strip()
+                            )
+                            mergetweet = mergetweet.replace("\n", "")
+
+                            newtweet["text"] = mergetweet
+
+                # reply count
+                newtweet["reply_count"] = tweet.public_metrics["reply_count"]
+                # number of quote tweets
+                newtweet["quote_count"] = tweet.public_metrics["quote_count"]
+                # number of likes
+                newtweet["like_count"] = tweet.public_metrics["like_count"]
+                # number of RTs
+                newtweet["retweet_count"] = tweet.public_metrics["retweet_count"]
+
+                ### geo xtwitter (where available)
+                newtweet["geo_full_name"] = None
+                newtweet["geo_id"] = None
+                newtweet["geo_bbox"] = None
+
+                if tweet.geo:
+                    newtweet["geo_id"] = tweet.geo["place_id"]
+                    newtweet["geo_full_name"] = place_info[tweet.geo["place_id"]]["full_name"]
+                    newtweet["geo_bbox"] = place_info[tweet.geo["place_id"]]["bbox"]
+
+                ### cordinate xtwitter - where available
+                newtweet["tweet_coordinate"] = ""
+                if tweet.geo:
+                    if tweet.geo.get("coordinates", None):
+                        newtweet["tweet_coordinate"] = tweet.geo.get("coordinates").get(
+                            "coordinates"
+                        )
+
+                # poster
+                newtweet["username"] = user.username
+
+                ### user profile location
+                newtweet["user_location"] = user.location
+
+                # number of followers
+                newtweet["num_followers"] = user.public_metrics["followers_count"]
+
+                ### so we know how it was found
+                newtweet["query"] = search_query
+
+                ### more meta xtwitter
+                newtweet["search_hashtag_other"] = self.__match_hashtags(text=newtweet["text"],
+                                                                         search_hashtag_other=search_hashtag_other)
+
+                return_data.append(newtweet)
+
+        return return_data
+
+
+    def __match_hashtags(self,
+                         text,
+                         search_hashtag_other):
+        '''
+        Method to find which of a query's hashtags (or other key search terms) a tweet
+        matched.  Queries search several hashtags at once, so the hashtags found in the
+        tweet's text are returned; if none are found (e.g. the match was on a word form
+        the API normalised) all of the query's hashtags are returned.  During a batch
+        scrape the hashtags actually matched are added to attributed_hashtags, which the
+        scrape's coverage is measured from.
+
+        Inputs:
+            text: str
+                Tweet text
+            search_hashtag_other: str
+                Query's hashtags, joined with ", "
+
+        Output:
+            Matched hashtags, joined with ", "
+
+        '''
+
+        hashtags = search_hashtag_other.split(", ")
+        if len(hashtags) == 1:
+            matched = hashtags
+        else:
+            matched = [ht for ht in hashtags
+                       if re.search(r"(?<![\w#]){}(?!\w)".format(re.escape(ht)), text, flags=re.IGNORECASE)]
+
+        if len(matched) == 0:
+            return search_hashtag_other
+
+        # Record the hashtags tweets were attributed to (for the batch scrape's coverage)
+        if hasattr(self, "attributed_hashtags"):
+            self.attributed_hashtags.update(matched)
+
+        return ", ".join(matched)
+
+
+    def __get_search_params(self,
+                            search_query):
+        '''
+        Method to get the parameters of the search_recent_tweets calls for a query
+
+        Input:
+            search_query: str
+                Query searched
+
+        Output:
+            Dictionary of search_recent_tweets parameters (other than next_token)
+
+        '''
+
         # Determine what start times to pass to the API
         if self.seven_days:
             start_time = None
@@ -288,119 +807,144 @@ class GVCEHXTwitter():
             start_time = self.start_time
             end_time = self.end_time
 
-        # get tweets
-        ### limits us last 7 days, need elevated account for longer than that
-        tweets = self.client.search_recent_tweets(query=search_query,
-                                                  start_time=start_time,
-                                                  end_time=end_time,
-                                                  tweet_fields=self.tweet_fields,
-                                                  user_fields=self.user_fields,
-                                                  max_results=self.max_tweets,
-                                                  place_fields=self.place_fields,
-                                                  expansions=self.expansions,)
-
-        # Manage API call rate
-        self.__manage_api_call_rate()
+        # Resume point of an earlier fetch cut short by max_pages
+        resume_point = self.__get_resume_point(search_query=search_query)
+
+        return {"query": search_query,
+                "start_time": start_time,
+                "end_time": end_time,
+                # Only fetch tweets newer than the query's high-water mark
+                "since_id": self.__get_since_id(search_query=search_query),
+                # And older than the tweets read by an earlier fetch cut short by max_pages
+                "until_id": None if resume_point is None else resume_point[0],
+                "tweet_fields": self.tweet_fields,
+                "user_fields": self.user_fields,
+                "max_results": self.max_tweets,
+                "place_fields": self.place_fields,
+                "expansions": self.expansions}
+
+
+    def __get_next_token(self,
+                         tweets):
+        '''
+        Method to get the token of the page after a page of search results.  There is
+        none after the last page or after a page holding tweets saved by an earlier run
+        (results are newest first, so the pages after it would be too).  Tweets claimed
+        in this run don't count, as they may have been found by another query.
 
-        ### not yielding anything? exit early
-        if not tweets.data:
-            return []
+        Input:
+            tweets: tweepy.Response
+                Page of search results
 
-        ### generate our place information
-        if "places" in tweets.includes.keys():
-            place_info = {
-                place.id: {
-                    "bbox": place.geo[
-                        "bbox"
-                    ],  # geoJSON, min long, min lat, max long, max lat
-                    "full_name": place.full_name,
-                    # place.name
-                    # place.place_type
-                    # place.full_name
-                    # place.country
-                }
-                for place in tweets.includes["places"]
-            }
+        Output:
+            Token of the next page or None
 
-            ### generate our xtwitter xtwitter
-        for tweet, user in zip(tweets.data, tweets.includes["users"]):
+        '''
 
-            newtweet = {}
+        # Stop once the results reach tweets saved by an earlier run
+        if hasattr(self, "seen_tweet_ids"):
+            if any([self.seen_tweet_ids.is_persisted(tweet.id) for tweet in tweets.data]):
+                return None
 
-            ### unique ID
-            newtweet["tweet_id"] = tweet.id
+        return tweets.meta.get("next_token")
 
-            # post time
-            newtweet["created_at"] = str(tweet.created_at)
 
-            # original text
-            newtweet["text"] = tweet.text
+    def __get_since_id(self,
+                       search_query):
+        '''
+        Method to get the since_id for an incremental search from the query's high-water
+        mark.  There is none for custom search windows, queries without a mark or marks
+        older than the recent search window (the API rejects those).
 
-            ### scrape time
-            newtweet["scrape_time"] = str(datetime.now())
+        Input:
+            search_query: str
+                Query searched
 
-            ### working on quote tweets:
-            if tweet.referenced_tweets:
-                # print(tweet.text)
-                for thist in tweet.referenced_tweets:
-                    if thist.data["type"] == "quoted":
-                        qt = self.client.get_tweet(thist.data["id"], tweet_fields=["text"])
+        Output:
+            Tweet ID or None
 
-                        # Add this to the count of API calls
-                        self.__manage_api_call_rate()
+        '''
 
-                        mergetweet = (
-                                newtweet["text"].strip() + " " + qt.data["text"].strip()
-                        )
-                        mergetweet = mergetweet.replace("\n", "")
+        if not self.incremental_search or not self.seven_days or not hasattr(self, "fetch_state"):
+            return None
 
-                        newtweet["text"] = mergetweet
+        since_id, created_utc = self.fetch_state.get_high_water_mark(key=search_query)
 
-            # reply count
-            newtweet["reply_count"] = tweet.public_metrics["reply_count"]
-            # number of quote tweets
-            newtweet["quote_count"] = tweet.public_metrics["quote_count"]
-            # number of likes
-            newtweet["like_count"] = tweet.public_metrics["like_count"]
-            # number of RTs
-            newtweet["retweet_count"] = tweet.public_metrics["retweet_count"]
+        if since_id is None or not self.__in_search_window(created_utc=created_utc):
+            return None
 
-            ### geo xtwitter (where available)
-            newtweet["geo_full_name"] = None
-            newtweet["geo_id"] = None
-            newtweet["geo_bbox"] = None
+        return since_id
 
-            if tweet.geo:
-                newtweet["geo_id"] = tweet.geo["place_id"]
-                newtweet["geo_full_name"] = place_info[tweet.geo["place_id"]]["full_name"]
-                newtweet["geo_bbox"] = place_info[tweet.geo["place_id"]]["bbox"]
 
-            ### cordinate xtwitter - where available
-            newtweet["tweet_coordinate"] = ""
-            if tweet.geo:
-                if tweet.geo.get("coordinates", None):
-                    newtweet["tweet_coordinate"] = tweet.geo.get("coordinates").get(
-                        "coordinates"
-                    )
+    def __get_resume_point(self,
+                           search_query):
+        '''
+        Method to get the resume point left by an earlier incremental search of a query
+        cut short by max_pages.  Resume points whose oldest tweet is older than the recent
+        search window are ignored, as those tweets can't be fetched any more.
+
+        Input:
+            search_query: str
+                Query searched
 
-            # poster
-            newtweet["username"] = user.username
+        Output:
+            Tuple of (oldest tweet ID read, its created_utc, newest tweet ID read, its
+            created_utc) or None
 
-            ### user profile location
-            newtweet["user_location"] = user.location
+        '''
 
-            # number of followers
-            newtweet["num_followers"] = user.public_metrics["followers_count"]
+        if not self.incremental_search or not self.seven_days or not hasattr(self, "fetch_state"):
+            return None
 
-            ### so we know how it was found
-            newtweet["query"] = search_query
+        resume_point = self.fetch_state.get_resume_point(key=search_query)
 
-            ### more meta xtwitter
-            newtweet["search_hashtag_other"] = search_hashtag_other
+        if resume_point is None or not self.__in_search_window(created_utc=resume_point[1]):
+            return None
 
-            return_data.append(newtweet)
+        return resume_point
 
-        return return_data
+
+    def __in_search_window(self,
+                           created_utc):
+        '''
+        Method to check if a tweet created at created_utc is in the recent search window
+        (leaving an hour's margin on the 7 day window)
+        '''
+
+        return time.time() - created_utc <= (timedelta(days=7) - timedelta(hours=1)).total_seconds()
+
+
+    def __find_quoted_texts(self,
+                            pages):
+        '''
+        Method to get the text of the tweets quoted in the pages of results of a search.
+        Quoted tweets are normally returned with the responses through the
+        referenced_tweets.id expansion; the IDs of any that are missing are returned so
+        they can be looked up with batched get_tweets calls of up to 100 IDs.
+
+        Input:
+            pages: list
+                tweepy.Response pages with data
+
+        Output:
+            Dictionary of quoted tweet ID to text and list of missing quoted tweet IDs
+
+        '''
+
+        # Text of the referenced tweets included in the responses
+        quoted_text = {int(ref_tweet.id): ref_tweet.text
+                       for tweets in pages for ref_tweet in tweets.includes.get("tweets", [])}
+
+        # Quoted tweets missing from the responses
+        missing_ids = []
+        for tweets in pages:
+            for tweet in tweets.data:
+                for thist in tweet.referenced_tweets or []:
+                    quoted_id = int(thist.data["id"])
+                    if thist.data["type"] == "quoted" and quoted_id not in quoted_text and quoted_id not in missing_ids:
+                        missing_ids.append(quoted_id)
+
+        return quoted_text, missing_ids
 
 
     def batch_scrape(self):
@@ -408,6 +952,143 @@ class GVCEHXTwitter():
         Method to run a batch of API queries calling the query_twitter method
         each time.
 
+        New tweets and the completed queries are checkpointed every file_update_trigger
+        tweets and if the batch scrape is interrupted.  A batch scrape started after an
+        interruption resumes from the checkpoint, skipping the completed queries.
+
+        '''
+
+        # Set up the batch scrape and get the queries to run
+        our_queries = self.__start_batch_scrape()
+
+        try:
+            for q in our_queries:
+
+                try:
+                    # Get data from API
+                    data = self.query_twitter(search_query=q[0],
+                                              search_hashtag_other=q[1])
+
+                    # Add the new tweets to the results
+                    self.__save_query_results(q=q, data=data)
+
+                except Exception as e:
+
+                    # Log exception
+                    self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
+                                     exception_info=str(e), query_num=self.rate_controller.call_count, query=q[0])
+
+                    # Try to continue
+                    continue
+
+        except BaseException:
+            # Save the progress so a new batch scrape can resume from here
+            self.__save_interrupted_checkpoint()
+
+            raise
+
+        # Save the new tweets
+        self.__finish_batch_scrape()
+
+
+    async def batch_scrape_async(self):
+        '''
+        Asynchronous version of batch_scrape.  Queries run as asyncio tasks calling
+        query_twitter_async, with at most fetch_concurrency queries in flight at any one
+        time.  All of them share the rate controller's per-endpoint limits, so waiting for
+        the API no longer blocks other work running in the event loop.
+
+        Checkpoints work as they do for batch_scrape.
+
+        Needs tweepy's async extras (pip install "tweepy[async]").
+
+        '''
+
+        # Imported here so the fetcher works without tweepy's async extras
+        import x_twitter_async_client as xac
+
+        # Set up the batch scrape and get the queries to run
+        our_queries = self.__start_batch_scrape()
+
+        # Stream the tweets restored from the checkpoint to the scoring queue
+        if self.row_queue is not None and len(self.checkpoint.rows) > 0:
+            await self.row_queue.put(self.checkpoint.rows)
+
+        # Asynchronous client sharing the rate controller of the client
+        self.async_client = xac.AsyncRateControlledClient(rate_controller=self.rate_controller,
+                                                          max_retries=self.max_retries,
+                                                          wait_callback=self.__log_rate_wait,
+                                                          **self.async_client_credentials)
+
+        # Limit the number of queries in flight
+        query_slots = asyncio.Semaphore(self.fetch_concurrency)
+
+        try:
+            await asyncio.gather(*[self.__run_query_async(q=q, query_slots=query_slots)
+                                   for q in our_queries])
+
+        except BaseException:
+            # Save the progress so a new batch scrape can resume from here
+            self.__save_interrupted_checkpoint()
+
+            raise
+
+        finally:
+            # Close the client's HTTP session (opened by its first request)
+            if self.async_client.session is not None:
+                await self.async_client.session.close()
+            self.async_client = None
+
+        # Save the new tweets
+        self.__finish_batch_scrape()
+
+
+    async def __run_query_async(self,
+                                q,
+                                query_slots):
+        '''
+        Method to run one query of an asynchronous batch scrape and add its new tweets
+        to the results
+
+        Inputs:
+            q: tuple
+                Query and its hashtags from the query cache
+            query_slots: asyncio.Semaphore
+                Semaphore limiting the number of queries in flight
+
+        '''
+
+        async with query_slots:
+
+            try:
+                # Get data from API
+                data = await self.query_twitter_async(search_query=q[0],
+                                                      search_hashtag_other=q[1])
+
+                # Add the new tweets to the results
+                new_rows = self.__save_query_results(q=q, data=data)
+
+            except Exception as e:
+
+                # Log exception
+                self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
+                                 exception_info=str(e), query_num=self.rate_controller.call_count, query=q[0])
+
+                return
+
+        # Stream the new tweets to the scoring queue
+        if self.row_queue is not None and len(new_rows) > 0:
+            await self.row_queue.put(new_rows)
+
+
+    def __start_batch_scrape(self):
+        '''
+        Method to set up a batch scrape: start the logger, create the query cache and
+        open the index of fetched tweets, the high-water marks and the checkpoint.
+
+        Output:
+            List of queries from the query cache still to run
+
         '''
 
         # Start logger
@@ -420,161 +1101,232 @@ class GVCEHXTwitter():
         self.__create_query_cache()
         our_queries = self.query_cache[self.query_start_at:]
 
-        try:
-            # Set history file name
-            history_file = "xtwitter_tweets.csv"
+        # Open the index of tweet IDs already fetched
+        self.seen_tweet_ids = si.SeenIdIndex(db_file=os.path.join(self.store_file_path, self.seen_index_file_name),
+                                             source="xtwitter")
 
-            # History file found
-            history_df = pd.read_csv(os.path.join(self.tweets_file_path, history_file))
-            history_cnt = len(history_df)
+        # Build the index from the history file the first time it is used
+        if self.seen_tweet_ids.is_empty():
 
-            # Get list  of tweet ids
-            history_tweet_ids = history_df['tweet_id'].unique().tolist()
+            try:
+                history_tweet_ids = pd.read_csv(os.path.join(self.tweets_file_path, self.tweets_file_name),
+                                                usecols=['tweet_id'])['tweet_id']
+                self.seen_tweet_ids.persist(history_tweet_ids.dropna().unique().tolist())
 
-            # Log file found
-            self.__log_event(msg_id=1, screen_print=False, event='history file loaded',
-                             history_row_cnt=history_cnt)
+                # Log index built
+                self.__log_event(msg_id=1, screen_print=False, event='seen index built from history file',
+                                 history_row_cnt=len(history_tweet_ids))
 
-        except:
-            # No history file found
-            history_cnt = 0
-            history_df = None
-            history_tweet_ids = []
+            except:
+                # Log file not found
+                self.__log_event(msg_id=1, screen_print=False, event='No history file found', history_row_cnt=0)
 
-            # Log file not found
-            self.__log_event(msg_id=1, screen_print=False, event='No history file found', history_row_cnt=history_cnt)
 
+        # Open the queries' high-water marks - new marks are saved once the tweets are
+        self.fetch_state = fs.FetchState(db_file=os.path.join(self.store_file_path, self.fetch_state_file_name),
+                                         source="xtwitter")
+        self.query_marks = {}
+        self.pending_high_water_marks = {}
+        self.pending_resume_points = {}
 
-        data_found = False
-        for q in our_queries:
+        # Load the checkpoint of an unfinished batch scrape, if any
+        self.checkpoint = cp.FetchCheckpoint(checkpoint_file=os.path.join(self.store_file_path, self.checkpoint_file_name),
+                                             max_age=self.checkpoint_max_age)
+        self.checkpoint.load()
 
-            try:
-                # Get data from API
-                data = self.query_twitter(search_query=q[0],
-                                          search_hashtag_other=q[1])
-
-                ### save our xtwitter - only if we got any
-                if data:
-                    data_cleaned = [
-                        {
-                            k: v
-                            for k, v in d.items()
-                            if k not in ("geo_bbox", "tweet_coordinate")
-                        }
-                        for d in data
-                    ]
-                    df = pd.DataFrame(data_cleaned)
-
-                    # Create mask to remove tweets already in history
-                    mask = ~df['tweet_id'].isin(history_tweet_ids)
-                    # Only include tweets not already seen
-                    df = df[mask]
-                    df = df.reset_index()
-
-                    # If this is first time data has been returned from API
-                    if not data_found:
-                        final_results = df
-                        data_found = True
-
-                    # If not add to previous data
-                    final_results = pd.concat(objs=[final_results, df])
-
-                    # Log success
-                    self.__log_event(msg_id=1, screen_print=False, event='fetch success',
-                                     query_num=len(self.api_call_times), len_responses=len(final_results), query=q[1])
+        # Buffer of new tweets, one list per column - the dataframe is only built once all queries have run
+        self.results_buffer = cb.ColumnBuffer()
+        self.rows_since_checkpoint = 0
 
-                else:
+        # Hashtags new tweets were attributed to
+        self.attributed_hashtags = set()
 
-                    # Log no data returned
-                    self.__log_event(msg_id=1, screen_print=False, event='fetch no data', query=q[1])
+        # Restore the tweets found before the interruption and claim them for this run
+        self.results_buffer.append_rows(self.checkpoint.rows)
+        for row in self.checkpoint.rows:
+            self.seen_tweet_ids.add(row['tweet_id'])
 
-            except Exception as e:
+        # Log resumed batch scrape
+        if self.checkpoint.resumed:
+            self.__log_event(msg_id=1, screen_print=True, event='resuming unfinished fetch',
+                             completed_queries=len(self.checkpoint.completed), restored_rows=len(self.checkpoint.rows))
 
-                # Log exception
-                self.__log_event(msg_id=1, screen_print=True, event='fetch exception',
-                                 exception_info=str(e), query_num=len(self.api_call_times), query=q[0])
+        # Skip queries completed before the interruption
+        return [q for q in our_queries if q[0] not in self.checkpoint.completed]
 
-                # Reset  call limit
-                self.api_call_times = len(self.api_call_times)
 
-                # Manage API call rate
-                self.__manage_api_call_rate()
 
-                # Try to continue
-                continue
+    def __save_query_results(self,
+                             q,
+                             data):
+        '''
+        Method to add a query's new tweets to the results buffer and checkpoint the
+        results every file_update_trigger tweets
 
-        # Construct a new dataframe with history and new tweets
-        if type(history_df) != type(None):
-            new_data_df = pd.concat(objs=[history_df, final_results])
+        Inputs:
+            q: tuple
+                Query and its hashtags from the query cache
+            data: list
+                List of dictionaries of tweets returned by the query
 
-        elif type(final_results) != type(None):
-            new_data_df = final_results
+        Output:
+            List of dictionaries of the new tweets
+
+        '''
+
+        data_cleaned = []
+
+        ### save our xtwitter - only if we got any
+        if data:
+            for d in data:
+
+                # Skip tweets already in history (or found by an earlier query)
+                if d['tweet_id'] in self.seen_tweet_ids:
+                    continue
+
+                # Claim this tweet for this run
+                self.seen_tweet_ids.add(d['tweet_id'])
+
+                data_cleaned.append({k: v for k, v in d.items()
+                                     if k not in ("geo_bbox", "tweet_coordinate")})
+
+            # Add the new tweets to the buffer
+            self.results_buffer.append_rows(data_cleaned)
+
+            # Log success
+            self.__log_event(msg_id=1, screen_print=False, event='fetch success',
+                             query_num=self.rate_controller.call_count, len_responses=len(self.results_buffer), query=q[1])
+
+            self.rows_since_checkpoint += len(data_cleaned)
 
         else:
-            self.__log_event(msg_id=1, screen_print=False, event='no results found')
 
-        # Drop duplicates
-        new_data_df = new_data_df.drop_duplicates(subset=self.dup_cols)
+            # Log no data returned
+            self.__log_event(msg_id=1, screen_print=False, event='fetch no data', query=q[1])
 
-        # Save the file
-        new_data_df.to_csv(path_or_buf=os.path.join(self.tweets_file_path, history_file),
-                           index=False)
+        # Now its tweets are buffered, the query's new high-water mark and resume point can be saved with them
+        query_mark = self.query_marks.pop(q[0], {})
+        if "high_water_mark" in query_mark:
+            self.pending_high_water_marks[q[0]] = query_mark["high_water_mark"]
+        if "resume_point" in query_mark:
+            self.pending_resume_points[q[0]] = query_mark["resume_point"]
 
-        # Log file update - finished fetch
-        self.__log_event(msg_id=1, screen_print=True, event='fetch complete')
+        # Record the completed query
+        self.checkpoint.completed.add(q[0])
 
-        # Close logging
-        self.__log_event(msg_id=-1, screen_print=False)
+        # Checkpoint the tweets added since the last checkpoint every file_update_trigger tweets
+        if self.rows_since_checkpoint >= self.file_update_trigger:
+            self.checkpoint.save(rows=self.results_buffer.to_records(start=self.checkpoint.row_count))
+            self.rows_since_checkpoint = 0
 
-    def __manage_api_call_rate(self):
+        return data_cleaned
+
+
+    def __save_interrupted_checkpoint(self):
+        '''
+        Method to checkpoint an interrupted batch scrape so it can be resumed
         '''
-        Method to pause fetch methods from calling the Reddit API to avoid rate limit exceptions.
-        Pauses are only needed if the program has made too many API calls within a specified window.
-        However. this method should be called after each API call since it also provides the
-        check determining if a pause is needed.
 
-        Key class parameters:
-            self.api_call_limit: The maximum number of API calls during a specified time window
-            self.rate_limit_window: The time window over which API calls are counted
-            self.api_call_times = deque(): A doubly ended queue store of timestamps for all API calls
-            self.pause_indexes = deque(): A doubly ended queue store of timestamps indexes at which API fetching
-                    was paused
+        self.checkpoint.save(rows=self.results_buffer.to_records(start=self.checkpoint.row_count))
 
+        # Log checkpoint
+        self.__log_event(msg_id=1, screen_print=True, event='fetch interrupted - checkpoint saved',
+                         completed_queries=len(self.checkpoint.completed))
 
+
+    def __finish_batch_scrape(self):
+        '''
+        Method to add the new tweets to the tweets file, record them in the index of
+        fetched tweets and save the queries' high-water marks
         '''
 
-        # Record the time this method was called which should correspond with an API call time
-        self.api_call_times.append(datetime.now())
+        # Read the history file
+        try:
+            history_df = pd.read_csv(os.path.join(self.tweets_file_path, self.tweets_file_name))
 
-        # Check rate limit - if equal to a multiple of the rate limit then we need to pause
-        if len(self.api_call_times) >= self.api_call_limit * (len(self.pause_indexes) + 1):
+            # Log file found
+            self.__log_event(msg_id=1, screen_print=False, event='history file loaded',
+                             history_row_cnt=len(history_df))
 
-            # Add this pause to the indexes of pauses
-            self.pause_indexes.append(len(self.api_call_times) - 1)
+        except:
+            # No history file found
+            history_df = None
 
-            # If this is the first pause wait until time uses first API entry
-            if len(self.pause_indexes) == 0:
+        # Build the dataframe of new tweets in one step
+        if len(self.results_buffer) > 0:
+            final_results = self.results_buffer.to_dataframe()
+        else:
+            final_results = None
 
-                wait_until = self.api_call_times[0] + self.rate_limit_window
+        # Construct a new dataframe with history and new tweets
+        if type(history_df) != type(None) and type(final_results) != type(None):
+            new_data_df = pd.concat(objs=[history_df, final_results])
 
-            # otherwise use the time of the last pause
-            else:
-                wait_until = self.api_call_times[self.pause_indexes[-1]] + self.rate_limit_window
+        elif type(final_results) != type(None):
+            new_data_df = final_results
 
-            # Now wait by pausing the API
-            wait_time = (wait_until - datetime.now()).total_seconds()
+        else:
+            new_data_df = None
+            self.__log_event(msg_id=1, screen_print=False, event='no results found')
 
-            #  Log the pause
-            self.__log_event(msg_id=1, screen_print=True, event='rate limit reached',
-                             wait_time_sec=wait_time, api_call_count=len(self.api_call_times))
+        # Save the file - only if there are new tweets
+        if type(new_data_df) != type(None):
 
-            time.sleep(wait_time)
+            # Drop duplicates
+            new_data_df = new_data_df.drop_duplicates(subset=self.dup_cols)
 
-        else:
+            new_data_df.to_csv(path_or_buf=os.path.join(self.tweets_file_path, self.tweets_file_name),
+                               index=False)
+
+        # Record the saved tweets in the index of fetched IDs
+        self.seen_tweet_ids.persist(list(self.seen_tweet_ids.claimed))
+        self.seen_tweet_ids.close()
+
+        # Now the tweets are saved, save the queries' high-water marks and resume points
+        for search_query, (tweet_id, created_utc) in self.pending_high_water_marks.items():
+            self.fetch_state.set_high_water_mark(key=search_query,
+                                                 post_id=tweet_id,
+                                                 created_utc=created_utc)
+        for search_query, resume_point in self.pending_resume_points.items():
+            self.fetch_state.set_resume_point(key=search_query,
+                                              resume_point=resume_point)
+        self.fetch_state.close()
+
+        # The batch scrape is finished - no need to resume it
+        self.checkpoint.clear()
+
+        # Coverage - share of the queries' hashtags that new tweets were attributed to
+        query_hashtags = set([ht for q in self.query_cache for ht in q[1].split(", ")])
+        self.__log_event(msg_id=1, screen_print=False, event='hashtag coverage',
+                         hashtag_cnt=len(query_hashtags),
+                         attributed_cnt=len(self.attributed_hashtags & query_hashtags),
+                         coverage=len(self.attributed_hashtags & query_hashtags) / max(1, len(query_hashtags)))
+
+        # Log file update - finished fetch
+        self.__log_event(msg_id=1, screen_print=True, event='fetch complete')
+
+        # Close logging
+        self.__log_event(msg_id=-1, screen_print=False)
 
-            # Even if we're not at limit's wait a short time
-            wait_time = self.api_sleep_time
-            time.sleep(wait_time)
+    def __log_rate_wait(self,
+                        endpoint,
+                        wait_time,
+                        event):
+        '''
+        Method to log a wait for an API endpoint's rate limit
+
+        Inputs:
+            endpoint: str
+                API endpoint waited for
+            wait_time: float
+                Seconds waited
+            event: str
+                Reason for the wait
+
+        '''
+
+        self.__log_event(msg_id=1, screen_print=True, event=event, endpoint=endpoint,
+                         wait_time_sec=wait_time, api_call_count=self.rate_controller.call_count)
 
 
     def __log_event(self,
@@ -606,27 +1358,31 @@ class GVCEHXTwitter():
         # msg_id = -1 - Close logger
         if self.fetch_logging and msg_id == -1:
 
-            # Close any open logs
-            logging.shutdown()
+            # Close the log file
+            for handler in self.logger.handlers[:]:
+                handler.close()
+                self.logger.removeHandler(handler)
 
         # msg_id = 0 - Set up the logger
         if self.fetch_logging and msg_id == 0:
 
-            # Close any open logs
-            logging.shutdown()
-
             # Name a new log file
             log_file = f"{kwargs['logfile_stub']}_logfile.log"
 
+            # Use a named logger rather than the root logger so that pipelines running at
+            # the same time (see run_scrapers.py) do not reconfigure each other's logs
+            self.logger = logging.getLogger("gvceh.xtwitter.{}".format(kwargs['logfile_stub']))
+            for handler in self.logger.handlers[:]:
+                handler.close()
+                self.logger.removeHandler(handler)
+
             # Configure the logging system
-            logging.basicConfig(filename=os.path.join(self.logs_file_path, log_file),
-                                filemode='w',
-                                format='%(levelname)s - %(message)s',
-                                level=logging.INFO,
-                                force=True)
-
-            # Create a logger
-            self.logger = logging.getLogger()
+            handler = logging.FileHandler(filename=os.path.join(self.logs_file_path, log_file),
+                                          mode='w')
+            handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
 
         # msg_id = 1 - Data fetch start
         elif self.fetch_logging and msg_id == 1:
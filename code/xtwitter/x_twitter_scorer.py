@@ -7,8 +7,16 @@ from datetime import datetime
 # Logging and monitoring
 import logging
 
-from transformers import pipeline
-from setfit import SetFitModel
+# Asynchronous work
+import asyncio
+
+# GVCEH objects
+# Utilities folder, found from this file so the standalone scrapers (run from their own folder) can import it too
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import incremental_scores as isc
+import inference_cache as ic
+import model_registry as mr
+import model_server as ms
 
 
 class ScoreTweets():
@@ -25,6 +33,8 @@ class ScoreTweets():
 
         relevance_model_hf_location: Hugging Face location for relevance model
         sentiment_model_hf_location: Hugging Face location for sentiment model
+        model_server_url: URL of a running model server (see run_model_server.py) - models are
+                          loaded in this process if blank or the server can't be reached
 
         gcp_project_id: GCP Project ID
 
@@ -35,6 +45,19 @@ class ScoreTweets():
         update_scores: Boolean indicating if scores should be updated and overwritten (True)
                         or only new scores should be added for not scored tweets
 
+        incremental_scoring: Boolean indicating if tweets keep their previous scores when neither
+                             their text (text_hash) nor the models (model_version) have changed
+        score_cols: Columns holding the model scores
+
+        use_inference_cache: Boolean indicating if model outputs are cached by text (shared with ScorePosts)
+        inference_cache_file_path: Path to the inference cache (an SQLite file which must be on local disk)
+        inference_cache_file_name: Name of the inference cache file
+        inference_cache_max_entries: Number of model outputs kept in the inference cache
+
+        streaming: Boolean indicating if tweets are scored in micro-batches as they are fetched
+                   (see score_stream) instead of all at once from the new tweets file
+        micro_batch_size: Number of tweets scored together in streaming mode
+
         fetch_logging: Boolean to turn logging on and off
         dtformat: String format for time values
 
@@ -51,6 +74,7 @@ class ScoreTweets():
     # Model parameters
     relevance_model_hf_location = "sheilaflood/gvceh-setfit-rel-model2"
     sentiment_model_hf_location = "cardiffnlp/twitter-roberta-base-sentiment-latest"
+    model_server_url = ""
 
     # Dup columns
     dup_cols = ["tweet_id", "created_at", "text"]
@@ -61,6 +85,20 @@ class ScoreTweets():
     # Flag indicating if old scores should be overwritten
     update_scores = True
 
+    # Only score tweets whose text or models have changed
+    incremental_scoring = True
+    score_cols = ["is_relevant", "sentiment", "sentiment_score"]
+
+    # Cache of model outputs
+    use_inference_cache = True
+    inference_cache_file_path = "../data/store"
+    inference_cache_file_name = "inference_cache.db"
+    inference_cache_max_entries = 500000
+
+    # Streaming mode
+    streaming = False
+    micro_batch_size = 64
+
     # Logging flag
     score_logging = True
 
@@ -70,10 +108,12 @@ class ScoreTweets():
     def __init__(self,
                  update_scores=False,
                  score_logging=True,
+                 streaming=False,
                  **kwargs
                  ):
         '''
-        Initialize the ScoreTweets class.
+        Initialize the ScoreTweets class.  Unless streaming, all of the new tweets are
+        scored and saved straight away.
         '''
 
         # Update any key word args
@@ -86,24 +126,47 @@ class ScoreTweets():
         if score_logging != True:
             self.score_logging = False
 
+        # Open the cache of model outputs
+        self.inference_cache = None
+        if self.use_inference_cache:
+            self.inference_cache = ic.InferenceCache(db_file=os.path.join(self.inference_cache_file_path,
+                                                                          self.inference_cache_file_name),
+                                                     max_entries=self.inference_cache_max_entries)
+
         # Start logger
         self.__log_event(msg_id=0, screen_print=False, logfile_stub='xtwitter_scorer')
 
         # Log score start
-        self.__log_event(msg_id=1, screen_print=True, event='start score', source='xtwitter')
+        self.__log_event(msg_id=1, screen_print=True, event='start score', source='xtwitter', streaming=streaming)
+
+        # Set up the models - run on the model server if there is one, otherwise loaded on
+        # first use (once per process)
+        self.__connect_models()
+
+        # In streaming mode tweets are scored by score_stream - only new tweets are scored
+        if streaming:
+            self.streaming = True
+            self.update_scores = False
+            self.scored_batches = []
+
+            # Previously scored tweets, to reuse their scores
+            if self.incremental_scoring:
+                self.__read_scored_file()
+
+            return
 
         # Read tweet data
         self.read_tweet_file()
 
-        # Score for relevance
-        self.score_relevance()
-
-        # Score for sentiment
-        self.sentiment_model()
+        # Score for relevance and sentiment
+        self.__score_changed_tweets()
 
         # Score for relevance
         self.write_tweet_file()
 
+        # Close the cache of model outputs
+        self.__close_inference_cache()
+
         # Close logging
         self.__log_event(msg_id=-1, screen_print=False)
 
@@ -115,25 +178,161 @@ class ScoreTweets():
         '''
 
         # Log relevance score start
-        self.__log_event(msg_id=1, screen_print=True, event='start relevance scoring', source='xtwitter')
-
-        # create the model
-        model = SetFitModel.from_pretrained(self.relevance_model_hf_location)
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='start relevance scoring', source='xtwitter')
 
         # Put the text columns into a list
         all_text = self.df_new['text'].tolist()
 
-        # Score the text
-        all_results = model(all_text)
-
-        # Convert to values
-        all_results = all_results.cpu().numpy()
+        # Score the text not in the cache - cached outputs are kept per model version
+        self.__get_model_version()
+        all_results = self.__cached_predict(model="relevance|{}".format(self.model_versions["relevance"]),
+                                            texts=all_text,
+                                            predict_fn=self.__predict_relevance)
 
         # add a is_relevant column
         self.df_new['is_relevant'] = all_results
 
         # Log relevance score completion
-        self.__log_event(msg_id=1, screen_print=True, event='relevance scoring completed', source='xtwitter')
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='relevance scoring completed', source='xtwitter')
+
+
+    def __predict_relevance(self,
+                            all_text):
+        '''
+        Method to predict relevance for a list of texts
+
+        Output:
+            List of predictions in the order of the texts
+
+        '''
+
+        if self.model_server is not None:
+            return self.model_server.predict(name="xtwitter_relevance", texts=all_text)
+
+        return self.model_registry.predict_setfit(hf_location=self.relevance_model_hf_location,
+                                                  texts=all_text)
+
+
+    def __cached_predict(self,
+                         model,
+                         texts,
+                         predict_fn):
+        '''
+        Method to get model outputs for a list of texts from the inference cache, only
+        running texts not in the cache through predict_fn
+
+        Output:
+            List of outputs in the order of the texts
+
+        '''
+
+        if self.inference_cache is None:
+            return predict_fn(texts)
+
+        return self.inference_cache.predict(model=model, texts=texts, predict_fn=predict_fn)
+
+
+    def __close_inference_cache(self):
+        '''
+        Method to log the inference cache hits and misses and close the cache
+
+        '''
+
+        if self.inference_cache is None:
+            return
+
+        # Log cache use
+        self.__log_event(msg_id=1, screen_print=False, event='inference cache', source='xtwitter',
+                         hits=self.inference_cache.hits, misses=self.inference_cache.misses,
+                         evictions=self.inference_cache.evictions)
+
+        self.inference_cache.close()
+        self.inference_cache = None
+
+
+    def __get_model_version(self):
+        '''
+        Method to get the version of the relevance and sentiment models saved with each
+        tweet's scores - each model's Hugging Face location and revision (commit hash)
+
+        '''
+
+        if self.model_version is None:
+
+            # Models run on the model server are the versions it loaded
+            if self.model_server is not None:
+                self.model_versions = {"relevance": self.model_server_versions.get("xtwitter_relevance"),
+                                       "sentiment": self.model_server_versions.get("sentiment")}
+
+            # Otherwise the versions this process loads
+            else:
+                self.model_versions = {"relevance": self.model_registry.get_hf_version(self.relevance_model_hf_location),
+                                       "sentiment": self.model_registry.get_hf_version(self.sentiment_model_hf_location)}
+
+            self.model_version = "{}|{}".format(self.model_versions["relevance"], self.model_versions["sentiment"])
+
+        return self.model_version
+
+
+    def __connect_models(self):
+        '''
+        Method to set up the model registry and, if model_server_url is set, connect to
+        the model server
+
+        '''
+
+        # Hugging Face caches the models on disk
+        self.model_registry = mr.ModelRegistry()
+        self.model_version = None
+        self.model_versions = None
+
+        self.model_server = None
+        self.model_server_versions = None
+        if len(self.model_server_url) > 0:
+            self.model_server = ms.ModelServerClient(url=self.model_server_url)
+            self.model_server_versions = self.model_server.get_versions()
+
+            # Fall back to loading the models here
+            if self.model_server_versions is None:
+                self.model_server = None
+
+            # Log model server connection
+            self.__log_event(msg_id=1, screen_print=True, event='model server', source='xtwitter',
+                             url=self.model_server_url, connected=self.model_server is not None)
+
+
+    def __score_changed_tweets(self):
+        '''
+        Method to score tweets for relevance and sentiment.  Each tweet keeps a hash of the
+        text scored and the version of the models.  With incremental_scoring set, only
+        tweets without previous scores for the same text hash and model version are run
+        through the models - the rest keep their previous scores.
+
+        '''
+
+        # Record the text and models the tweets are scored with
+        self.df_new['text_hash'] = isc.hash_texts(self.df_new['text'])
+        self.df_new['model_version'] = self.__get_model_version()
+
+        # Split off tweets whose scores are unchanged
+        df_reused = None
+        if self.incremental_scoring and self.scored_file_found:
+            self.df_new, df_reused = isc.split_scored_rows(df=self.df_new,
+                                                           df_scored=self.df_scored,
+                                                           score_cols=self.score_cols)
+
+        # Log tweets to score
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='tweets to score', source='xtwitter',
+                         score_cnt=len(self.df_new), reused_cnt=0 if df_reused is None else len(df_reused))
+
+        # Score for relevance and sentiment
+        if len(self.df_new) > 0:
+            self.score_relevance()
+            self.sentiment_model()
+
+        # Add back the tweets with unchanged scores
+        if df_reused is not None and len(df_reused) > 0:
+            self.df_new = pd.concat(objs=[self.df_new, df_reused])
 
 
     def sentiment_model(self):
@@ -146,22 +345,16 @@ class ScoreTweets():
         '''
 
         # Log sentiment score start
-        self.__log_event(msg_id=1, screen_print=True, event='start sentiment scoring', source='xtwitter')
-
-        # create the model ( #-1 = cpu, 0 = gpu )
-        model = pipeline(task="sentiment-analysis",
-                         model=self.sentiment_model_hf_location,
-                         device=-1)
-        model.tokenizer.model_max_length = 512
-
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='start sentiment scoring', source='xtwitter')
 
         # Put the text columns into a list
         all_text = self.df_new['text'].tolist()
 
-        all_res = []
-
-        for res in model(all_text, batch_size=32, truncation=True):
-            all_res.append(res)
+        # Score the text not in the cache - cached outputs are kept per model version
+        self.__get_model_version()
+        all_res = self.__cached_predict(model="sentiment|{}".format(self.model_versions["sentiment"]),
+                                        texts=all_text,
+                                        predict_fn=self.__analyze_sentiment)
 
         all_sentiments = [x['label'] for x in all_res]
         all_scores = [x['score'] for x in all_res]
@@ -170,7 +363,25 @@ class ScoreTweets():
         self.df_new['sentiment_score'] = all_scores
 
         # Log sentiment score start
-        self.__log_event(msg_id=1, screen_print=True, event='sentiment scoring completed', source='xtwitter')
+        self.__log_event(msg_id=1, screen_print=not self.streaming, event='sentiment scoring completed', source='xtwitter')
+
+
+    def __analyze_sentiment(self,
+                            all_text):
+        '''
+        Method to analyze sentiment for a list of texts
+
+        Output:
+            List of dictionaries of sentiment label and score in the order of the texts
+
+        '''
+
+        if self.model_server is not None:
+            return self.model_server.predict(name="sentiment", texts=all_text)
+
+        return self.model_registry.predict_sentiment(hf_location=self.sentiment_model_hf_location,
+                                                     texts=all_text,
+                                                     batch_size=32)
 
 
     def read_tweet_file(self):
@@ -197,6 +408,22 @@ class ScoreTweets():
             raise RuntimeError(msg)
 
         # Look for an existing file with scored tweet data
+        self.__read_scored_file()
+
+        # If we're updating everything create one big data frame
+        # Otherwise just score the new tweets and then concat with previously scored
+        # before writing (assuming scored file found)
+        if self.update_scores and self.scored_file_found:
+
+            self.df_new = pd.concat(objs=[self.df_new, self.df_scored])
+
+
+    def __read_scored_file(self):
+        '''
+        Method to read previously scored tweets, if there are any
+
+        '''
+
         try:
             self.df_scored = pd.read_csv(filepath_or_buffer=os.path.join(self.tweets_file_path,
                                                                          self.scored_input_file_name))
@@ -207,12 +434,112 @@ class ScoreTweets():
 
             self.scored_file_found = False
 
-        # If we're updating everything create one big data frame
-        # Otherwise just score the new tweets and then concat with previously scored
-        # before writing (assuming scored file found)
-        if self.update_scores and self.scored_file_found:
 
-            self.df_new = pd.concat(objs=[self.df_new, self.df_scored])
+    def score_batch(self,
+                    rows):
+        '''
+        Method to score a micro-batch of new tweets in streaming mode.  The scored tweets
+        are kept until finish_stream saves them.
+
+        Input:
+            rows: list
+                List of dictionaries of new tweets
+
+        '''
+
+        self.df_new = pd.DataFrame(rows)
+
+        # Score for relevance and sentiment
+        self.__score_changed_tweets()
+
+        self.scored_batches.append(self.df_new)
+
+        # Log micro-batch
+        self.__log_event(msg_id=1, screen_print=False, event='micro-batch scored', source='xtwitter',
+                         tweet_cnt=len(self.df_new))
+
+
+    def finish_stream(self):
+        '''
+        Method to save the tweets scored in streaming mode with the previously scored
+        tweets and close logging.  The scored tweets file may be in cloud storage, where
+        files can't be appended to, so it is written once at the end.
+
+        '''
+
+        if len(self.scored_batches) > 0:
+
+            # Combine the scored micro-batches
+            self.df_new = pd.concat(objs=self.scored_batches)
+
+            # Add the previously scored tweets and save
+            self.__read_scored_file()
+            self.write_tweet_file()
+
+        else:
+            self.__log_event(msg_id=1, screen_print=True, event='no new tweets to score', source='xtwitter')
+
+        # Close the cache of model outputs
+        self.__close_inference_cache()
+
+        # Close logging
+        self.__log_event(msg_id=-1, screen_print=False)
+
+
+    async def score_stream(self,
+                           row_queue):
+        '''
+        Method to score new tweets as they are fetched.  Lists of new tweets are taken
+        from the queue until a None is received and scored in micro-batches of at least
+        micro_batch_size tweets in a worker thread, so the fetch keeps running while the
+        models work.  The queue is bounded, so a fetch that gets ahead of scoring waits.
+
+        If scoring fails the queue is still drained, so the fetch is never left waiting,
+        and the error is raised once the None is received.
+
+        Input:
+            row_queue: asyncio.Queue
+                Queue of lists of dictionaries of new tweets, ended by None
+
+        '''
+
+        rows = []
+        stream_error = None
+
+        while True:
+
+            new_rows = await row_queue.get()
+
+            # End of stream
+            if new_rows is None:
+                break
+
+            # Keep draining the queue after a failure
+            if stream_error is not None:
+                continue
+
+            rows.extend(new_rows)
+
+            # Score a full micro-batch
+            if len(rows) >= self.micro_batch_size:
+                try:
+                    await asyncio.to_thread(self.score_batch, rows)
+
+                except Exception as e:
+                    stream_error = e
+                    self.__log_event(msg_id=1, screen_print=True, event='scoring exception',
+                                     exception_info=str(e), source='xtwitter')
+
+                rows = []
+
+        if stream_error is not None:
+            raise RuntimeError(stream_error)
+
+        # Score what is left and save
+        if len(rows) > 0:
+            await asyncio.to_thread(self.score_batch, rows)
+
+        await asyncio.to_thread(self.finish_stream)
 
 
     def write_tweet_file(self):
@@ -266,27 +593,31 @@ class ScoreTweets():
         # msg_id = -1 - Close logger
         if self.score_logging and msg_id == -1:
 
-            # Close any open logs
-            logging.shutdown()
+            # Close the log file
+            for handler in self.logger.handlers[:]:
+                handler.close()
+                self.logger.removeHandler(handler)
 
         # msg_id = 0 - Set up the logger
         if self.score_logging and msg_id == 0:
 
-            # Close any open logs
-            logging.shutdown()
-
             # Name a new log file
             log_file = f"{kwargs['logfile_stub']}_logfile.log"
 
+            # Use a named logger rather than the root logger so that pipelines running at
+            # the same time (see run_scrapers.py) do not reconfigure each other's logs
+            self.logger = logging.getLogger("gvceh.scorer.{}".format(kwargs['logfile_stub']))
+            for handler in self.logger.handlers[:]:
+                handler.close()
+                self.logger.removeHandler(handler)
+
             # Configure the logging system
-            logging.basicConfig(filename=os.path.join(self.logs_file_path, log_file),
-                                filemode='w',
-                                format='%(levelname)s - %(message)s',
-                                level=logging.INFO,
-                                force=True)
-
-            # Create a logger
-            self.logger = logging.getLogger()
+            handler = logging.FileHandler(filename=os.path.join(self.logs_file_path, log_file),
+                                          mode='w')
+            handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
 
         # msg_id = 1 - Data fetch start
         elif self.score_logging and msg_id == 1: